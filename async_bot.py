@@ -0,0 +1,723 @@
+import os
+import time
+import asyncio
+import logging
+import weakref
+from functools import wraps
+from datetime import datetime
+import telebot
+from telebot import asyncio_helper, util
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import CallbackQuery, ReplyKeyboardRemove
+from messages import *
+import core
+from sessions import Session, AsyncSessionStore, get_status_code, STATUS_ICONS, STATUS_TAKE_LATER, NEXT_STATUS
+from groups import GroupSession
+from logs import setup_logging, log_handled
+import startup
+import metrics
+from dedupe import skip_duplicates, get_update_id
+from metrics import track_handler
+from render import AsyncDebouncer
+from ratelimit import AsyncSendScheduler
+from core import (catalog, group_data, message_states, search_queries, is_stale_update, get_callback_index, get_status_icon,
+                  get_buy_keyboard, get_edit_list_keyboard, format_results,
+                  START_KEYBOARD, PACK_KEYBOARD, FINAL_KEYBOARD, FULL_LIST_KEYBOARD,
+                  render_list_selection, render_list_selected, render_full_list, render_item,
+                  render_item_editor, render_packing_step,
+                  is_group_chat, render_group_list_selection, render_group_summary,
+                  parse_departure, format_reminder, REMINDER_LEADS,
+                  normalize_query, search_items, render_search_page, render_inline_result)
+
+# Асинхронный режим: те же хендлеры, что и в bot.py, поверх AsyncTeleBot.
+# Общие настройки и отрисовка берутся из core, синхронный бот из bot.py не создаётся.
+# Запуск: python async_bot.py
+
+setup_logging()
+logger = logging.getLogger(__name__)
+startup.timer.mark('imports')
+
+# Все запросы идут через одну aiohttp-сессию telebot; ограничиваем размер её пула соединений
+asyncio_helper.REQUEST_LIMIT = int(os.environ.get('ASYNC_CONNECTION_LIMIT', '100'))
+if core.TELEGRAM_API_URL:
+    asyncio_helper.API_URL = core.TELEGRAM_API_URL
+    telebot.apihelper.API_URL = core.TELEGRAM_API_URL
+
+# Один ограничитель на ответы хендлеров и синхронный клиент напоминаний: они делят общий лимит
+send_scheduler = core.create_send_scheduler()
+if core.RATE_LIMIT_ENABLED:
+    send_scheduler.install()
+    AsyncSendScheduler(send_scheduler).install()
+if core.METRICS_ENABLED:
+    metrics.instrument_requests()
+    metrics.instrument_async_requests()
+
+bot = AsyncTeleBot(core.TOKEN)
+seen_updates = core.open_update_deduplicator()
+skip_duplicates(bot, seen_updates)
+
+catalog.load()
+startup.timer.mark('catalog')
+
+# Запросы к SQLite выполняются в пуле потоков и не останавливают цикл событий
+user_data = AsyncSessionStore(core.open_session_store())
+startup.timer.mark('sessions')
+
+# Правки списка откладываются на цикле событий
+edit_debouncer = AsyncDebouncer(core.EDIT_DEBOUNCE)
+
+async def reset_progress(user_id):
+    await user_data.delete(user_id)
+    # Очередь напоминаний с бэкендом sqlite — тоже запрос к базе
+    await asyncio.to_thread(reminder_engine.cancel, user_id)
+
+def forget_message(message):
+    edit_debouncer.cancel((message.chat.id, message.message_id))
+    message_states.forget(message.chat.id, message.message_id)
+
+# Апдейты разных чатов обрабатываются параллельно, а одного чата — по порядку
+_chat_locks = weakref.WeakValueDictionary()
+
+def chat_ordered(handler):
+    @wraps(handler)
+    async def wrapper(update):
+        chat = update.message.chat if isinstance(update, CallbackQuery) else update.chat
+        lock = _chat_locks.get(chat.id)
+        if lock is None:
+            lock = asyncio.Lock()
+            _chat_locks[chat.id] = lock
+        async with lock:
+            return await handler(update)
+    return wrapper
+
+async def is_stale(user_data_entry, event):
+    if not is_stale_update(user_data_entry, event, seen_updates):
+        return False
+    if isinstance(event, CallbackQuery):
+        await bot.answer_callback_query(event.id)
+    return True
+
+async def send_markdown(chat_id, text, **kwargs):
+    try:
+        await bot.send_message(chat_id, text, parse_mode='Markdown', **kwargs)
+    except asyncio_helper.ApiException as e:
+        logger.error("Failed to send message with Markdown. Sending without formatting. Error: %s", e)
+        await bot.send_message(chat_id, text, **kwargs)
+
+# Хендлеры сообщений
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('select_list_'))
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def handle_list_selection(call):
+    list_id = call.data.split('_', 2)[2]
+    user_id = call.from_user.id
+
+    current_entry = await user_data.get(user_id)
+    if current_entry and await is_stale(current_entry, call):
+        return
+
+    snapshot = catalog.snapshot
+    selected_list = snapshot.get_list(list_id)
+
+    if selected_list:
+        await user_data.save(user_id, Session(selected_list, snapshot.version, version=get_update_id(call) or 0))
+        await asyncio.gather(
+            bot.answer_callback_query(call.id, f"Вы выбрали: {selected_list['name']}"),
+            bot.edit_message_text(render_list_selected(snapshot, selected_list),
+                                  call.message.chat.id,
+                                  call.message.message_id))
+        await bot.send_message(call.message.chat.id, START_MESSAGE, reply_markup=START_KEYBOARD)
+    else:
+        await bot.answer_callback_query(call.id, "Ошибка: список не найден")
+
+async def show_list_selection(chat_id):
+    await bot.send_message(chat_id, CHOOSE_HIKE_TYPE, reply_markup=render_list_selection())
+
+@bot.message_handler(commands=[COMMAND_START, COMMAND_RESET])
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def start(message):
+    logger.info("Received start/reset command from user %s", message.from_user.id)
+    await reset_progress(message.from_user.id)
+    await show_list_selection(message.chat.id)
+
+@bot.message_handler(func=lambda message: message.text == BUTTON_PACK)
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def pack(message):
+    logger.info("User %s started packing", message.from_user.id)
+    user_id = message.from_user.id
+    user_data_entry = await user_data.get(user_id)
+    if not user_data_entry:
+        await show_list_selection(message.chat.id)
+        return
+    if await is_stale(user_data_entry, message):
+        return
+
+    # Сбрасываем прогресс, но оставляем выбранный список
+    user_data_entry = Session(user_data_entry.current_list, user_data_entry.catalog_version,
+                              version=user_data_entry.version)
+    await user_data.save(user_id, user_data_entry)
+    if core.PACKING_MODE == 'inline' and user_data_entry.current_list['items']:
+        text, keyboard = render_packing_step(user_data_entry)
+        await send_markdown(message.chat.id, text, reply_markup=keyboard)
+        return
+    await bot.send_message(message.chat.id, PACK_START_MESSAGE, reply_markup=PACK_KEYBOARD)
+    await ask_object(message.chat.id, user_id)
+
+@bot.message_handler(func=lambda message: message.text == BUTTON_SHOW_LIST)
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def show_full_list(message):
+    logger.info("User %s requested full list", message.from_user.id)
+    user_data_entry = await user_data.get(message.from_user.id)
+
+    if not user_data_entry:
+        await show_list_selection(message.chat.id)
+        return
+
+    # Части списка отправляются по очереди, чтобы не перепутаться в чате
+    pages = render_full_list(user_data_entry)
+    for page in pages[:-1]:
+        await send_markdown(message.chat.id, page)
+    await send_markdown(message.chat.id, pages[-1], reply_markup=FULL_LIST_KEYBOARD)
+
+async def ask_object(chat_id, user_id):
+    user_data_entry = await user_data.get(user_id)
+    if not user_data_entry:
+        await show_list_selection(chat_id)
+        return
+
+    current_list = user_data_entry.current_list
+    current_object = user_data_entry.progress
+
+    if current_object < len(current_list['items']):
+        logger.debug("Asking user %s about item %s", user_id, current_object)
+        text, keyboard = render_item(user_data_entry, current_object)
+        await send_markdown(chat_id, text, reply_markup=keyboard)
+    else:
+        await finish_packing(chat_id, user_id)
+
+@bot.message_handler(func=lambda message: message.text == BUTTON_BUY)
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def handle_buy(message):
+    user_data_entry = await user_data.get(message.from_user.id)
+    if not user_data_entry:
+        await show_list_selection(message.chat.id)
+        return
+
+    current_list = user_data_entry.current_list
+    current_object = user_data_entry.progress
+
+    if current_object < len(current_list['items']):
+        item = current_list['items'][current_object]
+        if item['buy_link']:
+            await bot.send_message(message.chat.id, BUY_PROMPT.format(item['full_name']), reply_markup=get_buy_keyboard(item))
+        else:
+            await bot.send_message(message.chat.id, NO_BUY_LINK)
+    else:
+        await bot.send_message(message.chat.id, PACKING_FINISHED_MESSAGE)
+
+@bot.message_handler(func=lambda message: message.text in [BUTTON_TAKE, BUTTON_TAKE_LATER, BUTTON_SKIP])
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def handle_response(message):
+    user_id = message.from_user.id
+    response = get_status_code(message.text)
+
+    user_data_entry = await user_data.get(user_id)
+    if not user_data_entry:
+        await show_list_selection(message.chat.id)
+        return
+    if await is_stale(user_data_entry, message):
+        return
+
+    current_list = user_data_entry.current_list
+    current_object = user_data_entry.progress
+
+    if current_object < len(current_list['items']):
+        logger.debug("User %s responded %s to item %s", user_id, response, current_object)
+        user_data_entry.set_status(current_object, response)
+        user_data_entry.progress += 1
+        await user_data.save(user_id, user_data_entry)
+        await ask_object(message.chat.id, user_id)
+    else:
+        await finish_packing(message.chat.id, user_id)
+
+async def edit_packing_message(message, text, keyboard):
+    if not message_states.changed(message.chat.id, message.message_id, text, keyboard):
+        return
+    try:
+        await bot.edit_message_text(text, message.chat.id, message.message_id,
+                                    reply_markup=keyboard, parse_mode='Markdown')
+    except asyncio_helper.ApiTelegramException as api_error:
+        if "message is not modified" not in str(api_error).lower():
+            logger.error("Failed to edit message with Markdown. Editing without formatting. Error: %s", api_error)
+            await bot.edit_message_text(text, message.chat.id, message.message_id, reply_markup=keyboard)
+    message_states.remember(message.chat.id, message.message_id, text, keyboard)
+
+async def edit_packing_markup(message, text, keyboard):
+    # Текст страницы не меняется, обновляем только кнопки
+    if message_states.changed(message.chat.id, message.message_id, text, keyboard):
+        await bot.edit_message_reply_markup(message.chat.id, message.message_id, reply_markup=keyboard)
+        message_states.remember(message.chat.id, message.message_id, text, keyboard)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('pack_'))
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def handle_inline_response(call):
+    user_id = call.from_user.id
+    user_data_entry = await user_data.get(user_id)
+    if not user_data_entry:
+        await asyncio.gather(bot.answer_callback_query(call.id), show_list_selection(call.message.chat.id))
+        return
+    if await is_stale(user_data_entry, call):
+        return
+
+    items_count = len(user_data_entry.current_list['items'])
+    start = user_data_entry.progress
+    stop = min(start + core.PACKING_PAGE_SIZE, items_count)
+
+    toggled = False
+    if call.data == 'pack_next':
+        if user_data_entry.statuses.find(0, start, stop) != -1:
+            await bot.answer_callback_query(call.id, MARK_ALL_ITEMS)
+            return
+        user_data_entry.progress = stop
+    else:
+        _, index, code = call.data.split('_')
+        index, code = int(index), int(code)
+        if not start <= index < stop:
+            await bot.answer_callback_query(call.id, PACKING_STEP_OUTDATED)
+            return
+        user_data_entry.set_status(index, code or NEXT_STATUS[user_data_entry.statuses[index]])
+        toggled = not code
+        if core.PACKING_PAGE_SIZE == 1:
+            user_data_entry.progress += 1
+
+    await user_data.save(user_id, user_data_entry)
+    if toggled:
+        edit = edit_packing_markup(call.message, *render_packing_step(user_data_entry))
+    elif user_data_entry.progress < items_count:
+        edit = edit_packing_message(call.message, *render_packing_step(user_data_entry))
+    else:
+        logger.info("Finishing inline packing for user %s", user_id)
+        edit = edit_packing_message(call.message, format_results(user_data_entry), FINAL_KEYBOARD)
+    await asyncio.gather(bot.answer_callback_query(call.id), edit)
+
+async def finish_packing(chat_id, user_id):
+    logger.info("Finishing packing for user %s", user_id)
+    user_data_entry = await user_data.get(user_id)
+    if not user_data_entry:
+        await show_list_selection(chat_id)
+        return
+
+    # Порядок сообщений в чате виден пользователю, поэтому отправляем их последовательно
+    await bot.send_message(chat_id, PACKING_FINISHED_MESSAGE, reply_markup=ReplyKeyboardRemove())
+    await show_lists(chat_id, user_id)
+    await bot.send_message(chat_id, WHAT_NEXT_MESSAGE, reply_markup=FINAL_KEYBOARD)
+
+async def show_lists(chat_id, user_id):
+    user_data_entry = await user_data.get(user_id)
+    if not user_data_entry:
+        await show_list_selection(chat_id)
+        return
+    await send_markdown(chat_id, format_results(user_data_entry))
+
+@bot.callback_query_handler(func=lambda call: call.data == "edit_list")
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def handle_edit_list(call):
+    logger.info("Received 'Редактировать список' callback from user %s", call.from_user.id)
+    try:
+        user_data_entry = await user_data.get(call.from_user.id)
+        if user_data_entry and user_data_entry.has_responses():
+            await edit_list(call.message)
+        else:
+            logger.warning("User %s has no saved responses.", call.from_user.id)
+            await asyncio.gather(bot.answer_callback_query(call.id, NO_SAVED_RESPONSES),
+                                 bot.send_message(call.message.chat.id, NO_SAVED_RESPONSES))
+    except Exception as e:
+        logger.exception("Error in handle_edit_list for user %s: %s", call.from_user.id, e)
+        metrics.count_handler_error('handle_edit_list')
+        await asyncio.gather(bot.answer_callback_query(call.id, GENERAL_ERROR),
+                             bot.send_message(call.message.chat.id, GENERAL_ERROR))
+
+async def edit_list(message):
+    try:
+        user_id = message.chat.id
+        user_data_entry = await user_data.get(user_id)
+        if not user_data_entry:
+            await show_list_selection(message.chat.id)
+            return
+
+        if not user_data_entry.has_responses():
+            logger.info("No saved responses for user %s", user_id)
+            await bot.send_message(message.chat.id, NO_SAVED_RESPONSES)
+            return
+
+        keyboard = get_edit_list_keyboard(user_data_entry).to_json()
+        if not message_states.changed(message.chat.id, message.message_id, CHOOSE_ITEM_TO_EDIT, keyboard):
+            return
+        try:
+            await bot.edit_message_text(CHOOSE_ITEM_TO_EDIT,
+                                        message.chat.id,
+                                        message.message_id,
+                                        reply_markup=keyboard)
+        except asyncio_helper.ApiTelegramException as api_error:
+            # Сообщение уже показывает этот список: второе меню не отправляем
+            if "message is not modified" not in str(api_error).lower():
+                raise
+        message_states.remember(message.chat.id, message.message_id, CHOOSE_ITEM_TO_EDIT, keyboard)
+    except Exception as e:
+        logger.exception("Error in edit_list for user %s: %s", message.chat.id, e)
+        metrics.count_handler_error('edit_list')
+        await bot.send_message(message.chat.id, EDIT_LIST_ERROR)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('edit_'))
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def edit_item(call):
+    logger.info("Received edit callback from user %s", call.from_user.id)
+    try:
+        user_data_entry = await user_data.get(call.from_user.id)
+        if not user_data_entry:
+            await show_list_selection(call.message.chat.id)
+            return
+
+        item_hash = call.data.split('_', 1)[1]
+        callback_index = get_callback_index(user_data_entry)
+        item_index = callback_index.find_item(item_hash)
+
+        if item_index is None:
+            logger.error("Item not found for hash %s", item_hash)
+            await bot.answer_callback_query(call.id, GENERAL_ERROR)
+            return
+
+        message_text, keyboard = render_item_editor(user_data_entry, item_index, callback_index)
+        edit_debouncer.cancel((call.message.chat.id, call.message.message_id))
+        if message_states.changed(call.message.chat.id, call.message.message_id, message_text, keyboard):
+            await bot.edit_message_text(message_text,
+                                        call.message.chat.id,
+                                        call.message.message_id,
+                                        reply_markup=keyboard,
+                                        parse_mode='Markdown')
+            message_states.remember(call.message.chat.id, call.message.message_id, message_text, keyboard)
+    except Exception as e:
+        logger.exception("Error in edit_item for user %s: %s", call.from_user.id, e)
+        metrics.count_handler_error('edit_item')
+        await asyncio.gather(bot.answer_callback_query(call.id, GENERAL_ERROR),
+                             bot.send_message(call.message.chat.id, EDIT_ITEM_ERROR))
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('status_'))
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def set_status(call):
+    logger.info("Received status callback from user %s", call.from_user.id)
+    try:
+        user_id = call.from_user.id
+        user_data_entry = await user_data.get(user_id)
+        if not user_data_entry:
+            await show_list_selection(call.message.chat.id)
+            return
+        if await is_stale(user_data_entry, call):
+            return
+
+        status_hash = call.data.split('_', 1)[1]
+        item_index, chosen_status = get_callback_index(user_data_entry).find_status(status_hash)
+
+        if item_index is None or not chosen_status:
+            logger.error("Item or status not found for hash %s", status_hash)
+            await bot.answer_callback_query(call.id, GENERAL_ERROR)
+            return
+
+        if user_data_entry.set_status(item_index, get_status_code(chosen_status)):
+            await user_data.save(user_id, user_data_entry)
+
+        status_icon = get_status_icon(chosen_status)
+        await asyncio.gather(bot.answer_callback_query(call.id, f"{STATUS_UPDATED}: {status_icon}"),
+                             edit_debouncer.schedule((call.message.chat.id, call.message.message_id),
+                                                     lambda: edit_list(call.message)))
+    except Exception as e:
+        logger.exception("Error in set_status for user %s: %s", call.from_user.id, e)
+        metrics.count_handler_error('set_status')
+        await asyncio.gather(bot.answer_callback_query(call.id, GENERAL_ERROR),
+                             bot.send_message(call.message.chat.id, UPDATE_STATUS_ERROR))
+
+@bot.callback_query_handler(func=lambda call: call.data == "back_to_edit")
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def edit_list_callback(call):
+    edit_debouncer.cancel((call.message.chat.id, call.message.message_id))
+    await edit_list(call.message)
+
+@bot.callback_query_handler(func=lambda call: call.data == "back_to_final")
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def back_to_final(call):
+    logger.info("Returning to final menu for user %s", call.from_user.id)
+
+    async def send_final():
+        await show_lists(call.message.chat.id, call.from_user.id)
+        await bot.send_message(call.message.chat.id, WHAT_NEXT_MESSAGE, reply_markup=FINAL_KEYBOARD)
+
+    # Удаление старого меню не зависит от отправки новых сообщений
+    forget_message(call.message)
+    await asyncio.gather(send_final(),
+                         bot.delete_message(call.message.chat.id, call.message.message_id))
+
+@bot.callback_query_handler(func=lambda call: call.data == "restart_packing")
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def restart_packing(call):
+    logger.info("User %s requested to restart packing", call.from_user.id)
+    await reset_progress(call.from_user.id)
+    forget_message(call.message)
+    await asyncio.gather(bot.delete_message(call.message.chat.id, call.message.message_id),
+                         show_list_selection(call.message.chat.id))
+
+# Общий сбор в группе
+
+async def find_group(call):
+    group = group_data.get(call.message.chat.id)
+    if group is None or group.message_id != call.message.message_id:
+        await bot.answer_callback_query(call.id, GROUP_LIST_OUTDATED)
+        return None
+    return group
+
+async def refresh_group_summary(message):
+    group = group_data.get(message.chat.id)
+    if group is not None and group.message_id == message.message_id:
+        await edit_packing_message(message, *render_group_summary(group))
+
+@bot.message_handler(commands=[COMMAND_GROUP])
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def start_group(message):
+    logger.info("Group packing requested in chat %s", message.chat.id)
+    if not is_group_chat(message.chat):
+        await bot.send_message(message.chat.id, GROUP_ONLY)
+        return
+    await bot.send_message(message.chat.id, CHOOSE_HIKE_TYPE, reply_markup=render_group_list_selection())
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('group_list_'))
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def handle_group_list_selection(call):
+    list_id = call.data.split('_', 2)[2]
+    snapshot = catalog.snapshot
+    selected_list = snapshot.get_list(list_id)
+    if not selected_list:
+        await bot.answer_callback_query(call.id, "Ошибка: список не найден")
+        return
+
+    group = GroupSession(selected_list, snapshot.version, call.message.message_id)
+    group_data.save(call.message.chat.id, group)
+    await asyncio.gather(bot.answer_callback_query(call.id, f"Вы выбрали: {selected_list['name']}"),
+                         edit_packing_message(call.message, *render_group_summary(group)))
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('group_item_'))
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def handle_group_item(call):
+    group = await find_group(call)
+    if group is None:
+        return
+    # group_item_<индекс>_<статус, который ставит кнопка>
+    index, status = map(int, call.data.split('_')[2:4])
+    if not 0 <= index < len(group) or status not in STATUS_ICONS:
+        await bot.answer_callback_query(call.id, GROUP_LIST_OUTDATED)
+        return
+
+    user = call.from_user
+    group.members[user.id] = user.first_name
+    if not group.merge(index, status, user.id, get_update_id(call)):
+        await bot.answer_callback_query(call.id)
+        return
+
+    item = group.current_list['items'][index]
+    await asyncio.gather(
+        bot.answer_callback_query(call.id, GROUP_ITEM_UPDATED.format(item['short_name'], STATUS_ICONS[status])),
+        edit_debouncer.schedule((call.message.chat.id, call.message.message_id),
+                                lambda: refresh_group_summary(call.message)))
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('group_page_'))
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def handle_group_page(call):
+    group = await find_group(call)
+    if group is None:
+        return
+    page = int(call.data.rsplit('_', 1)[1])
+    if 0 <= page * core.GROUP_PAGE_SIZE < len(group):
+        group.page = page
+    edit_debouncer.cancel((call.message.chat.id, call.message.message_id))
+    await asyncio.gather(bot.answer_callback_query(call.id), refresh_group_summary(call.message))
+
+# Напоминания отправляет пул потоков ReminderEngine через синхронный клиент без своих потоков:
+# его вызовы проходят через тот же SendScheduler и уступают ответам хендлеров
+reminder_bot = telebot.TeleBot(core.TOKEN, threaded=False)
+
+def send_reminder_markdown(chat_id, text):
+    try:
+        reminder_bot.send_message(chat_id, text, parse_mode='Markdown')
+    except telebot.apihelper.ApiException as e:
+        logger.error("Failed to send reminder with Markdown. Sending without formatting. Error: %s", e)
+        reminder_bot.send_message(chat_id, text)
+
+reminder_engine = core.create_reminder_engine(user_data.store, send_scheduler, send_reminder_markdown)
+
+@bot.message_handler(commands=[COMMAND_REMIND])
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def remind(message):
+    user_id = message.from_user.id
+    user_data_entry = await user_data.get(user_id)
+    if not user_data_entry or STATUS_TAKE_LATER not in user_data_entry.statuses:
+        await bot.send_message(message.chat.id, REMIND_NOTHING)
+        return
+
+    departure = parse_departure(util.extract_arguments(message.text) or '')
+    if departure is None:
+        await bot.send_message(message.chat.id, REMIND_USAGE)
+        return
+    if departure <= time.time():
+        await bot.send_message(message.chat.id, REMIND_IN_PAST)
+        return
+
+    logger.info("User %s scheduled reminders before %s", user_id, departure)
+    if await asyncio.to_thread(reminder_engine.schedule, user_id, message.chat.id, departure, REMINDER_LEADS):
+        await bot.send_message(message.chat.id,
+                               REMIND_SET.format(datetime.fromtimestamp(departure).strftime('%d.%m.%Y %H:%M')))
+    else:
+        await send_markdown(message.chat.id, format_reminder(user_data_entry))
+
+# Поиск по каталогу
+
+@bot.message_handler(commands=[COMMAND_SEARCH])
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def search(message):
+    query = normalize_query(util.extract_arguments(message.text))
+    if not query:
+        await bot.send_message(message.chat.id, SEARCH_USAGE)
+        return
+    snapshot = catalog.snapshot
+    item_ids = search_items(snapshot, query)
+    if not item_ids:
+        await bot.send_message(message.chat.id, SEARCH_NOTHING_FOUND.format(query))
+        return
+    text, keyboard = render_search_page(snapshot, query, item_ids, 0)
+    await send_markdown(message.chat.id, text, reply_markup=keyboard)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('search_'))
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def handle_search_page(call):
+    _, key, page = call.data.split('_')
+    query = search_queries.get(key)
+    snapshot = catalog.snapshot
+    item_ids = search_items(snapshot, query) if query else []
+    page = int(page)
+    if not 0 <= page * core.SEARCH_PAGE_SIZE < len(item_ids):
+        await bot.answer_callback_query(call.id, SEARCH_OUTDATED)
+        return
+    await asyncio.gather(bot.answer_callback_query(call.id),
+                         edit_packing_message(call.message, *render_search_page(snapshot, query, item_ids, page)))
+
+# У inline-запроса нет чата, поэтому он обрабатывается без chat_ordered
+@bot.inline_handler(func=lambda inline_query: True)
+@log_handled(logger)
+@track_handler
+async def inline_search(inline_query):
+    query = normalize_query(inline_query.query)
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    snapshot = catalog.snapshot
+    item_ids = search_items(snapshot, query) if query else []
+    stop = offset + core.INLINE_PAGE_SIZE
+    await bot.answer_inline_query(inline_query.id,
+                                  [render_inline_result(snapshot, item_id) for item_id in item_ids[offset:stop]],
+                                  cache_time=core.INLINE_CACHE_TIME,
+                                  next_offset=str(stop) if stop < len(item_ids) else '')
+
+@bot.message_handler(func=lambda message: True)
+@chat_ordered
+@log_handled(logger)
+@track_handler
+async def echo_all(message):
+    await bot.reply_to(message, UNKNOWN_COMMAND)
+
+# Метрики состояния, читаются при запросе /metrics
+if core.METRICS_ENABLED:
+    core.register_gauges(user_data, seen_updates, reminder_engine, send_scheduler, edit_debouncer)
+
+async def set_commands():
+    commands = core.get_bot_commands()
+    digest = startup.commands_digest(core.TOKEN, commands)
+    if startup.commands_unchanged(core.COMMANDS_STAMP_PATH, digest):
+        logger.info("Bot commands unchanged, skipping set_my_commands")
+        return
+    try:
+        if not startup.same_commands(await bot.get_my_commands(), commands):
+            await bot.set_my_commands(commands)
+        startup.remember_commands(core.COMMANDS_STAMP_PATH, digest)
+    except Exception as e:
+        logger.error("Failed to set bot commands: %s", e)
+
+# Цикл событий хранит только слабые ссылки на задачи: держим фоновые задачи здесь, пока они не завершатся
+background_tasks = set()
+
+def run_in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def main():
+    # Меню команд синхронизируется в фоне, не задерживая первый апдейт
+    run_in_background(set_commands())
+    if core.METRICS_ENABLED:
+        metrics.start_metrics_server(core.METRICS_HOST, core.METRICS_PORT, ready=startup.timer.is_ready,
+                                     report=startup.timer.report)
+    catalog.start_watching()
+    reminder_engine.start()
+    core.warm_caches()
+    startup.timer.mark('warmup')
+    startup.watch_first_update(bot)
+    startup.timer.set_ready()
+    core.build_search_index()
+    catalog.add_listener(core.build_search_index)
+    logger.info("Async bot started")
+    try:
+        await bot.infinity_polling()
+    finally:
+        if asyncio_helper.session_manager.session:
+            await asyncio_helper.session_manager.session.close()
+        reminder_engine.stop()
+        user_data.close()
+        seen_updates.close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
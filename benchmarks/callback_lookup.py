@@ -0,0 +1,45 @@
+"""Сравнение линейного поиска callback-хешей с таблицами CallbackIndex.
+
+Запуск: python benchmarks/callback_lookup.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from catalog import CallbackIndex, STATUSES, generate_short_callback
+
+
+def make_list(size):
+    return {
+        'id': f'bench_{size}',
+        'items': [{'short_name': f'Item {i}', 'full_name': f'Item number {i}',
+                   'description': '', 'buy_link': ''} for i in range(size)],
+    }
+
+
+def linear_find_status(hiking_list, status_hash):
+    for item in hiking_list['items']:
+        for status in STATUSES:
+            if generate_short_callback("status", f"{item['full_name']}_{status}").split('_')[1] == status_hash:
+                return item, status
+    return None, None
+
+
+def main(sizes=(10, 100, 1000), repeat=200):
+    print(f"{'items':>6} {'linear, us':>12} {'indexed, us':>12} {'speedup':>9}")
+    for size in sizes:
+        hiking_list = make_list(size)
+        index = CallbackIndex(hiking_list)
+        # Худший случай для линейного поиска — последний предмет
+        last = hiking_list['items'][-1]['full_name']
+        status_hash = generate_short_callback("status", f"{last}_{STATUSES[-1]}").split('_')[1]
+
+        linear = min(timeit.repeat(lambda: linear_find_status(hiking_list, status_hash), number=repeat, repeat=3)) / repeat
+        indexed = min(timeit.repeat(lambda: index.find_status(status_hash), number=repeat, repeat=3)) / repeat
+        print(f"{size:>6} {linear * 1e6:>12.1f} {indexed * 1e6:>12.3f} {linear / indexed:>8.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Загрузка каталога: hiking_items.json против скомпилированного файла с ленивыми предметами.
+
+Для синтетических каталогов разного размера печатает время загрузки снимка,
+прирост памяти после загрузки и время доступа к одному предмету.
+
+Запуск: python benchmarks/catalog_load.py
+"""
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from catalog import Catalog, compile_catalog
+from load_test import make_catalog
+
+
+def measure_load(path):
+    # Время и память меряем отдельными загрузками: tracemalloc сильно замедляет разбор
+    catalog = Catalog(path)
+    started = time.perf_counter()
+    catalog.load(force=True)
+    elapsed = time.perf_counter() - started
+    tracemalloc.start()
+    traced = Catalog(path)
+    traced.load(force=True)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del traced
+    return catalog, elapsed, memory
+
+
+def measure_item_access(catalog, count=10000):
+    lists = catalog.snapshot.lists
+    started = time.perf_counter()
+    for step in range(count):
+        items = lists[step % len(lists)]['items']
+        items[step % len(items)]
+    return (time.perf_counter() - started) / count
+
+
+def main(sizes=((100, 50), (1000, 100), (3000, 200))):
+    print(f"{'lists x items':>14} {'format':>9} {'load, ms':>9} {'memory, MB':>11} {'item, us':>9}")
+    for lists, items in sizes:
+        source = make_catalog(lists, items)
+        target = os.path.join(tempfile.mkdtemp(), 'catalog.cat')
+        compile_catalog(source, target)
+        for name, path in (('json', source), ('compiled', target)):
+            catalog, elapsed, memory = measure_load(path)
+            access = measure_item_access(catalog)
+            print(f"{f'{lists} x {items}':>14} {name:>9} {elapsed * 1000:>9.1f} "
+                  f"{memory / 2 ** 20:>11.1f} {access * 1e6:>9.2f}")
+        os.remove(source)
+        os.remove(target)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""Локальная замена Bot API для нагрузочных тестов.
+
+Принимает getUpdates/sendMessage/editMessageText/answerCallbackQuery и другие методы,
+добавляет задержку и отвечает 429 с заданной вероятностью. Последний ответ бота
+в каждом чате сохраняется, чтобы виртуальные пользователи могли нажимать его кнопки.
+
+Отдельный запуск: python benchmarks/fake_telegram.py --port 8081 --latency 0.05
+"""
+import json
+import time
+import queue
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+MESSAGE_METHODS = {'sendMessage', 'editMessageText', 'editMessageReplyMarkup'}
+
+
+class FakeTelegram:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, retry_after=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.errors = Counter()
+        self.updates = queue.Queue()
+        self._message_ids = Counter()
+        self._last_markup = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/bot{{0}}/{{1}}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-telegram', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def last_markup(self, chat_id):
+        """Last reply_markup the bot sent or edited in the chat, as a dict."""
+        return self._last_markup.get(chat_id)
+
+    def last_message_id(self, chat_id):
+        return self._message_ids[chat_id]
+
+    def push_update(self, update):
+        self.updates.put(update)
+
+    def _get_updates(self, params):
+        timeout = float(params.get('timeout') or 0)
+        updates = []
+        try:
+            updates.append(self.updates.get(timeout=timeout) if timeout else self.updates.get_nowait())
+            while len(updates) < int(params.get('limit') or 100):
+                updates.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        return updates
+
+    def _call(self, method, params):
+        self.calls[method] += 1
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self._get_updates(params)}
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors[method] += 1
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f'Too Many Requests: retry after {self.retry_after}',
+                         'parameters': {'retry_after': self.retry_after}}
+
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'fake', 'username': 'fake_bot'}}
+        if method == 'getMyCommands':
+            return 200, {'ok': True, 'result': []}
+        if method not in MESSAGE_METHODS:
+            return 200, {'ok': True, 'result': True}
+
+        chat_id = int(params['chat_id'])
+        with self._lock:
+            if method == 'sendMessage':
+                self._message_ids[chat_id] += 1
+            message_id = int(params.get('message_id') or self._message_ids[chat_id])
+            markup = params.get('reply_markup')
+            if markup:
+                self._last_markup[chat_id] = json.loads(markup)
+        return 200, {'ok': True, 'result': {
+            'message_id': message_id, 'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'text': params.get('text', ''),
+        }}
+
+    def _make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                url = urlsplit(self.path)
+                method = url.path.rsplit('/', 1)[-1]
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length)
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(parse_qsl(body.decode()))
+                status, payload = fake._call(method, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeTelegram(args.host, args.port, args.latency, args.jitter, args.error_rate)
+    print(f"TELEGRAM_API_URL={fake.api_url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""Нагрузочный тест хендлеров bot.py против локального фейкового Bot API.
+
+Каждый виртуальный пользователь проходит весь сценарий:
+/start -> select_list_ -> «Собраться в поход» -> ответ на каждый предмет
+(текстом или inline-кнопками, см. --packing-mode) ->
+edit_list -> edit_ -> status_ -> back_to_final.
+Шаги разных пользователей перемешиваются в общем пуле потоков, шаги одного
+пользователя идут по порядку. С --rate-limit пользователь делает следующий шаг,
+только когда ограничитель отправил все отложенные ответы его чату: иначе он видит
+старые кнопки. В конце печатаются пропускная способность и p50/p95/p99 задержки хендлеров.
+
+Запуск: python benchmarks/load_test.py --users 2000 --concurrency 64 --latency 0.02
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import itertools
+import logging
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegram
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def make_catalog(lists, items):
+    """Synthetic catalog with the given number of lists and items per list."""
+    data = {'lists': [{
+        'id': f'list_{list_index}',
+        'name': f'Поход {list_index}',
+        'description': 'Синтетический список для нагрузочного теста',
+        'items': [{
+            'short_name': f'Предмет {item_index}',
+            'full_name': f'Предмет {item_index} списка {list_index}',
+            'description': f'Описание предмета {item_index}',
+            'buy_link': 'https://example.com' if item_index % 2 else '',
+        } for item_index in range(items)],
+    } for list_index in range(lists)]}
+    file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False, encoding='utf-8')
+    json.dump(data, file, ensure_ascii=False)
+    file.close()
+    return file.name
+
+
+# Один счётчик на всех: диапазоны пользователей не пересекаются при любой длине сценария,
+# и фильтр повторов не отбрасывает чужие апдейты
+_update_ids = itertools.count(1)
+
+
+class VirtualUser:
+    def __init__(self, user_id, fake, messages):
+        self.user_id = user_id
+        self.fake = fake
+        self.messages = messages
+        self._update_id = 0
+
+    def _base(self):
+        self._update_id = next(_update_ids)
+        return self._update_id, {'id': self.user_id, 'is_bot': False, 'first_name': f'user{self.user_id}'}
+
+    def text(self, text):
+        update_id, user = self._base()
+        message = {'message_id': self._update_id, 'date': int(time.time()), 'text': text,
+                   'chat': {'id': self.user_id, 'type': 'private'}, 'from': user}
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return {'update_id': update_id, 'message': message}
+
+    def callback(self, data):
+        update_id, user = self._base()
+        message = {'message_id': self.fake.last_message_id(self.user_id), 'date': int(time.time()),
+                   'chat': {'id': self.user_id, 'type': 'private'}}
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'chat_instance': str(self.user_id), 'data': data, 'from': user, 'message': message}}
+
+    def inline_buttons(self, prefix):
+        markup = self.fake.last_markup(self.user_id) or {}
+        return [button['callback_data'] for row in markup.get('inline_keyboard', [])
+                for button in row if button.get('callback_data', '').startswith(prefix)]
+
+    def steps(self):
+        """Yield (step name, update); the next step is built after the previous one was handled."""
+        messages = self.messages
+        yield 'start', self.text('/start')
+        yield 'select_list', self.callback(random.choice(self.inline_buttons('select_list_')))
+        yield 'pack', self.text(messages.BUTTON_PACK)
+        answers = (messages.BUTTON_TAKE, messages.BUTTON_TAKE_LATER, messages.BUTTON_SKIP)
+        while not self.inline_buttons('edit_list'):
+            buttons = self.inline_buttons('pack_')
+            if 'pack_next' in buttons:
+                # Страница inline-режима: отмечаем каждый предмет и листаем дальше
+                for data in buttons[:-1]:
+                    yield 'toggle', self.callback(data)
+                yield 'next_page', self.callback('pack_next')
+            elif buttons:
+                yield 'response', self.callback(random.choice(buttons))
+            else:
+                yield 'response', self.text(random.choice(answers))
+        yield 'edit_list', self.callback('edit_list')
+        yield 'edit_item', self.callback(random.choice(self.inline_buttons('edit_')))
+        yield 'set_status', self.callback(random.choice(self.inline_buttons('status_')))
+        yield 'back_to_final', self.callback('back_to_final')
+
+
+def run(users, concurrency, fake, bot_module, messages, send_scheduler=None):
+    from telebot.types import Update
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    ready = queue.Queue()
+    for user_id in range(1, users + 1):
+        ready.put((user_id, VirtualUser(user_id, fake, messages).steps()))
+    remaining = [users]
+    done = threading.Event()
+
+    def worker():
+        while not done.is_set():
+            try:
+                user_id, steps = ready.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if send_scheduler is not None and send_scheduler.has_pending(user_id):
+                # Ответ на прошлый шаг ещё в очереди ограничителя: пользователь ждёт его
+                ready.put((user_id, steps))
+                time.sleep(0.005)
+                continue
+            try:
+                name, payload = next(steps)
+            except StopIteration:
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        done.set()
+                continue
+            except Exception:
+                # Бот не прислал ожидаемые кнопки — сценарий пользователя прерван
+                with lock:
+                    errors['scenario'] += 1
+                    remaining[0] -= 1
+                    if remaining[0] == 0:
+                        done.set()
+                continue
+            update = Update.de_json(payload)
+            started = time.perf_counter()
+            try:
+                bot_module.process_update(update)
+            except Exception:
+                with lock:
+                    errors[name] += 1
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies[name].append(elapsed)
+            ready.put((user_id, steps))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    done.wait()
+    wall = time.perf_counter() - started
+    for thread in threads:
+        thread.join()
+    return latencies, errors, wall
+
+
+def report(latencies, errors, wall, fake):
+    total = sum(len(values) for values in latencies.values())
+    everything = [value for values in latencies.values() for value in values]
+    print(f"updates: {total}, wall: {wall:.2f} s, throughput: {total / wall:.1f} updates/s")
+    print(f"{'handler':<14} {'count':>7} {'p50, ms':>9} {'p95, ms':>9} {'p99, ms':>9} {'errors':>7}")
+    for name, values in sorted(latencies.items()) + [('all', everything)]:
+        print(f"{name:<14} {len(values):>7} {percentile(values, 0.50) * 1000:>9.2f} "
+              f"{percentile(values, 0.95) * 1000:>9.2f} {percentile(values, 0.99) * 1000:>9.2f} "
+              f"{errors.get(name, 0) if name != 'all' else sum(errors.values()):>7}")
+    if errors.get('scenario'):
+        print(f"aborted scenarios: {errors['scenario']}")
+    print(f"API calls: {dict(fake.calls)}")
+    if fake.errors:
+        print(f"injected 429: {dict(fake.errors)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.0, help='fake API latency, seconds')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API calls answered with 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--lists', type=int, default=0, help='use a synthetic catalog with this many lists')
+    parser.add_argument('--items', type=int, default=20, help='items per list in the synthetic catalog')
+    parser.add_argument('--rate-limit', action='store_true', help='send through the outbound rate limiter')
+    parser.add_argument('--session-backend', default='memory')
+    parser.add_argument('--packing-mode', default='reply', choices=('reply', 'inline'))
+    parser.add_argument('--page-size', type=int, default=1, help='items per page in the inline packing mode')
+    args = parser.parse_args()
+
+    fake = FakeTelegram(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                        retry_after=args.retry_after).start()
+
+    os.environ.setdefault('BOT_TOKEN', '123456:load-test')
+    os.environ['TELEGRAM_API_URL'] = fake.api_url
+    # Без пула потоков telebot хендлер выполняется в вызывающем потоке, и задержка измеряется целиком
+    os.environ['BOT_MODE'] = 'webhook'
+    os.environ['RATE_LIMIT_ENABLED'] = '1' if args.rate_limit else '0'
+    os.environ['SESSION_BACKEND'] = args.session_backend
+    os.environ['PACKING_MODE'] = args.packing_mode
+    os.environ['PACKING_PAGE_SIZE'] = str(args.page_size)
+    os.environ['CATALOG_PATH'] = (make_catalog(args.lists, args.items) if args.lists
+                                  else os.path.join(ROOT, 'hiking_items.json'))
+    if args.session_backend == 'sqlite':
+        os.environ['SESSION_DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'sessions.db')
+
+    import bot as bot_module
+    import messages
+    logging.disable(logging.WARNING)
+
+    try:
+        latencies, errors, wall = run(args.users, args.concurrency, fake, bot_module, messages,
+                                      bot_module.send_scheduler if args.rate_limit else None)
+        report(latencies, errors, wall, fake)
+    finally:
+        # Отложенные правки и отправки уходят до остановки фейкового API
+        bot_module.edit_debouncer.flush()
+        bot_module.send_scheduler.drain(timeout=30)
+        bot_module.user_data.close()
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Пропускная способность рассылки напоминаний против локального фейкового Bot API.
+
+Пробный прогон без Telegram: создаёт сессии с вещами «Позже», кладёт в очередь
+по одному напоминанию на пользователя со сроком «сейчас» и ждёт, пока ReminderEngine
+из bot.py всё отправит через ограничитель исходящих запросов. Печатает время
+заполнения очереди, время рассылки и число отправок в секунду.
+
+Запуск: python benchmarks/reminder_send.py --reminders 20000 --rate 1000 --latency 0.02
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_telegram import FakeTelegram
+from load_test import make_catalog
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--reminders', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=1000.0, help='global rate limit, calls per second')
+    parser.add_argument('--latency', type=float, default=0.0, help='fake API latency, seconds')
+    parser.add_argument('--items', type=int, default=20, help='items per list, every third is "take later"')
+    parser.add_argument('--session-backend', default='memory')
+    args = parser.parse_args()
+
+    fake = FakeTelegram(latency=args.latency).start()
+
+    os.environ.setdefault('BOT_TOKEN', '123456:reminders')
+    os.environ['TELEGRAM_API_URL'] = fake.api_url
+    os.environ['BOT_MODE'] = 'webhook'
+    os.environ['RATE_LIMIT_ENABLED'] = '1'
+    os.environ['RATE_LIMIT_GLOBAL'] = str(args.rate)
+    os.environ['REMINDER_WORKERS'] = str(args.workers)
+    os.environ['REMINDER_BATCH_SIZE'] = str(args.batch_size)
+    os.environ['SESSION_BACKEND'] = args.session_backend
+    os.environ['SESSION_CACHE_SIZE'] = str(args.reminders)
+    os.environ['CATALOG_PATH'] = make_catalog(1, args.items)
+    if args.session_backend == 'sqlite':
+        os.environ['SESSION_DB_PATH'] = os.path.join(tempfile.mkdtemp(), 'sessions.db')
+
+    import bot as bot_module
+    from sessions import Session, STATUS_TAKE, STATUS_TAKE_LATER
+    logging.disable(logging.WARNING)
+
+    snapshot = bot_module.catalog.snapshot
+    hiking_list = snapshot.lists[0]
+    statuses = bytes(STATUS_TAKE_LATER if index % 3 == 0 else STATUS_TAKE for index in range(args.items))
+    engine = bot_module.reminder_engine
+
+    started = time.perf_counter()
+    due_at = time.time()
+    for user_id in range(1, args.reminders + 1):
+        bot_module.user_data.save(user_id, Session(hiking_list, snapshot.version, args.items, statuses))
+        engine.queue.add(due_at, user_id, user_id)
+    filled = time.perf_counter() - started
+
+    try:
+        started = time.perf_counter()
+        engine.start()
+        while sum(engine.stats.values()) < args.reminders:
+            time.sleep(0.05)
+        wall = time.perf_counter() - started
+    finally:
+        engine.stop()
+        bot_module.user_data.close()
+        fake.stop()
+
+    print(f"reminders: {args.reminders}, queue fill: {filled:.2f} s, send: {wall:.2f} s, "
+          f"throughput: {args.reminders / wall:.1f} reminders/s (limit {args.rate:g}/s)")
+    print(f"outcomes: {engine.stats}")
+    print(f"rate limiter: {bot_module.send_scheduler.metrics()}")
+    print(f"API calls: {dict(fake.calls)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Память на одну сессию: прежний dict с ответами по full_name против Session.
+
+Запуск: python benchmarks/session_memory.py
+"""
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from messages import BUTTON_TAKE, BUTTON_TAKE_LATER, BUTTON_SKIP
+from sessions import Session, STATUS_TAKE, STATUS_TAKE_LATER, STATUS_SKIP
+
+LABELS = (BUTTON_TAKE.lower(), BUTTON_TAKE_LATER.lower(), BUTTON_SKIP.lower())
+CODES = (STATUS_TAKE, STATUS_TAKE_LATER, STATUS_SKIP)
+
+
+def make_list(size):
+    return {
+        'id': f'bench_{size}',
+        'items': [{'short_name': f'Предмет {i}', 'full_name': f'Полное название предмета {i}',
+                   'description': '', 'buy_link': ''} for i in range(size)],
+    }
+
+
+def dict_session(hiking_list):
+    # Строки статусов в прежнем формате приходили из message.text.lower() — у каждого ответа своя копия
+    return {
+        'current_list': hiking_list,
+        'progress': len(hiking_list['items']),
+        'responses': {item['full_name']: ''.join(LABELS[i % 3]) for i, item in enumerate(hiking_list['items'])},
+    }
+
+
+def slotted_session(hiking_list):
+    session = Session(hiking_list, 1, progress=len(hiking_list['items']))
+    for index in range(len(hiking_list['items'])):
+        session.set_status(index, CODES[index % 3])
+    return session
+
+
+def measure(factory, hiking_list, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = [factory(hiking_list) for _ in range(count)]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del sessions
+    return (after - before) / count
+
+
+def main(sizes=(10, 100, 1000), count=2000):
+    print(f"{'items':>6} {'dict, B/session':>16} {'Session, B/session':>19} {'ratio':>7}")
+    for size in sizes:
+        hiking_list = make_list(size)
+        old = measure(dict_session, hiking_list, count)
+        new = measure(slotted_session, hiking_list, count)
+        print(f"{size:>6} {old:>16.0f} {new:>19.0f} {old / new:>6.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,148 +1,182 @@
 import os
+import startup
 import telebot
-from telebot.types import ReplyKeyboardMarkup, KeyboardButton, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
+from telebot.types import ReplyKeyboardRemove, CallbackQuery
 import logging
 import time
-import traceback
-import hashlib
-import re
-import json
+import threading
+from datetime import datetime
 from messages import *
-
-# Расширенное логирование
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+from groups import GroupSession
+from sessions import Session, get_status_code, STATUS_ICONS, STATUS_TAKE_LATER, NEXT_STATUS
+from render import Debouncer
+from logs import setup_logging, log_handled
+from dedupe import skip_duplicates, get_update_id
+import metrics
+from metrics import track_handler
+from core import (TOKEN, TELEGRAM_API_URL, RATE_LIMIT_ENABLED, METRICS_ENABLED, METRICS_HOST, METRICS_PORT,
+                  PACKING_MODE, PACKING_PAGE_SIZE, GROUP_PAGE_SIZE, SEARCH_PAGE_SIZE, INLINE_PAGE_SIZE, INLINE_CACHE_TIME,
+                  EDIT_DEBOUNCE, REMINDER_LEADS, COMMANDS_STAMP_PATH,
+                  catalog, group_data, message_states, search_queries,
+                  create_send_scheduler, open_update_deduplicator, open_session_store, create_reminder_engine,
+                  register_gauges, is_stale_update, get_callback_index, get_status_icon, get_buy_keyboard,
+                  get_edit_list_keyboard, format_results, START_KEYBOARD, PACK_KEYBOARD, FINAL_KEYBOARD, FULL_LIST_KEYBOARD,
+                  render_list_selection, render_list_selected, render_full_list, render_item, render_item_editor,
+                  render_packing_step, is_group_chat, render_group_list_selection, render_group_summary,
+                  parse_departure, format_reminder, normalize_query, search_items, render_search_page,
+                  render_inline_result, warm_caches, build_search_index, get_bot_commands)
+
+# Структурированные логи через очередь: уровень, формат и сэмплирование задаются LOG_* переменными
+setup_logging()
 logger = logging.getLogger(__name__)
+startup.timer.mark('imports')
 
-# Получение токена
-TOKEN = os.environ.get('BOT_TOKEN')
-if TOKEN is None:
-    raise ValueError("Произошла ошибка: переменная окружения BOT_TOKEN не может быть 'None'")
+# Локальный адрес API, например фейковый сервер Telegram для тестов
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
 
-bot = telebot.TeleBot(TOKEN)
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', os.environ.get('PORT', '8443')))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '8'))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '1000'))
 
-# Чтение файла
+# Ограничение исходящих запросов под лимиты Telegram
+send_scheduler = create_send_scheduler()
+if RATE_LIMIT_ENABLED:
+    send_scheduler.install()
 
-user_progress = {}
-user_responses = {}
-user_data = {}
+# Метрики в формате Prometheus на отдельном локальном порту
+if METRICS_ENABLED:
+    metrics.instrument_requests()
 
-def reset_progress(user_id):
-    user_data.pop(user_id, None)
+# В режиме webhook порядок и параллельность обеспечивает UpdateDispatcher, а не пул telebot
+bot = telebot.TeleBot(TOKEN, threaded=BOT_MODE != 'webhook')
 
-# Работа со списком
+# Повторно доставленные апдейты (перезапуск polling, повтор webhook) отбрасываются по update_id.
+# С DEDUPE_PATH кольцо последних id переживает перезапуск процесса.
+seen_updates = open_update_deduplicator()
+skip_duplicates(bot, seen_updates)
 
-def read_lists():
-    try:
-        with open('hiking_items.json', 'r', encoding='utf-8') as file:
-            data = json.load(file)
-            return data['lists']
-    except FileNotFoundError:
-        logger.error(FILE_NOT_FOUND_ERROR)
-        return []
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e}")
-        return []
-    except Exception as e:
-        logger.error(FILE_READ_ERROR.format(e))
-        return []
-
-# Функции создания клавиатур
-
-def get_start_keyboard():
-    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
-    keyboard.add(KeyboardButton(BUTTON_PACK), KeyboardButton(BUTTON_SHOW_LIST))
-    return keyboard
-
-def get_pack_keyboard():
-    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
-    keyboard.add(KeyboardButton(BUTTON_TAKE), KeyboardButton(BUTTON_TAKE_LATER), KeyboardButton(BUTTON_SKIP))
-    return keyboard
-
-def get_final_keyboard():
-    keyboard = InlineKeyboardMarkup()
-    keyboard.row(InlineKeyboardButton(BUTTON_EDIT_LIST, callback_data="edit_list"))
-    keyboard.row(InlineKeyboardButton(BUTTON_RESTART_PACKING, callback_data="restart_packing"))
-    return keyboard
-
-def get_status_icon(status):
-    if status.lower() == BUTTON_TAKE.lower():
-        return "✅"  
-    elif status.lower() == BUTTON_SKIP.lower():
-        return "❌"  
-    elif status.lower() == BUTTON_TAKE_LATER.lower():
-        return "⏳"  
-    else:
-        return "❓"  
+# Каталог и хранилища сессий
+
+catalog.load()
+startup.timer.mark('catalog')
+
+user_data = open_session_store()
+startup.timer.mark('sessions')
+
+def reset_progress(user_id):
+    user_data.delete(user_id)
+    reminder_engine.cancel(user_id)
+
+def is_stale(user_data_entry, event):
+    """is_stale_update() that also answers a dropped callback query."""
+    if not is_stale_update(user_data_entry, event, seen_updates):
+        return False
+    if isinstance(event, CallbackQuery):
+        # Без ответа клиент показывает индикатор загрузки на кнопке до таймаута
+        bot.answer_callback_query(event.id)
+    return True
+
+# Правки сообщений: правка без изменений пропускается, быстрые нажатия сливаются в одну правку
+edit_debouncer = Debouncer(EDIT_DEBOUNCE)
+
+def forget_message(message):
+    """Drop the pending edit and stored content of a message that is being deleted or replaced."""
+    edit_debouncer.cancel((message.chat.id, message.message_id))
+    message_states.forget(message.chat.id, message.message_id)
 
 # Хендлеры сообщений
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('select_list_'))
+@log_handled(logger)
+@track_handler
 def handle_list_selection(call):
-    list_id = call.data.split('_')[2]
+    list_id = call.data.split('_', 2)[2]
     user_id = call.from_user.id
     
-    lists = read_lists()
-    selected_list = next((l for l in lists if l['id'] == list_id), None)
+    current_entry = user_data.get(user_id)
+    if current_entry and is_stale(current_entry, call):
+        return
+
+    snapshot = catalog.snapshot
+    selected_list = snapshot.get_list(list_id)
     
     if selected_list:
-        user_data[user_id] = {
-            'current_list': selected_list,
-            'progress': 0,
-            'responses': {}
-        }
+        # Сессия держит ссылку на список из снимка, поэтому перезагрузка каталога её не затрагивает
+        user_data.save(user_id, Session(selected_list, snapshot.version, version=get_update_id(call) or 0))
         bot.answer_callback_query(call.id, f"Вы выбрали: {selected_list['name']}")
-        bot.edit_message_text(f"Вы выбрали: {selected_list['name']}\n\n{selected_list['description']}\n\nНачнем сбор снаряжения?",
+        bot.edit_message_text(render_list_selected(snapshot, selected_list),
                               call.message.chat.id,
-                              call.message.message_id,
-                              reply_markup=get_start_keyboard())
+                              call.message.message_id)
+        # Обычную клавиатуру нельзя прикрепить при редактировании, поэтому отправляем её отдельно
+        bot.send_message(call.message.chat.id, START_MESSAGE, reply_markup=START_KEYBOARD)
     else:
         bot.answer_callback_query(call.id, "Ошибка: список не найден")
 
 def show_list_selection(chat_id):
-    lists = read_lists()
-    keyboard = InlineKeyboardMarkup()
-    for hiking_list in lists:
-        callback_data = f"select_list_{hiking_list['id']}"
-        keyboard.add(InlineKeyboardButton(hiking_list['name'], callback_data=callback_data))
-    
-    bot.send_message(chat_id, "Выберите тип похода:", reply_markup=keyboard)
+    bot.send_message(chat_id, CHOOSE_HIKE_TYPE, reply_markup=render_list_selection())
+
+def send_markdown(chat_id, text, **kwargs):
+    try:
+        bot.send_message(chat_id, text, parse_mode='Markdown', **kwargs)
+    except telebot.apihelper.ApiException as e:
+        logger.error("Failed to send message with Markdown. Sending without formatting. Error: %s", e)
+        bot.send_message(chat_id, text, **kwargs)
 
 @bot.message_handler(commands=[COMMAND_START, COMMAND_RESET])
+@log_handled(logger)
+@track_handler
 def start(message):
-    logger.info(f"Received start/reset command from user {message.from_user.id}")
+    logger.info("Received start/reset command from user %s", message.from_user.id)
     user_id = message.from_user.id
     reset_progress(user_id)
     show_list_selection(message.chat.id)
 
 @bot.message_handler(func=lambda message: message.text == BUTTON_PACK)
+@log_handled(logger)
+@track_handler
 def pack(message):
-    logger.info(f"User {message.from_user.id} started packing")
+    logger.info("User %s started packing", message.from_user.id)
     user_id = message.from_user.id
-    reset_progress(user_id)
-    bot.send_message(message.chat.id, PACK_START_MESSAGE, reply_markup=get_pack_keyboard())
+    user_data_entry = user_data.get(user_id)
+    if not user_data_entry:
+        show_list_selection(message.chat.id)
+        return
+    if is_stale(user_data_entry, message):
+        return
+
+    # Сбрасываем прогресс, но оставляем выбранный список
+    user_data_entry = Session(user_data_entry.current_list, user_data_entry.catalog_version,
+                              version=user_data_entry.version)
+    user_data.save(user_id, user_data_entry)
+    if PACKING_MODE == 'inline' and user_data_entry.current_list['items']:
+        text, keyboard = render_packing_step(user_data_entry)
+        send_markdown(message.chat.id, text, reply_markup=keyboard)
+        return
+    bot.send_message(message.chat.id, PACK_START_MESSAGE, reply_markup=PACK_KEYBOARD)
     ask_object(message.chat.id, user_id)
 
 @bot.message_handler(func=lambda message: message.text == BUTTON_SHOW_LIST)
+@log_handled(logger)
+@track_handler
 def show_full_list(message):
-    logger.info(f"User {message.from_user.id} requested full list")
+    logger.info("User %s requested full list", message.from_user.id)
     user_id = message.from_user.id
     user_data_entry = user_data.get(user_id)
     
-    if not user_data_entry or 'current_list' not in user_data_entry:
+    if not user_data_entry:
         show_list_selection(message.chat.id)
         return
     
-    current_list = user_data_entry['current_list']
-    items = current_list['items']
-    
-    object_list = "\n\n".join([f"• *{item['full_name']}*\n{item['description']}" for item in items])
-    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
-    keyboard.add(KeyboardButton(BUTTON_PACK))
-    
-    bot.send_message(message.chat.id, 
-                     SHOW_FULL_LIST_PROMPT.format(current_list['name'], object_list), 
-                     reply_markup=keyboard, 
-                     parse_mode='Markdown')
+    pages = render_full_list(user_data_entry)
+    for page in pages[:-1]:
+        send_markdown(message.chat.id, page)
+    send_markdown(message.chat.id, pages[-1], reply_markup=FULL_LIST_KEYBOARD)
 
 def ask_object(chat_id, user_id):
     user_data_entry = user_data.get(user_id)
@@ -150,32 +184,27 @@ def ask_object(chat_id, user_id):
         show_list_selection(chat_id)
         return
 
-    current_list = user_data_entry['current_list']
-    current_object = user_data_entry['progress']
+    current_list = user_data_entry.current_list
+    current_object = user_data_entry.progress
 
     if current_object < len(current_list['items']):
-        item = current_list['items'][current_object]
-        logger.debug(f"Asking user {user_id} about item: {item['full_name']}")
-        
-        message = f"*{item['full_name']}*\n\n{item['description']}\n\n{ITEM_PROMPT}"
-        
-        keyboard = get_pack_keyboard()
-        
-        if item['buy_link']:
-            keyboard.add(KeyboardButton(BUTTON_BUY))
+        logger.debug("Asking user %s about item %s", user_id, current_object)
+        message, keyboard = render_item(user_data_entry, current_object)
         
         try:
             bot.send_message(chat_id, message, 
                              reply_markup=keyboard,
                              parse_mode='Markdown')
         except telebot.apihelper.ApiException as e:
-            logger.error(f"Failed to send message with Markdown. Sending without formatting. Error: {e}")
+            logger.error("Failed to send message with Markdown. Sending without formatting. Error: %s", e)
             bot.send_message(chat_id, message, 
                              reply_markup=keyboard)
     else:
         finish_packing(chat_id, user_id)
 
 @bot.message_handler(func=lambda message: message.text == BUTTON_BUY)
+@log_handled(logger)
+@track_handler
 def handle_buy(message):
     user_id = message.from_user.id
     user_data_entry = user_data.get(user_id)
@@ -183,44 +212,47 @@ def handle_buy(message):
         show_list_selection(message.chat.id)
         return
 
-    current_list = user_data_entry['current_list']
-    current_object = user_data_entry['progress']
+    current_list = user_data_entry.current_list
+    current_object = user_data_entry.progress
 
     if current_object < len(current_list['items']):
         item = current_list['items'][current_object]
         if item['buy_link']:
-            keyboard = InlineKeyboardMarkup()
-            keyboard.add(InlineKeyboardButton(BUTTON_BUY_ONLINE, url=item['buy_link']))
-            bot.send_message(message.chat.id, BUY_PROMPT.format(item['full_name']), reply_markup=keyboard)
+            bot.send_message(message.chat.id, BUY_PROMPT.format(item['full_name']), reply_markup=get_buy_keyboard(item))
         else:
             bot.send_message(message.chat.id, NO_BUY_LINK)
     else:
         bot.send_message(message.chat.id, PACKING_FINISHED_MESSAGE)
 
 @bot.message_handler(func=lambda message: message.text in [BUTTON_TAKE, BUTTON_TAKE_LATER, BUTTON_SKIP])
+@log_handled(logger)
+@track_handler
 def handle_response(message):
     user_id = message.from_user.id
-    response = message.text.lower()
+    response = get_status_code(message.text)
 
     user_data_entry = user_data.get(user_id)
     if not user_data_entry:
         show_list_selection(message.chat.id)
         return
+    # Повтор того же ответа иначе сдвинул бы прогресс ещё раз и пропустил предмет
+    if is_stale(user_data_entry, message):
+        return
 
-    current_list = user_data_entry['current_list']
-    current_object = user_data_entry['progress']
+    current_list = user_data_entry.current_list
+    current_object = user_data_entry.progress
 
     if current_object < len(current_list['items']):
-        item = current_list['items'][current_object]
-        logger.debug(f"User {user_id} responded {response} to item {item['full_name']}")
-        user_data_entry['responses'][item['full_name']] = response
-        user_data_entry['progress'] += 1
+        logger.debug("User %s responded %s to item %s", user_id, response, current_object)
+        user_data_entry.set_status(current_object, response)
+        user_data_entry.progress += 1
+        user_data.save(user_id, user_data_entry)
         ask_object(message.chat.id, user_id)
     else:
         finish_packing(message.chat.id, user_id)
 
 def finish_packing(chat_id, user_id):
-    logger.info(f"Finishing packing for user {user_id}")
+    logger.info("Finishing packing for user %s", user_id)
     user_data_entry = user_data.get(user_id)
     if not user_data_entry:
         show_list_selection(chat_id)
@@ -228,67 +260,112 @@ def finish_packing(chat_id, user_id):
 
     bot.send_message(chat_id, PACKING_FINISHED_MESSAGE, reply_markup=ReplyKeyboardRemove())
     show_lists(chat_id, user_id)
-    final_keyboard = get_final_keyboard()
-    logger.info(f"Sending final keyboard to user {user_id}: {final_keyboard}")
-    bot.send_message(chat_id, WHAT_NEXT_MESSAGE, reply_markup=final_keyboard)
+    logger.debug("Sending final keyboard to user %s", user_id)
+    bot.send_message(chat_id, WHAT_NEXT_MESSAGE, reply_markup=FINAL_KEYBOARD)
 
-def show_lists(chat_id, user_id):
+# Inline-режим сбора: одно сообщение, которое редактируется на каждом шаге
+
+def edit_packing_message(message, text, keyboard):
+    if not message_states.changed(message.chat.id, message.message_id, text, keyboard):
+        return
+    try:
+        bot.edit_message_text(text, message.chat.id, message.message_id,
+                              reply_markup=keyboard, parse_mode='Markdown')
+    except telebot.apihelper.ApiTelegramException as api_error:
+        # Повторное нажатие той же кнопки не меняет сообщение
+        if "message is not modified" not in str(api_error).lower():
+            logger.error("Failed to edit message with Markdown. Editing without formatting. Error: %s", api_error)
+            bot.edit_message_text(text, message.chat.id, message.message_id, reply_markup=keyboard)
+    message_states.remember(message.chat.id, message.message_id, text, keyboard)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('pack_'))
+@log_handled(logger)
+@track_handler
+def handle_inline_response(call):
+    user_id = call.from_user.id
     user_data_entry = user_data.get(user_id)
     if not user_data_entry:
-        show_list_selection(chat_id)
+        bot.answer_callback_query(call.id)
+        show_list_selection(call.message.chat.id)
+        return
+    if is_stale(user_data_entry, call):
         return
 
-    responses = user_data_entry['responses']
-    current_list = user_data_entry['current_list']
+    items_count = len(user_data_entry.current_list['items'])
+    start = user_data_entry.progress
+    stop = min(start + PACKING_PAGE_SIZE, items_count)
 
-    packed = [item for item in current_list['items'] if responses.get(item['full_name'], '').lower() == BUTTON_TAKE.lower()]
-    not_packed = [item for item in current_list['items'] if responses.get(item['full_name'], '').lower() == BUTTON_TAKE_LATER.lower()]
-    postponed = [item for item in current_list['items'] if responses.get(item['full_name'], '').lower() == BUTTON_SKIP.lower()]
+    toggled = False
+    if call.data == 'pack_next':
+        if user_data_entry.statuses.find(0, start, stop) != -1:
+            bot.answer_callback_query(call.id, MARK_ALL_ITEMS)
+            return
+        user_data_entry.progress = stop
+    else:
+        _, index, code = call.data.split('_')
+        index, code = int(index), int(code)
+        # Нажатие на кнопку старого шага, например двойной тап
+        if not start <= index < stop:
+            bot.answer_callback_query(call.id, PACKING_STEP_OUTDATED)
+            return
+        logger.debug("User %s responded %s to item %s", user_id, code, index)
+        user_data_entry.set_status(index, code or NEXT_STATUS[user_data_entry.statuses[index]])
+        toggled = not code
+        # По одному предмету — сразу следующий шаг, на странице — только после «Далее»
+        if PACKING_PAGE_SIZE == 1:
+            user_data_entry.progress += 1
+
+    user_data.save(user_id, user_data_entry)
+    bot.answer_callback_query(call.id)
+    if toggled:
+        # Текст страницы не меняется, обновляем только кнопки
+        text, keyboard = render_packing_step(user_data_entry)
+        if message_states.changed(call.message.chat.id, call.message.message_id, text, keyboard):
+            bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=keyboard)
+            message_states.remember(call.message.chat.id, call.message.message_id, text, keyboard)
+    elif user_data_entry.progress < items_count:
+        edit_packing_message(call.message, *render_packing_step(user_data_entry))
+    else:
+        # Итоги и финальное меню заменяют сообщение сбора, без отдельных сообщений
+        logger.info("Finishing inline packing for user %s", user_id)
+        edit_packing_message(call.message, format_results(user_data_entry), FINAL_KEYBOARD)
 
-    result = f"Результаты сбора для похода: *{current_list['name']}*\n\n"
-    
-    if packed:
-        result += "Уже в рюкзаке:\n" + "\n".join(f"- *{item['full_name']}*" for item in packed) + "\n\n"
-    
-    if not_packed:
-        result += "Не забыть положить позже:\n" + "\n".join(f"- *{item['full_name']}*" for item in not_packed) + "\n\n"
-    
-    if postponed:
-        result += "Не будете брать в этот поход:\n" + "\n".join(f"- *{item['full_name']}*" for item in postponed)
+def show_lists(chat_id, user_id):
+    user_data_entry = user_data.get(user_id)
+    if not user_data_entry:
+        show_list_selection(chat_id)
+        return
 
-    result = result.rstrip()
+    result = format_results(user_data_entry)
 
     try:
         bot.send_message(chat_id, result, parse_mode='Markdown')
     except telebot.apihelper.ApiException as e:
-        logger.error(f"Failed to send message with Markdown. Sending without formatting. Error: {e}")
+        logger.error("Failed to send message with Markdown. Sending without formatting. Error: %s", e)
         bot.send_message(chat_id, result)
 
 @bot.callback_query_handler(func=lambda call: call.data == "edit_list")
+@log_handled(logger)
+@track_handler
 def handle_edit_list(call):
-    logger.info(f"Received 'Редактировать список' callback from user {call.from_user.id}")
+    logger.info("Received 'Редактировать список' callback from user %s", call.from_user.id)
     try:
         user_data_entry = user_data.get(call.from_user.id)
-        if user_data_entry and user_data_entry['responses']:
-            logger.debug(f"User {call.from_user.id} has saved responses. Proceeding to edit_list.")
+        if user_data_entry and user_data_entry.has_responses():
+            logger.debug("User %s has saved responses. Proceeding to edit_list.", call.from_user.id)
             edit_list(call.message)
         else:
-            logger.warning(f"User {call.from_user.id} has no saved responses.")
+            logger.warning("User %s has no saved responses.", call.from_user.id)
             bot.answer_callback_query(call.id, NO_SAVED_RESPONSES)
             bot.send_message(call.message.chat.id, NO_SAVED_RESPONSES)
     except Exception as e:
-        logger.error(f"Error in handle_edit_list for user {call.from_user.id}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error in handle_edit_list for user %s: %s", call.from_user.id, e)
+        metrics.count_handler_error('handle_edit_list')
         bot.answer_callback_query(call.id, GENERAL_ERROR)
         bot.send_message(call.message.chat.id, GENERAL_ERROR)
 
-def generate_short_callback(prefix, data):
-    """Generate a short callback data using a hash function."""
-    hash_object = hashlib.md5(data.encode())
-    return f"{prefix}_{hash_object.hexdigest()[:10]}"
-
 def edit_list(message):
-    logger.debug(f"Entered edit_list function for user {message.chat.id}")
+    logger.debug("Entered edit_list function for user %s", message.chat.id)
     try:
         user_id = message.chat.id
         user_data_entry = user_data.get(user_id)
@@ -296,46 +373,39 @@ def edit_list(message):
             show_list_selection(message.chat.id)
             return
 
-        current_list = user_data_entry['current_list']
-        responses = user_data_entry['responses']
-
-        if not responses:
-            logger.info(f"No saved responses for user {user_id}")
+        if not user_data_entry.has_responses():
+            logger.info("No saved responses for user %s", user_id)
             bot.send_message(message.chat.id, NO_SAVED_RESPONSES)
             return
 
-        logger.debug(f"Creating keyboard for item editing for user {user_id}")
-        keyboard = InlineKeyboardMarkup(row_width=1)
-        for item in current_list['items']:
-            status = responses.get(item['full_name'], 'Не задано')
-            callback_data = generate_short_callback("edit", item['full_name'])
-            status_icon = get_status_icon(status)
-            button_text = f"{status_icon} {item['short_name']}"  
-            keyboard.add(InlineKeyboardButton(button_text, callback_data=callback_data))
-
-        keyboard.add(InlineKeyboardButton(BUTTON_BACK, callback_data="back_to_final"))
+        logger.debug("Creating keyboard for item editing for user %s", user_id)
+        keyboard = get_edit_list_keyboard(user_data_entry).to_json()
+        if not message_states.changed(message.chat.id, message.message_id, CHOOSE_ITEM_TO_EDIT, keyboard):
+            logger.debug("Edit list of user %s is unchanged, skipping edit", user_id)
+            return
 
-        logger.debug(f"Sending edit list message to user {user_id}")
+        logger.debug("Sending edit list message to user %s", user_id)
         try:
             bot.edit_message_text(CHOOSE_ITEM_TO_EDIT, 
                                   message.chat.id, 
                                   message.message_id, 
                                   reply_markup=keyboard)
         except telebot.apihelper.ApiTelegramException as api_error:
-            logger.error(f"Telegram API error: {str(api_error)}")
-            if "message is not modified" in str(api_error).lower():
-                logger.info("Message content is the same, sending new message instead of editing")
-                bot.send_message(message.chat.id, CHOOSE_ITEM_TO_EDIT, reply_markup=keyboard)
-            else:
+            # Сообщение уже показывает этот список: второе меню не отправляем
+            if "message is not modified" not in str(api_error).lower():
                 raise
+            logger.debug("Edit list of user %s is already shown", user_id)
+        message_states.remember(message.chat.id, message.message_id, CHOOSE_ITEM_TO_EDIT, keyboard)
     except Exception as e:
-        logger.error(f"Error in edit_list for user {message.chat.id}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error in edit_list for user %s: %s", message.chat.id, e)
+        metrics.count_handler_error('edit_list')
         bot.send_message(message.chat.id, EDIT_LIST_ERROR)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('edit_'))
+@log_handled(logger)
+@track_handler
 def edit_item(call):
-    logger.info(f"Received edit callback from user {call.from_user.id}")
+    logger.info("Received edit callback from user %s", call.from_user.id)
     try:
         user_id = call.from_user.id
         user_data_entry = user_data.get(user_id)
@@ -344,127 +414,334 @@ def edit_item(call):
             return
 
         item_hash = call.data.split('_', 1)[1]
-        current_list = user_data_entry['current_list']
+        callback_index = get_callback_index(user_data_entry)
+        item_index = callback_index.find_item(item_hash)
 
-        full_item = next((item for item in current_list['items'] if generate_short_callback("edit", item['full_name']).split('_')[1] == item_hash), None)
-
-        if full_item is None:
-            logger.error(f"Item not found for hash {item_hash}")
+        if item_index is None:
+            logger.error("Item not found for hash %s", item_hash)
             bot.answer_callback_query(call.id, GENERAL_ERROR)
             return
 
-        keyboard = InlineKeyboardMarkup(row_width=1)
-        statuses = [BUTTON_TAKE, BUTTON_TAKE_LATER, BUTTON_SKIP]
-        for status in statuses:
-            callback_data = generate_short_callback("status", f"{full_item['full_name']}_{status}")
-            keyboard.add(InlineKeyboardButton(status, callback_data=callback_data))
-        keyboard.add(InlineKeyboardButton(BUTTON_BACK, callback_data="back_to_edit"))
-
-        message_text = f"*{full_item['full_name']}*\n\n{full_item['description']}\n\n{CHOOSE_ITEM_STATUS}"
-        
-        if full_item['buy_link']:
-            keyboard.add(InlineKeyboardButton("Купить", url=full_item['buy_link']))
-
-        bot.edit_message_text(message_text, 
-                              call.message.chat.id, 
-                              call.message.message_id, 
-                              reply_markup=keyboard,
-                              parse_mode='Markdown')
+        message_text, keyboard = render_item_editor(user_data_entry, item_index, callback_index)
+        # Отложенная правка списка не должна затереть открытый редактор
+        edit_debouncer.cancel((call.message.chat.id, call.message.message_id))
+        if message_states.changed(call.message.chat.id, call.message.message_id, message_text, keyboard):
+            bot.edit_message_text(message_text, 
+                                  call.message.chat.id, 
+                                  call.message.message_id, 
+                                  reply_markup=keyboard,
+                                  parse_mode='Markdown')
+            message_states.remember(call.message.chat.id, call.message.message_id, message_text, keyboard)
     except Exception as e:
-        logger.error(f"Error in edit_item for user {call.from_user.id}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error in edit_item for user %s: %s", call.from_user.id, e)
+        metrics.count_handler_error('edit_item')
         bot.answer_callback_query(call.id, GENERAL_ERROR)
         bot.send_message(call.message.chat.id, EDIT_ITEM_ERROR)
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('status_'))
+@log_handled(logger)
+@track_handler
 def set_status(call):
-    logger.info(f"Received status callback from user {call.from_user.id}")
+    logger.info("Received status callback from user %s", call.from_user.id)
     try:
         user_id = call.from_user.id
         user_data_entry = user_data.get(user_id)
         if not user_data_entry:
             show_list_selection(call.message.chat.id)
             return
+        if is_stale(user_data_entry, call):
+            return
 
         status_hash = call.data.split('_', 1)[1]
-        current_list = user_data_entry['current_list']
-
-        full_item = None
-        chosen_status = None
-
-        for item in current_list['items']:
-            for status in [BUTTON_TAKE, BUTTON_TAKE_LATER, BUTTON_SKIP]:
-                if generate_short_callback("status", f"{item['full_name']}_{status}").split('_')[1] == status_hash:
-                    full_item = item
-                    chosen_status = status
-                    break
-            if full_item:
-                break
-
-        if not full_item or not chosen_status:
-            logger.error(f"Item or status not found for hash {status_hash}")
+        item_index, chosen_status = get_callback_index(user_data_entry).find_status(status_hash)
+
+        if item_index is None or not chosen_status:
+            logger.error("Item or status not found for hash %s", status_hash)
             bot.answer_callback_query(call.id, GENERAL_ERROR)
             return
 
-        user_data_entry['responses'][full_item['full_name']] = chosen_status
+        if user_data_entry.set_status(item_index, get_status_code(chosen_status)):
+            user_data.save(user_id, user_data_entry)
 
         status_icon = get_status_icon(chosen_status)
         bot.answer_callback_query(call.id, f"{STATUS_UPDATED}: {status_icon}")
 
-        # Обновляем сообщение с текущим статусом редактирования
-        edit_list(call.message)
+        # Обновляем сообщение с текущим статусом редактирования; нажатия подряд дают одну правку
+        edit_debouncer.schedule((call.message.chat.id, call.message.message_id), lambda: edit_list(call.message))
     except Exception as e:
-        logger.error(f"Error in set_status for user {call.from_user.id}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error in set_status for user %s: %s", call.from_user.id, e)
+        metrics.count_handler_error('set_status')
         bot.answer_callback_query(call.id, GENERAL_ERROR)
         bot.send_message(call.message.chat.id, UPDATE_STATUS_ERROR)
 
 @bot.callback_query_handler(func=lambda call: call.data == "back_to_edit")
+@log_handled(logger)
+@track_handler
 def edit_list_callback(call):
-    logger.debug(f"Returning to edit list for user {call.from_user.id}")
+    logger.debug("Returning to edit list for user %s", call.from_user.id)
+    edit_debouncer.cancel((call.message.chat.id, call.message.message_id))
     edit_list(call.message)
 
 @bot.callback_query_handler(func=lambda call: call.data == "back_to_final")
+@log_handled(logger)
+@track_handler
 def back_to_final(call):
-    logger.info(f"Returning to final menu for user {call.from_user.id}")
+    logger.info("Returning to final menu for user %s", call.from_user.id)
     user_id = call.from_user.id
     
     # Показываем обновленные списки
     show_lists(call.message.chat.id, user_id)
     
     # Отправляем сообщение с финальным меню и клавиатурой
-    bot.send_message(call.message.chat.id, WHAT_NEXT_MESSAGE, reply_markup=get_final_keyboard())
+    bot.send_message(call.message.chat.id, WHAT_NEXT_MESSAGE, reply_markup=FINAL_KEYBOARD)
     
     # Удаляем предыдущее сообщение с кнопками редактирования
+    forget_message(call.message)
     bot.delete_message(call.message.chat.id, call.message.message_id)
 
 @bot.callback_query_handler(func=lambda call: call.data == "restart_packing")
+@log_handled(logger)
+@track_handler
 def restart_packing(call):
-    logger.info(f"User {call.from_user.id} requested to restart packing")
+    logger.info("User %s requested to restart packing", call.from_user.id)
     user_id = call.from_user.id
     reset_progress(user_id)
+    forget_message(call.message)
     bot.delete_message(call.message.chat.id, call.message.message_id)
     show_list_selection(call.message.chat.id)
 
+# Общий сбор в группе: одно сообщение со списком на весь чат вместо сценария для каждого участника
+
+def find_group(call):
+    """Group session of the tapped summary message; answers the tap and returns None for an old message."""
+    group = group_data.get(call.message.chat.id)
+    if group is None or group.message_id != call.message.message_id:
+        bot.answer_callback_query(call.id, GROUP_LIST_OUTDATED)
+        return None
+    return group
+
+def refresh_group_summary(message):
+    group = group_data.get(message.chat.id)
+    if group is not None and group.message_id == message.message_id:
+        edit_packing_message(message, *render_group_summary(group))
+
+@bot.message_handler(commands=[COMMAND_GROUP])
+@log_handled(logger)
+@track_handler
+def start_group(message):
+    logger.info("Group packing requested in chat %s", message.chat.id)
+    if not is_group_chat(message.chat):
+        bot.send_message(message.chat.id, GROUP_ONLY)
+        return
+    bot.send_message(message.chat.id, CHOOSE_HIKE_TYPE, reply_markup=render_group_list_selection())
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('group_list_'))
+@log_handled(logger)
+@track_handler
+def handle_group_list_selection(call):
+    list_id = call.data.split('_', 2)[2]
+    snapshot = catalog.snapshot
+    selected_list = snapshot.get_list(list_id)
+    if not selected_list:
+        bot.answer_callback_query(call.id, "Ошибка: список не найден")
+        return
+
+    # Сообщение выбора становится общим списком; нажатия на прежний список группы больше не принимаются
+    group = GroupSession(selected_list, snapshot.version, call.message.message_id)
+    group_data.save(call.message.chat.id, group)
+    bot.answer_callback_query(call.id, f"Вы выбрали: {selected_list['name']}")
+    edit_packing_message(call.message, *render_group_summary(group))
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('group_item_'))
+@log_handled(logger)
+@track_handler
+def handle_group_item(call):
+    group = find_group(call)
+    if group is None:
+        return
+    # group_item_<индекс>_<статус, который ставит кнопка>
+    index, status = map(int, call.data.split('_')[2:4])
+    if not 0 <= index < len(group) or status not in STATUS_ICONS:
+        bot.answer_callback_query(call.id, GROUP_LIST_OUTDATED)
+        return
+
+    user = call.from_user
+    group.members[user.id] = user.first_name
+    # Кнопка задаёт статус, а версия — update_id нажатия: из одновременных нажатий побеждает
+    # более позднее, в любом порядке обработки
+    if not group.merge(index, status, user.id, get_update_id(call)):
+        bot.answer_callback_query(call.id)
+        return
+
+    item = group.current_list['items'][index]
+    bot.answer_callback_query(call.id, GROUP_ITEM_UPDATED.format(item['short_name'], STATUS_ICONS[status]))
+    # Нажатия всех участников за EDIT_DEBOUNCE секунд дают одну правку общего сообщения
+    edit_debouncer.schedule((call.message.chat.id, call.message.message_id),
+                            lambda: refresh_group_summary(call.message))
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('group_page_'))
+@log_handled(logger)
+@track_handler
+def handle_group_page(call):
+    group = find_group(call)
+    if group is None:
+        return
+    page = int(call.data.rsplit('_', 1)[1])
+    if 0 <= page * GROUP_PAGE_SIZE < len(group):
+        group.page = page
+    bot.answer_callback_query(call.id)
+    edit_debouncer.cancel((call.message.chat.id, call.message.message_id))
+    refresh_group_summary(call.message)
+
+# Напоминания о вещах «Позже» перед датой выхода
+
+reminder_engine = create_reminder_engine(user_data, send_scheduler, send_markdown)
+
+@bot.message_handler(commands=[COMMAND_REMIND])
+@log_handled(logger)
+@track_handler
+def remind(message):
+    user_id = message.from_user.id
+    user_data_entry = user_data.get(user_id)
+    if not user_data_entry or STATUS_TAKE_LATER not in user_data_entry.statuses:
+        bot.send_message(message.chat.id, REMIND_NOTHING)
+        return
+
+    departure = parse_departure(telebot.util.extract_arguments(message.text) or '')
+    if departure is None:
+        bot.send_message(message.chat.id, REMIND_USAGE)
+        return
+    if departure <= time.time():
+        bot.send_message(message.chat.id, REMIND_IN_PAST)
+        return
+
+    logger.info("User %s scheduled reminders before %s", user_id, departure)
+    if reminder_engine.schedule(user_id, message.chat.id, departure, REMINDER_LEADS):
+        bot.send_message(message.chat.id, REMIND_SET.format(datetime.fromtimestamp(departure).strftime('%d.%m.%Y %H:%M')))
+    else:
+        # До выхода меньше самого короткого упреждения — напоминаем сразу
+        send_markdown(message.chat.id, format_reminder(user_data_entry))
+
+# Поиск по каталогу
+
+@bot.message_handler(commands=[COMMAND_SEARCH])
+@log_handled(logger)
+@track_handler
+def search(message):
+    query = normalize_query(telebot.util.extract_arguments(message.text))
+    if not query:
+        bot.send_message(message.chat.id, SEARCH_USAGE)
+        return
+    snapshot = catalog.snapshot
+    item_ids = search_items(snapshot, query)
+    logger.info("User %s searched the catalog: %s results", message.from_user.id, len(item_ids))
+    if not item_ids:
+        bot.send_message(message.chat.id, SEARCH_NOTHING_FOUND.format(query))
+        return
+    text, keyboard = render_search_page(snapshot, query, item_ids, 0)
+    send_markdown(message.chat.id, text, reply_markup=keyboard)
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('search_'))
+@log_handled(logger)
+@track_handler
+def handle_search_page(call):
+    _, key, page = call.data.split('_')
+    query = search_queries.get(key)
+    snapshot = catalog.snapshot
+    item_ids = search_items(snapshot, query) if query else []
+    page = int(page)
+    if not 0 <= page * SEARCH_PAGE_SIZE < len(item_ids):
+        bot.answer_callback_query(call.id, SEARCH_OUTDATED)
+        return
+    bot.answer_callback_query(call.id)
+    edit_packing_message(call.message, *render_search_page(snapshot, query, item_ids, page))
+
+@bot.inline_handler(func=lambda inline_query: True)
+@log_handled(logger)
+@track_handler
+def inline_search(inline_query):
+    query = normalize_query(inline_query.query)
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    snapshot = catalog.snapshot
+    item_ids = search_items(snapshot, query) if query else []
+    stop = offset + INLINE_PAGE_SIZE
+    # Следующую порцию Telegram запросит сам с next_offset, когда пользователь долистает до конца
+    bot.answer_inline_query(inline_query.id,
+                            [render_inline_result(snapshot, item_id) for item_id in item_ids[offset:stop]],
+                            cache_time=INLINE_CACHE_TIME,
+                            next_offset=str(stop) if stop < len(item_ids) else '')
+
 @bot.message_handler(func=lambda message: True)
+@log_handled(logger)
+@track_handler
 def echo_all(message):
-    logger.debug(f"Received message: '{message.text}' from user {message.from_user.id}")
+    logger.debug("Received message: '%s' from user %s", message.text, message.from_user.id)
     bot.reply_to(message, UNKNOWN_COMMAND)
 
+# Запуск
+
+POLLING_BACKOFF_BASE = float(os.environ.get('POLLING_BACKOFF_BASE', '1'))
+POLLING_BACKOFF_CAP = float(os.environ.get('POLLING_BACKOFF_CAP', '60'))
+
+# Метрики состояния, читаются при запросе /metrics
+if METRICS_ENABLED:
+    register_gauges(user_data, seen_updates, reminder_engine, send_scheduler, edit_debouncer)
+
+startup.timer.mark('handlers')
+
 def set_commands():
-    bot.set_my_commands([
-        BotCommand(COMMAND_START, COMMAND_START_DESCRIPTION),
-        BotCommand(COMMAND_RESET, COMMAND_RESET_DESCRIPTION)
-    ])
+    startup.sync_commands(bot, TOKEN, COMMANDS_STAMP_PATH, get_bot_commands())
 
-if __name__ == '__main__':
-    set_commands()
-    logger.info("Bot started")
+def process_update(update):
+    bot.process_new_updates([update])
+
+def run_polling():
+    backoff = startup.Backoff(POLLING_BACKOFF_BASE, POLLING_BACKOFF_CAP)
     while True:
+        started = time.monotonic()
         try:
             logger.info("Starting bot polling")
             bot.polling(none_stop=True)
         except Exception as e:
-            logger.error(f"Bot crashed. Restarting. Error: {e}")
-            logger.error(traceback.format_exc())
-            time.sleep(10)
+            # После долгой нормальной работы паузы начинаются заново
+            if time.monotonic() - started > POLLING_BACKOFF_CAP:
+                backoff.reset()
+            delay = backoff.next_delay()
+            logger.exception("Bot crashed. Restarting in %.1f s. Error: %s", delay, e)
+            time.sleep(delay)
+        finally:
+            user_data.flush()
+            seen_updates.flush()
+
+def run_webhook():
+    from webhook import serve_webhook
+    if WEBHOOK_URL:
+        bot.remove_webhook()
+        bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    try:
+        serve_webhook(process_update, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                      secret_token=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS, queue_size=WEBHOOK_QUEUE_SIZE)
+    finally:
+        reminder_engine.stop()
+        user_data.close()
+        seen_updates.close()
+
+if __name__ == '__main__':
+    # Меню команд не нужно для обработки апдейтов, поэтому синхронизируется в фоне
+    threading.Thread(target=set_commands, name='set-commands', daemon=True).start()
+    if METRICS_ENABLED:
+        metrics.start_metrics_server(METRICS_HOST, METRICS_PORT, ready=startup.timer.is_ready,
+                                     report=startup.timer.report)
+    catalog.start_watching()
+    reminder_engine.start()
+    warm_caches()
+    startup.timer.mark('warmup')
+    startup.watch_first_update(bot)
+    startup.timer.set_ready()
+    build_search_index()
+    catalog.add_listener(build_search_index)
+    logger.info("Bot started")
+    if BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        run_polling()
@@ -0,0 +1,334 @@
+import os
+import re
+import sys
+import json
+import mmap
+import time
+import struct
+import hashlib
+import logging
+import threading
+from collections.abc import Sequence
+from messages import FILE_NOT_FOUND_ERROR, FILE_READ_ERROR, BUTTON_TAKE, BUTTON_TAKE_LATER, BUTTON_SKIP
+
+logger = logging.getLogger(__name__)
+
+STATUSES = (BUTTON_TAKE, BUTTON_TAKE_LATER, BUTTON_SKIP)
+
+def generate_short_callback(prefix, data):
+    """Generate a short callback data using a hash function."""
+    hash_object = hashlib.md5(data.encode())
+    return f"{prefix}_{hash_object.hexdigest()[:10]}"
+
+# Таблицы callback-хешей
+
+class CallbackIndex:
+    """Precomputed callback hashes for one list: edit hash -> item index, status hash -> (item index, status)."""
+
+    def __init__(self, hiking_list):
+        self.edit_callbacks = []
+        self.items_by_hash = {}
+        self.statuses_by_hash = {}
+        self.status_callbacks = []
+        for index, item in enumerate(hiking_list['items']):
+            callback_data = generate_short_callback("edit", item['full_name'])
+            self.edit_callbacks.append(callback_data)
+            self.items_by_hash[callback_data.split('_', 1)[1]] = index
+            status_callbacks = []
+            for status in STATUSES:
+                status_callback = generate_short_callback("status", f"{item['full_name']}_{status}")
+                status_callbacks.append((status, status_callback))
+                self.statuses_by_hash[status_callback.split('_', 1)[1]] = (index, status)
+            self.status_callbacks.append(status_callbacks)
+
+    def find_item(self, item_hash):
+        return self.items_by_hash.get(item_hash)
+
+    def find_status(self, status_hash):
+        return self.statuses_by_hash.get(status_hash, (None, None))
+
+# Поиск по каталогу
+
+SEARCH_MIN_PREFIX = 2
+SEARCH_MAX_PREFIX = 12
+
+def tokenize(text):
+    return re.findall(r'\w+', text.lower().replace('ё', 'е'))
+
+class SearchIndex:
+    """Inverted index over short_name, full_name and description of every catalog item.
+
+    Keys are word prefixes of SEARCH_MIN_PREFIX..SEARCH_MAX_PREFIX characters, so a query word
+    still being typed is one dict lookup. A query intersects the postings of its words starting
+    from the shortest, so its cost depends on the number of matches, not on the catalog size.
+    An item shared by several lists is indexed once; results are item ids in catalog order.
+    """
+
+    def __init__(self, lists):
+        # id предмета -> (индекс списка, индекс предмета) первого вхождения и индексы всех его списков
+        self.items = []
+        self.item_lists = []
+        ids = {}
+        postings = {}
+        for list_index, hiking_list in enumerate(lists):
+            for item_index, item in enumerate(hiking_list['items']):
+                item_id = ids.get(item['full_name'])
+                if item_id is not None:
+                    if self.item_lists[item_id][-1] != list_index:
+                        self.item_lists[item_id].append(list_index)
+                    continue
+                item_id = ids[item['full_name']] = len(self.items)
+                self.items.append((list_index, item_index))
+                self.item_lists.append([list_index])
+                words = set(tokenize(f"{item['short_name']} {item['full_name']} {item['description']}"))
+                keys = {word[:length] for word in words
+                        for length in range(SEARCH_MIN_PREFIX, min(len(word), SEARCH_MAX_PREFIX) + 1)}
+                for key in keys:
+                    postings.setdefault(key, []).append(item_id)
+        self.postings = {key: frozenset(item_ids) for key, item_ids in postings.items()}
+
+    def search(self, query):
+        """Ids of the items that contain every word of the query as a word prefix."""
+        keys = {word[:SEARCH_MAX_PREFIX] for word in tokenize(query) if len(word) >= SEARCH_MIN_PREFIX}
+        if not keys:
+            return []
+        postings = sorted((self.postings.get(key, frozenset()) for key in keys), key=len)
+        found = postings[0]
+        for item_ids in postings[1:]:
+            if not found:
+                break
+            found = found & item_ids
+        return sorted(found)
+
+    def get_item(self, item_id, lists):
+        list_index, item_index = self.items[item_id]
+        return lists[list_index]['items'][item_index]
+
+    def __len__(self):
+        return len(self.items)
+
+# Снимок каталога
+
+class CatalogSnapshot:
+    """Immutable view of the catalog.
+
+    Per-list indexes are built on first use, so loading cost does not grow with the number of items.
+    """
+
+    def __init__(self, lists, version=0, mtime=None):
+        self.version = version
+        self.mtime = mtime
+        self.lists = tuple(lists)
+        self.by_id = {hiking_list['id']: hiking_list for hiking_list in self.lists}
+        self._callbacks = {}
+        self._search_index = None
+        self._search_lock = threading.Lock()
+
+    def get_list(self, list_id):
+        return self.by_id.get(list_id)
+
+    def get_callbacks(self, list_id):
+        callback_index = self._callbacks.get(list_id)
+        if callback_index is None:
+            # При гонке двух потоков таблица построится дважды, но результат одинаковый
+            callback_index = CallbackIndex(self.by_id[list_id])
+            self._callbacks[list_id] = callback_index
+        return callback_index
+
+    def get_search_index(self):
+        """Search index over all lists; the bot starts building it right after each load."""
+        if self._search_index is None:
+            # Индекс строится по всему каталогу, поэтому запрос во время сборки ждёт её, а не строит второй
+            with self._search_lock:
+                if self._search_index is None:
+                    self._search_index = SearchIndex(self.lists)
+        return self._search_index
+
+    def __len__(self):
+        return len(self.lists)
+
+# Скомпилированный каталог
+#
+# Формат файла (little-endian):
+#   заголовок: магия, число списков, смещение таблицы списков;
+#   данные: JSON заголовков списков и JSON каждого предмета подряд;
+#   таблица списков: смещение и длина заголовка, число предметов, смещение таблицы предметов;
+#   таблица предметов списка: смещение и длина JSON каждого предмета.
+# Файл отображается в память через mmap, предмет разбирается из JSON только при обращении к нему.
+
+CATALOG_MAGIC = b'HIKECAT1'
+CATALOG_HEADER = struct.Struct('<8sIIQ')
+LIST_ENTRY = struct.Struct('<QIIQ')
+ITEM_ENTRY = struct.Struct('<QI')
+
+class CompiledItems(Sequence):
+    """Items of one compiled list; each access decodes the item from the mapped file."""
+
+    __slots__ = ('_data', '_table', '_count')
+
+    def __init__(self, data, table, count):
+        self._data = data
+        self._table = table
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self._count))]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('item index out of range')
+        offset, length = ITEM_ENTRY.unpack_from(self._data, self._table + index * ITEM_ENTRY.size)
+        return json.loads(self._data[offset:offset + length])
+
+def compile_catalog(source, target):
+    """Compile hiking_items.json into the binary catalog; the target is replaced atomically."""
+    with open(source, 'r', encoding='utf-8') as file:
+        lists = json.load(file)['lists']
+
+    data = bytearray(CATALOG_HEADER.size)
+    entries = []
+    for hiking_list in lists:
+        header = {key: value for key, value in hiking_list.items() if key != 'items'}
+        header_blob = json.dumps(header, ensure_ascii=False).encode('utf-8')
+        header_offset = len(data)
+        data += header_blob
+        item_entries = []
+        for item in hiking_list['items']:
+            blob = json.dumps(item, ensure_ascii=False).encode('utf-8')
+            item_entries.append((len(data), len(blob)))
+            data += blob
+        entries.append((header_offset, len(header_blob), item_entries))
+
+    tables_offset = len(data)
+    item_tables = bytearray()
+    item_table_offsets = []
+    for _, _, item_entries in entries:
+        item_table_offsets.append(tables_offset + len(entries) * LIST_ENTRY.size + len(item_tables))
+        for offset, length in item_entries:
+            item_tables += ITEM_ENTRY.pack(offset, length)
+    for (header_offset, header_length, item_entries), table_offset in zip(entries, item_table_offsets):
+        data += LIST_ENTRY.pack(header_offset, header_length, len(item_entries), table_offset)
+    data += item_tables
+    CATALOG_HEADER.pack_into(data, 0, CATALOG_MAGIC, len(entries), 0, tables_offset)
+
+    temporary = f"{target}.tmp"
+    with open(temporary, 'wb') as file:
+        file.write(data)
+    os.replace(temporary, target)
+    return len(entries)
+
+def read_compiled_catalog(path):
+    """Map a compiled catalog; list headers are decoded now, items on access."""
+    with open(path, 'rb') as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, list_count, _, tables_offset = CATALOG_HEADER.unpack_from(data, 0)
+    if magic != CATALOG_MAGIC:
+        raise ValueError(f"{path} is not a compiled catalog")
+    lists = []
+    for position in range(list_count):
+        header_offset, header_length, item_count, item_table = LIST_ENTRY.unpack_from(
+            data, tables_offset + position * LIST_ENTRY.size)
+        hiking_list = json.loads(data[header_offset:header_offset + header_length])
+        hiking_list['items'] = CompiledItems(data, item_table, item_count)
+        lists.append(hiking_list)
+    return lists
+
+def is_compiled_catalog(path):
+    with open(path, 'rb') as file:
+        return file.read(len(CATALOG_MAGIC)) == CATALOG_MAGIC
+
+# Загрузка и горячая перезагрузка
+
+class Catalog:
+    """Loads the catalog once and atomically swaps in a new snapshot when the file changes."""
+
+    def __init__(self, path, poll_interval=5.0):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.snapshot = CatalogSnapshot([])
+        self.stats = {
+            'loads': 0,
+            'swaps': 0,
+            'errors': 0,
+            'last_load_seconds': 0.0,
+            'last_swap_seconds': 0.0,
+        }
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher = None
+
+    def add_listener(self, callback):
+        """Register callback(snapshot) to be called after every swap."""
+        self._listeners.append(callback)
+
+    def _read(self):
+        try:
+            if is_compiled_catalog(self.path):
+                return read_compiled_catalog(self.path)
+            with open(self.path, 'r', encoding='utf-8') as file:
+                return json.load(file)['lists']
+        except FileNotFoundError:
+            logger.error(FILE_NOT_FOUND_ERROR)
+        except json.JSONDecodeError as e:
+            logger.error("JSON decode error: %s", e)
+        except Exception as e:
+            logger.error(FILE_READ_ERROR.format(e))
+        self.stats['errors'] += 1
+        return None
+
+    def load(self, force=False):
+        """Reload the file if its mtime changed. Returns True when a new snapshot was swapped in."""
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if not force and mtime is not None and mtime == self.snapshot.mtime:
+                return False
+
+            started = time.perf_counter()
+            lists = self._read()
+            if lists is None:
+                # Оставляем предыдущий снимок, если новый файл не читается
+                return False
+            snapshot = CatalogSnapshot(lists, version=self.snapshot.version + 1, mtime=mtime)
+            self.stats['loads'] += 1
+            self.stats['last_load_seconds'] = time.perf_counter() - started
+
+            swap_started = time.perf_counter()
+            self.snapshot = snapshot
+            for callback in self._listeners:
+                try:
+                    callback(snapshot)
+                except Exception as e:
+                    logger.exception("Catalog listener failed: %s", e)
+            self.stats['swaps'] += 1
+            self.stats['last_swap_seconds'] = time.perf_counter() - swap_started
+
+        logger.info("Catalog v%s loaded: %s lists in %.1f ms",
+                    snapshot.version, len(snapshot), self.stats['last_load_seconds'] * 1000)
+        return True
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            self.load()
+
+    def start_watching(self):
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch, name='catalog-watcher', daemon=True)
+            self._watcher.start()
+
+    def stop_watching(self):
+        self._stop.set()
+
+if __name__ == '__main__':
+    # Сборка: python catalog.py hiking_items.json hiking_items.cat
+    if len(sys.argv) != 3:
+        sys.exit("usage: python catalog.py SOURCE.json TARGET.cat")
+    count = compile_catalog(sys.argv[1], sys.argv[2])
+    print(f"Compiled {count} lists into {sys.argv[2]}")
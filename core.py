@@ -0,0 +1,544 @@
+import os
+import re
+import logging
+import threading
+from datetime import datetime
+from telebot import util
+from telebot.types import ReplyKeyboardMarkup, KeyboardButton, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton
+from telebot.types import InlineQueryResultArticle, InputTextMessageContent
+from messages import *
+from catalog import Catalog, CallbackIndex
+from sessions import create_session_store, MemorySessionStore, Session, get_status_code, STATUS_ICONS, STATUS_TAKE, STATUS_TAKE_LATER, STATUS_SKIP
+from ratelimit import SendScheduler
+from render import RenderCache, MessageStates, SearchQueries
+from dedupe import UpdateDeduplicator, get_update_id
+import startup
+
+# Общее у синхронного (bot.py) и асинхронного (async_bot.py) ботов: настройки, каталог, отрисовка
+# сообщений и фабрики хранилищ. Импорт модуля ничего не запускает — бота, потоки, файлы
+# и соединения создаёт точка входа.
+
+logger = logging.getLogger(__name__)
+
+# Получение токена
+TOKEN = os.environ.get('BOT_TOKEN')
+if TOKEN is None:
+    raise ValueError("Произошла ошибка: переменная окружения BOT_TOKEN не может быть 'None'")
+
+# Локальный адрес API, например фейковый сервер Telegram для тестов
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+
+# Ограничение исходящих запросов под лимиты Telegram
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_GLOBAL = float(os.environ.get('RATE_LIMIT_GLOBAL', '30'))
+RATE_LIMIT_CHAT = float(os.environ.get('RATE_LIMIT_CHAT', '1'))
+RATE_LIMIT_CHAT_BURST = int(os.environ.get('RATE_LIMIT_CHAT_BURST', '3'))
+# Потоки, отправляющие отложенные вызовы: каждый ждёт ответа API, поэтому один поток упирается в задержку API
+RATE_LIMIT_SENDERS = int(os.environ.get('RATE_LIMIT_SENDERS', '4'))
+
+def create_send_scheduler():
+    return SendScheduler(global_rate=RATE_LIMIT_GLOBAL, global_burst=int(RATE_LIMIT_GLOBAL),
+                         chat_rate=RATE_LIMIT_CHAT, chat_burst=RATE_LIMIT_CHAT_BURST, senders=RATE_LIMIT_SENDERS)
+
+# Метрики в формате Prometheus на отдельном локальном порту
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9090'))
+
+# Повторно доставленные апдейты (перезапуск polling, повтор webhook) отбрасываются по update_id.
+# С DEDUPE_PATH кольцо последних id переживает перезапуск процесса.
+DEDUPE_CAPACITY = int(os.environ.get('DEDUPE_CAPACITY', '10000'))
+DEDUPE_PATH = os.environ.get('DEDUPE_PATH')
+
+def open_update_deduplicator():
+    return UpdateDeduplicator(DEDUPE_CAPACITY, path=DEDUPE_PATH)
+
+# Чтение файла
+
+CATALOG_PATH = os.environ.get('CATALOG_PATH', 'hiking_items.json')
+CATALOG_POLL_INTERVAL = float(os.environ.get('CATALOG_POLL_INTERVAL', '5'))
+
+# Снимок загружает точка входа вызовом catalog.load()
+catalog = Catalog(CATALOG_PATH, poll_interval=CATALOG_POLL_INTERVAL)
+
+# Хранилище сессий
+
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'memory')
+SESSION_DB_PATH = os.environ.get('SESSION_DB_PATH', 'sessions.db')
+SESSION_TTL = float(os.environ.get('SESSION_TTL', str(7 * 24 * 3600)))
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+
+def resolve_session_list(list_id):
+    snapshot = catalog.snapshot
+    hiking_list = snapshot.get_list(list_id)
+    if hiking_list is None:
+        return None
+    return hiking_list, snapshot.version
+
+def open_session_store():
+    return create_session_store(SESSION_BACKEND, resolve_session_list,
+                                path=SESSION_DB_PATH, ttl=SESSION_TTL, cache_size=SESSION_CACHE_SIZE)
+
+# Общие списки групповых чатов по chat_id, только в памяти процесса
+GROUP_PAGE_SIZE = max(1, int(os.environ.get('GROUP_PAGE_SIZE', '20')))
+
+group_data = MemorySessionStore(ttl=SESSION_TTL)
+
+# Режим сбора: reply — новое сообщение на каждый предмет, inline — одно сообщение, которое редактируется.
+# При PACKING_PAGE_SIZE > 1 в inline-режиме на странице сразу несколько предметов.
+PACKING_MODE = os.environ.get('PACKING_MODE', 'reply')
+PACKING_PAGE_SIZE = max(1, int(os.environ.get('PACKING_PAGE_SIZE', '1')))
+
+def is_stale_update(user_data_entry, event, seen_updates):
+    """Session version check: True for an update the session has already moved past."""
+    if user_data_entry.accept(get_update_id(event)):
+        return False
+    seen_updates.stats['stale'] += 1
+    logger.info("Dropped stale update %s from user %s", get_update_id(event), event.from_user.id)
+    return True
+
+# Функции создания клавиатур
+
+def get_start_keyboard():
+    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
+    keyboard.add(KeyboardButton(BUTTON_PACK), KeyboardButton(BUTTON_SHOW_LIST))
+    return keyboard
+
+def get_pack_keyboard():
+    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
+    keyboard.add(KeyboardButton(BUTTON_TAKE), KeyboardButton(BUTTON_TAKE_LATER), KeyboardButton(BUTTON_SKIP))
+    return keyboard
+
+def get_final_keyboard():
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton(BUTTON_EDIT_LIST, callback_data="edit_list"))
+    keyboard.row(InlineKeyboardButton(BUTTON_RESTART_PACKING, callback_data="restart_packing"))
+    return keyboard
+
+def get_list_selection_keyboard(lists, prefix='select_list_'):
+    keyboard = InlineKeyboardMarkup()
+    for hiking_list in lists:
+        callback_data = f"{prefix}{hiking_list['id']}"
+        keyboard.add(InlineKeyboardButton(hiking_list['name'], callback_data=callback_data))
+    return keyboard
+
+def get_full_list_keyboard():
+    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
+    keyboard.add(KeyboardButton(BUTTON_PACK))
+    return keyboard
+
+def get_item_keyboard(item):
+    keyboard = get_pack_keyboard()
+    if item['buy_link']:
+        keyboard.add(KeyboardButton(BUTTON_BUY))
+    return keyboard
+
+def get_buy_keyboard(item):
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton(BUTTON_BUY_ONLINE, url=item['buy_link']))
+    return keyboard
+
+def get_edit_list_keyboard(user_data_entry):
+    current_list = user_data_entry.current_list
+    statuses = user_data_entry.statuses
+    callback_index = get_callback_index(user_data_entry)
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for index, (item, callback_data) in enumerate(zip(current_list['items'], callback_index.edit_callbacks)):
+        status_icon = STATUS_ICONS.get(statuses[index], "❓")
+        button_text = f"{status_icon} {item['short_name']}"  
+        keyboard.add(InlineKeyboardButton(button_text, callback_data=callback_data))
+
+    keyboard.add(InlineKeyboardButton(BUTTON_BACK, callback_data="back_to_final"))
+    return keyboard
+
+def get_status_keyboard(item, index, callback_index):
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for status, callback_data in callback_index.status_callbacks[index]:
+        keyboard.add(InlineKeyboardButton(status, callback_data=callback_data))
+    keyboard.add(InlineKeyboardButton(BUTTON_BACK, callback_data="back_to_edit"))
+    if item['buy_link']:
+        keyboard.add(InlineKeyboardButton("Купить", url=item['buy_link']))
+    return keyboard
+
+def get_inline_item_keyboard(item, index):
+    keyboard = InlineKeyboardMarkup()
+    keyboard.row(InlineKeyboardButton(BUTTON_TAKE, callback_data=f"pack_{index}_{STATUS_TAKE}"),
+                 InlineKeyboardButton(BUTTON_TAKE_LATER, callback_data=f"pack_{index}_{STATUS_TAKE_LATER}"),
+                 InlineKeyboardButton(BUTTON_SKIP, callback_data=f"pack_{index}_{STATUS_SKIP}"))
+    if item['buy_link']:
+        keyboard.row(InlineKeyboardButton(BUTTON_BUY_ONLINE, url=item['buy_link']))
+    return keyboard
+
+def get_inline_page_keyboard(user_data_entry, start, stop):
+    items = user_data_entry.current_list['items']
+    statuses = user_data_entry.statuses
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for index in range(start, stop):
+        status_icon = STATUS_ICONS.get(statuses[index], "❓")
+        # Код статуса 0 — переключить на следующий статус по кругу
+        keyboard.add(InlineKeyboardButton(f"{status_icon} {items[index]['short_name']}", callback_data=f"pack_{index}_0"))
+    keyboard.add(InlineKeyboardButton(BUTTON_NEXT_PAGE, callback_data="pack_next"))
+    return keyboard
+
+def get_status_icon(status):
+    return STATUS_ICONS.get(get_status_code(status), "❓")
+
+# Форматирование сообщений
+
+def format_list_selected(hiking_list):
+    return f"Вы выбрали: {hiking_list['name']}\n\n{hiking_list['description']}\n\nНачнем сбор снаряжения?"
+
+def format_full_list(current_list):
+    """Full list as message texts under Telegram's length limit, split between items."""
+    header = FULL_LIST_HEADER.format(current_list['name'])
+    pages = [[]]
+    length = len(header) + len(FULL_LIST_FOOTER)
+    entry_length = MESSAGE_MAX_LENGTH - length
+    for item in current_list['items']:
+        entry = f"• *{item['full_name']}*\n{item['description']}"
+        # Разметка каждого пункта закрыта внутри него, поэтому между пунктами резать безопасно.
+        # Пункт длиннее сообщения режется по строкам и словам описания.
+        for part in util.smart_split(entry, entry_length) if len(entry) > entry_length else (entry,):
+            if pages[-1] and length + len(part) + 2 > MESSAGE_MAX_LENGTH:
+                pages.append([])
+                length = len(FULL_LIST_FOOTER)
+            pages[-1].append(part)
+            length += len(part) + 2
+    texts = ["\n\n".join(page) for page in pages]
+    texts[0] = header + texts[0]
+    texts[-1] += FULL_LIST_FOOTER
+    return tuple(texts)
+
+def format_item(item):
+    return f"*{item['full_name']}*\n\n{item['description']}\n\n{ITEM_PROMPT}"
+
+def format_item_editor(item):
+    return f"*{item['full_name']}*\n\n{item['description']}\n\n{CHOOSE_ITEM_STATUS}"
+
+def format_page(current_list, start, stop):
+    items = current_list['items']
+    lines = "\n".join(f"• *{items[index]['full_name']}*" for index in range(start, stop))
+    return f"{PACKING_PAGE_HEADER.format(start + 1, stop, len(items))}\n\n{lines}"
+
+def escape_markdown(text):
+    return re.sub(r'([_*`\[])', r'\\\1', text)
+
+def format_search_lists(snapshot, search_index, item_id):
+    list_indexes = search_index.item_lists[item_id]
+    names = ", ".join(snapshot.lists[list_index]['name'] for list_index in list_indexes[:SEARCH_LISTS_SHOWN])
+    if len(list_indexes) > SEARCH_LISTS_SHOWN:
+        names = SEARCH_MORE_LISTS.format(names, len(list_indexes) - SEARCH_LISTS_SHOWN)
+    return names
+
+def format_search_result(snapshot, search_index, item_id):
+    item = search_index.get_item(item_id, snapshot.lists)
+    return f"• *{item['full_name']}* — {format_search_lists(snapshot, search_index, item_id)}\n{item['description']}"
+
+RESULT_SECTIONS = (
+    (STATUS_TAKE, "Уже в рюкзаке:\n"),
+    (STATUS_TAKE_LATER, "Не забыть положить позже:\n"),
+    (STATUS_SKIP, "Не будете брать в этот поход:\n"),
+)
+
+def format_result_lines(current_list):
+    return tuple(f"- *{item['full_name']}*" for item in current_list['items'])
+
+def format_results(user_data_entry):
+    current_list = user_data_entry.current_list
+    lines = render_result_lines(user_data_entry)
+
+    # Индексы предметов ищем поиском байта статуса, без проверки каждого предмета в Python
+    sections = [f"Результаты сбора для похода: *{current_list['name']}*"]
+    for code, title in RESULT_SECTIONS:
+        indexes = user_data_entry.indexes(code)
+        if indexes:
+            sections.append(title + "\n".join(lines[index] for index in indexes))
+
+    return "\n\n".join(sections)
+
+def get_callback_index(user_data_entry):
+    snapshot = catalog.snapshot
+    current_list = user_data_entry.current_list
+    if user_data_entry.catalog_version == snapshot.version:
+        return snapshot.get_callbacks(current_list['id'])
+    # Сессия начата на старой версии каталога: таблица её списка строится один раз и живёт в кэше отрисовки
+    return render_cache.get((user_data_entry.catalog_version, current_list['id'], None, 'callbacks'),
+                            lambda: CallbackIndex(current_list))
+
+# Кэш отрисовки
+
+MESSAGE_MAX_LENGTH = util.MAX_MESSAGE_LENGTH
+
+# Поиск: /search с листанием по SEARCH_PAGE_SIZE и inline-запросы @бот <запрос> по INLINE_PAGE_SIZE.
+# Inline-режим нужно включить у @BotFather.
+SEARCH_PAGE_SIZE = max(1, int(os.environ.get('SEARCH_PAGE_SIZE', '10')))
+SEARCH_LISTS_SHOWN = 3
+SEARCH_QUERY_LENGTH = 100
+INLINE_PAGE_SIZE = min(50, max(1, int(os.environ.get('INLINE_PAGE_SIZE', '20'))))
+INLINE_CACHE_TIME = int(os.environ.get('INLINE_CACHE_TIME', '300'))
+
+search_queries = SearchQueries(max_size=int(os.environ.get('SEARCH_QUERIES_SIZE', '10000')))
+
+START_KEYBOARD = get_start_keyboard().to_json()
+PACK_KEYBOARD = get_pack_keyboard().to_json()
+FINAL_KEYBOARD = get_final_keyboard().to_json()
+FULL_LIST_KEYBOARD = get_full_list_keyboard().to_json()
+
+render_cache = RenderCache(max_size=int(os.environ.get('RENDER_CACHE_SIZE', '50000')))
+catalog.add_listener(render_cache.clear)
+
+# Правки сообщений: правка без изменений пропускается, быстрые нажатия сливаются в одну правку
+EDIT_DEBOUNCE = float(os.environ.get('EDIT_DEBOUNCE', '0.3'))
+
+message_states = MessageStates(max_size=int(os.environ.get('MESSAGE_STATES_SIZE', '50000')))
+
+def render_list_selection():
+    snapshot = catalog.snapshot
+    return render_cache.get((snapshot.version, None, None, 'selection'),
+                            lambda: get_list_selection_keyboard(snapshot.lists).to_json())
+
+def render_group_list_selection():
+    snapshot = catalog.snapshot
+    return render_cache.get((snapshot.version, None, None, 'group_selection'),
+                            lambda: get_list_selection_keyboard(snapshot.lists, 'group_list_').to_json())
+
+def render_list_selected(snapshot, hiking_list):
+    return render_cache.get((snapshot.version, hiking_list['id'], None, 'selected'),
+                            lambda: format_list_selected(hiking_list))
+
+def render_full_list(user_data_entry):
+    """Texts of the full list messages, see format_full_list."""
+    current_list = user_data_entry.current_list
+    return render_cache.get((user_data_entry.catalog_version, current_list['id'], None, 'full_list'),
+                            lambda: format_full_list(current_list))
+
+def render_item(user_data_entry, index):
+    """Item card text and reply_markup JSON for the packing step."""
+    current_list = user_data_entry.current_list
+    item = current_list['items'][index]
+    return render_cache.get((user_data_entry.catalog_version, current_list['id'], index, 'item'),
+                            lambda: (format_item(item), get_item_keyboard(item).to_json()))
+
+def render_item_editor(user_data_entry, index, callback_index):
+    """Status editor text and reply_markup JSON for one item."""
+    current_list = user_data_entry.current_list
+    item = current_list['items'][index]
+    return render_cache.get((user_data_entry.catalog_version, current_list['id'], index, 'editor'),
+                            lambda: (format_item_editor(item), get_status_keyboard(item, index, callback_index).to_json()))
+
+def render_inline_item(user_data_entry, index):
+    """Item card text and inline keyboard JSON for the inline packing step."""
+    current_list = user_data_entry.current_list
+    item = current_list['items'][index]
+    return render_cache.get((user_data_entry.catalog_version, current_list['id'], index, 'inline_item'),
+                            lambda: (format_item(item), get_inline_item_keyboard(item, index).to_json()))
+
+def render_packing_step(user_data_entry):
+    """Text and inline keyboard JSON of the current inline packing step."""
+    start = user_data_entry.progress
+    if PACKING_PAGE_SIZE == 1:
+        return render_inline_item(user_data_entry, start)
+    current_list = user_data_entry.current_list
+    stop = min(start + PACKING_PAGE_SIZE, len(current_list['items']))
+    text = render_cache.get((user_data_entry.catalog_version, current_list['id'], start, 'page'),
+                            lambda: format_page(current_list, start, stop))
+    # Клавиатура страницы зависит от статусов, поэтому не кэшируется
+    return text, get_inline_page_keyboard(user_data_entry, start, stop).to_json()
+
+def render_group_summary(group):
+    """Text and inline keyboard JSON of a group's shared list; labels of unchanged items come from the session."""
+    items_count = len(group)
+    start = group.page * GROUP_PAGE_SIZE
+    stop = min(start + GROUP_PAGE_SIZE, items_count)
+    counts = group.counts()
+    text = GROUP_SUMMARY.format(group.current_list['name'], counts[STATUS_TAKE], counts[STATUS_TAKE_LATER],
+                                counts[STATUS_SKIP], counts[0], start + 1, stop, items_count)
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for index in range(start, stop):
+        keyboard.add(InlineKeyboardButton(group.label(index),
+                                          callback_data=f"group_item_{index}_{group.next_status(index)}"))
+    pages = []
+    if start > 0:
+        pages.append(InlineKeyboardButton(BUTTON_PREV_PAGE, callback_data=f"group_page_{group.page - 1}"))
+    if stop < items_count:
+        pages.append(InlineKeyboardButton(BUTTON_NEXT_PAGE, callback_data=f"group_page_{group.page + 1}"))
+    if pages:
+        keyboard.row(*pages)
+    return text, keyboard.to_json()
+
+def search_items(snapshot, query):
+    """Ids of the items matching the query. Not cached: the lookup is cheap, and free-text
+    queries would flush the render cache."""
+    return snapshot.get_search_index().search(query)
+
+def render_search_page(snapshot, query, item_ids, page):
+    """Text and inline keyboard JSON of one page of /search results."""
+    search_index = snapshot.get_search_index()
+    pages_count = (len(item_ids) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    start = page * SEARCH_PAGE_SIZE
+    lines = [render_cache.get((snapshot.version, None, item_id, 'search_result'),
+                              lambda: format_search_result(snapshot, search_index, item_id))
+             for item_id in item_ids[start:start + SEARCH_PAGE_SIZE]]
+    text = SEARCH_RESULTS.format(escape_markdown(query), len(item_ids), page + 1, pages_count, "\n\n".join(lines))
+    keyboard = InlineKeyboardMarkup()
+    pages = []
+    if pages_count > 1:
+        # Запрос не помещается в callback_data, поэтому в кнопку идёт его короткий ключ
+        key = search_queries.add(query)
+        if page > 0:
+            pages.append(InlineKeyboardButton(BUTTON_PREV_PAGE, callback_data=f"search_{key}_{page - 1}"))
+        if page + 1 < pages_count:
+            pages.append(InlineKeyboardButton(BUTTON_NEXT_PAGE, callback_data=f"search_{key}_{page + 1}"))
+    if pages:
+        keyboard.row(*pages)
+    return text, keyboard.to_json()
+
+def render_inline_result(snapshot, item_id):
+    """Inline query result for one item: the item card is sent to the chat when it is chosen."""
+    def build():
+        search_index = snapshot.get_search_index()
+        item = search_index.get_item(item_id, snapshot.lists)
+        return InlineQueryResultArticle(
+            str(item_id), item['full_name'],
+            InputTextMessageContent(format_search_result(snapshot, search_index, item_id), parse_mode='Markdown'),
+            description=format_search_lists(snapshot, search_index, item_id))
+    return render_cache.get((snapshot.version, None, item_id, 'inline_result'), build)
+
+def render_result_lines(user_data_entry):
+    current_list = user_data_entry.current_list
+    return render_cache.get((user_data_entry.catalog_version, current_list['id'], None, 'result_lines'),
+                            lambda: format_result_lines(current_list))
+
+# Прогрев: первые шаги сценария отрисовываются до первого апдейта и после каждой перезагрузки каталога
+
+WARMUP_LISTS = int(os.environ.get('WARMUP_LISTS', '50'))
+
+def warm_caches(snapshot=None):
+    snapshot = snapshot or catalog.snapshot
+    render_list_selection()
+    for hiking_list in snapshot.lists[:WARMUP_LISTS]:
+        render_list_selected(snapshot, hiking_list)
+        if hiking_list['items']:
+            user_data_entry = Session(hiking_list, snapshot.version)
+            if PACKING_MODE == 'inline':
+                render_packing_step(user_data_entry)
+            else:
+                render_item(user_data_entry, 0)
+
+catalog.add_listener(warm_caches)
+
+def build_search_index(snapshot=None):
+    """Build the search index in a background thread, so the first /search does not build it itself.
+
+    The first update does not need the index, so entry points call this after startup.timer.set_ready()
+    and then register it as a catalog listener.
+    """
+    snapshot = snapshot or catalog.snapshot
+    threading.Thread(target=snapshot.get_search_index, name='search-index', daemon=True).start()
+
+# Метрики состояния, читаются при запросе /metrics
+
+def register_gauges(user_data, seen_updates, reminder_engine, send_scheduler, edit_debouncer):
+    """State gauges of a running bot; the entry point calls it once its stores and senders exist."""
+    import metrics
+    metrics.registry.gauge('bot_active_sessions', 'Sessions in the session store.', lambda: len(user_data))
+    metrics.registry.gauge('bot_group_sessions', 'Shared group lists in memory.', lambda: len(group_data))
+    metrics.registry.gauge('bot_reminders_pending', 'Reminders waiting for their due time.',
+                           lambda: len(reminder_engine.queue))
+    metrics.registry.gauge('bot_reminders_sent', 'Reminders sent so far.', lambda: reminder_engine.stats['sent'])
+    metrics.registry.gauge('bot_catalog_version', 'Version of the loaded catalog snapshot.', lambda: catalog.snapshot.version)
+    metrics.registry.gauge('bot_catalog_load_seconds', 'Time to read and index the catalog on the last load.',
+                           lambda: catalog.stats['last_load_seconds'])
+    metrics.registry.gauge('bot_catalog_swap_seconds', 'Time to swap in the last snapshot and run the listeners.',
+                           lambda: catalog.stats['last_swap_seconds'])
+    metrics.registry.gauge('bot_catalog_swaps', 'Catalog snapshots swapped in so far.', lambda: catalog.stats['swaps'])
+    metrics.registry.gauge('bot_catalog_load_errors', 'Catalog loads that failed so far.', lambda: catalog.stats['errors'])
+    metrics.registry.gauge('bot_render_cache_entries', 'Entries in the render cache.', lambda: len(render_cache))
+    metrics.registry.gauge('bot_send_queue_depth', 'Calls waiting for the global rate limit.',
+                           lambda: send_scheduler.metrics()['queue_depth'])
+    metrics.registry.gauge('bot_send_throttled', 'Bot API calls answered with 429 so far.',
+                           lambda: send_scheduler.stats['throttled'])
+    metrics.registry.gauge('bot_send_deferred', 'Bot API calls queued for the sender threads so far.',
+                           lambda: send_scheduler.stats['deferred'])
+    metrics.registry.gauge('bot_send_failed', 'Deferred Bot API calls that failed so far.',
+                           lambda: send_scheduler.stats['failed'])
+    metrics.registry.gauge('bot_send_wait_seconds_avg', 'Average time a call waited for the rate limits.',
+                           lambda: send_scheduler.metrics()['avg_wait_seconds'])
+    metrics.registry.gauge('bot_send_wait_seconds_max', 'Longest time a call waited for the rate limits.',
+                           lambda: send_scheduler.stats['max_wait_seconds'])
+    metrics.registry.gauge('bot_duplicate_updates', 'Redelivered updates dropped so far.',
+                           lambda: seen_updates.stats['duplicates'])
+    metrics.registry.gauge('bot_stale_updates', 'Updates dropped by the session version check so far.',
+                           lambda: seen_updates.stats['stale'])
+    metrics.registry.gauge('bot_edits_skipped', 'Message edits skipped because nothing changed.',
+                           lambda: message_states.stats['skipped'])
+    metrics.registry.gauge('bot_edits_coalesced', 'Message edits merged into an already scheduled one.',
+                           lambda: edit_debouncer.stats['coalesced'])
+    metrics.registry.gauge('bot_ready', 'Whether the bot finished starting up.', lambda: int(startup.timer.is_ready()))
+    metrics.registry.gauge('bot_startup_seconds', 'Time from start to ready.', lambda: startup.timer.ready_seconds or 0)
+
+# Общий сбор в группе
+
+def is_group_chat(chat):
+    return chat.type in ('group', 'supergroup')
+
+# Напоминания о вещах «Позже» перед датой выхода.
+# REMINDER_LEADS — за сколько часов до выхода напоминать; очередь лежит рядом с сессиями.
+REMINDER_LEADS = tuple(float(hours) * 3600 for hours in os.environ.get('REMINDER_LEADS', '24,3').split(','))
+REMINDER_WORKERS = int(os.environ.get('REMINDER_WORKERS', '8'))
+REMINDER_BATCH_SIZE = int(os.environ.get('REMINDER_BATCH_SIZE', '500'))
+REMINDER_POLL_INTERVAL = float(os.environ.get('REMINDER_POLL_INTERVAL', '1'))
+
+def parse_departure(text):
+    """Unix time of "ДД.ММ.ГГГГ [ЧЧ:ММ]" in the server's local time zone, None if it does not parse."""
+    for date_format in ('%d.%m.%Y %H:%M', '%d.%m.%Y'):
+        try:
+            return datetime.strptime(text.strip(), date_format).timestamp()
+        except ValueError:
+            continue
+    return None
+
+def format_reminder(user_data_entry):
+    """Reminder text with the items still marked "take later", None when there are none."""
+    indexes = user_data_entry.indexes(STATUS_TAKE_LATER)
+    if not indexes:
+        return None
+    lines = render_result_lines(user_data_entry)
+    return REMINDER_MESSAGE.format(user_data_entry.current_list['name'], "\n".join(lines[index] for index in indexes))
+
+def create_reminder_engine(user_data, send_scheduler, send_markdown):
+    """ReminderEngine over the reminder queue of SESSION_BACKEND; send_markdown(chat_id, text) is a sync sender."""
+    from reminders import ReminderEngine, create_reminder_queue
+
+    def send_reminder(user_id, chat_id):
+        # Статусы читаются в момент отправки: если вещи уже собраны, напоминание не нужно
+        user_data_entry = user_data.get(user_id)
+        text = format_reminder(user_data_entry) if user_data_entry else None
+        if text is None:
+            return False
+        # Ответы на нажатия пользователей обгоняют рассылку в общем лимите
+        with send_scheduler.bulk():
+            send_markdown(chat_id, text)
+        return True
+
+    return ReminderEngine(create_reminder_queue(SESSION_BACKEND, SESSION_DB_PATH), send_reminder,
+                          workers=REMINDER_WORKERS, batch_size=REMINDER_BATCH_SIZE,
+                          poll_interval=REMINDER_POLL_INTERVAL)
+
+# Поиск по каталогу
+
+def normalize_query(text):
+    return " ".join((text or '').split())[:SEARCH_QUERY_LENGTH]
+
+# Меню команд
+
+COMMANDS_STAMP_PATH = os.environ.get('COMMANDS_STAMP_PATH', '.bot_commands')
+
+def get_bot_commands():
+    return [
+        BotCommand(COMMAND_START, COMMAND_START_DESCRIPTION),
+        BotCommand(COMMAND_RESET, COMMAND_RESET_DESCRIPTION),
+        BotCommand(COMMAND_GROUP, COMMAND_GROUP_DESCRIPTION),
+        BotCommand(COMMAND_REMIND, COMMAND_REMIND_DESCRIPTION),
+        BotCommand(COMMAND_SEARCH, COMMAND_SEARCH_DESCRIPTION)
+    ]
@@ -0,0 +1,122 @@
+import os
+import inspect
+import logging
+import threading
+from array import array
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+class UpdateDeduplicator:
+    """Remembers the last `capacity` update ids to drop updates Telegram delivers twice.
+
+    Redelivery happens after a polling restart or when a webhook response is lost.
+    With a path, the ring is written by a background thread every flush_interval
+    seconds and loaded back on start, so duplicates are caught across restarts too.
+    """
+
+    def __init__(self, capacity=10000, path=None, flush_interval=1.0):
+        self.capacity = capacity
+        self.path = path
+        self.flush_interval = flush_interval
+        self.stats = {'duplicates': 0, 'stale': 0}
+
+        # Кольцо задаёт порядок вытеснения, множество — проверку за O(1)
+        self._ring = deque(maxlen=capacity)
+        self._seen = set()
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._writer = None
+
+        if path:
+            self._load()
+            self._writer = threading.Thread(target=self._write_loop, name='dedupe-writer', daemon=True)
+            self._writer.start()
+
+    def seen(self, update_id):
+        """Record update_id. Returns True when it was already recorded."""
+        with self._lock:
+            if update_id in self._seen:
+                self.stats['duplicates'] += 1
+                return True
+            if len(self._ring) == self.capacity:
+                self._seen.discard(self._ring[0])
+            self._ring.append(update_id)
+            self._seen.add(update_id)
+            self._dirty = True
+            return False
+
+    def _load(self):
+        ids = array('q')
+        try:
+            with open(self.path, 'rb') as file:
+                ids.frombytes(file.read())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Failed to load seen update ids from %s: %s", self.path, e)
+            return
+        self._ring.extend(ids[-self.capacity:])
+        self._seen.update(self._ring)
+        logger.info("Loaded %s seen update ids", len(self._ring))
+
+    def flush(self):
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            ids = array('q', self._ring)
+            self._dirty = False
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'wb') as file:
+            ids.tofile(file)
+        os.replace(tmp_path, self.path)
+
+    def _write_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error("Failed to write seen update ids: %s", e)
+
+    def close(self):
+        self._stop.set()
+        if self._writer is not None:
+            self._writer.join()
+        self.flush()
+
+    def __len__(self):
+        return len(self._ring)
+
+def get_update_id(event):
+    """update_id stamped on a message or callback query by skip_duplicates(), None if absent."""
+    return getattr(event, 'update_id', None)
+
+def _stamp(updates):
+    for update in updates:
+        # Хендлеры получают сообщение или нажатие без апдейта, поэтому переносим его id на них
+        for event in (update.message, update.callback_query):
+            if event is not None:
+                event.update_id = update.update_id
+
+def skip_duplicates(bot, deduplicator):
+    """Filter the bot's process_new_updates through the deduplicator."""
+    process_new_updates = bot.process_new_updates
+
+    if inspect.iscoroutinefunction(process_new_updates):
+        async def fresh_updates_async(updates):
+            fresh = [update for update in updates if not deduplicator.seen(update.update_id)]
+            _stamp(fresh)
+            if fresh:
+                await process_new_updates(fresh)
+        bot.process_new_updates = fresh_updates_async
+        return
+
+    def fresh_updates(updates):
+        fresh = [update for update in updates if not deduplicator.seen(update.update_id)]
+        _stamp(fresh)
+        if fresh:
+            process_new_updates(fresh)
+    bot.process_new_updates = fresh_updates
@@ -0,0 +1,72 @@
+import threading
+from sessions import STATUS_ICONS, NEXT_STATUS, STATUS_SKIP
+
+# Общий сбор в группе: один список на чат, отмечают все участники
+
+class GroupSession:
+    """Shared packing list of a group chat, shown in a single summary message.
+
+    Every item is a last-writer-wins register: status, assignee and the version of the
+    write that set them. A button carries the status it sets, not "next status", so a tap
+    is an absolute write. A write only applies when its version is higher, so taps of
+    different members converge to the same state whatever order they are handled in.
+    Button labels are cached per item and rebuilt only for items that changed.
+    """
+
+    __slots__ = ('current_list', 'catalog_version', 'message_id', 'page',
+                 'statuses', 'assignees', 'versions', 'members', '_labels', '_lock')
+
+    def __init__(self, current_list, catalog_version, message_id):
+        count = len(current_list['items'])
+        self.current_list = current_list
+        self.catalog_version = catalog_version
+        self.message_id = message_id
+        self.page = 0
+        self.statuses = bytearray(count)
+        self.assignees = [0] * count
+        self.versions = [0] * count
+        # user_id -> имя участника для подписи на кнопке
+        self.members = {}
+        self._labels = [None] * count
+        # Блокировка своя у каждой группы: нажатия в разных чатах друг друга не ждут
+        self._lock = threading.Lock()
+
+    def next_status(self, index):
+        """Status the item's button sets: the one after its current status."""
+        return NEXT_STATUS[self.statuses[index]]
+
+    def merge(self, index, status, assignee, version=None):
+        """Apply a write of status by assignee. Returns False when a newer write is already applied.
+
+        Without a version the write wins over everything applied so far.
+        """
+        # Сравнение версии и запись трёх полей предмета должны пройти вместе
+        with self._lock:
+            if version is None:
+                version = self.versions[index] + 1
+            elif version <= self.versions[index]:
+                return False
+            self.versions[index] = version
+            self.statuses[index] = status
+            self.assignees[index] = assignee if status != STATUS_SKIP else 0
+            self._labels[index] = None
+            return True
+
+    def label(self, index):
+        label = self._labels[index]
+        if label is None:
+            item = self.current_list['items'][index]
+            label = f"{STATUS_ICONS.get(self.statuses[index], '❓')} {item['short_name']}"
+            assignee = self.assignees[index]
+            if assignee:
+                label += f" — {self.members.get(assignee, assignee)}"
+            self._labels[index] = label
+        return label
+
+    def counts(self):
+        counts = {code: self.statuses.count(code) for code in STATUS_ICONS}
+        counts[0] = self.statuses.count(0)
+        return counts
+
+    def __len__(self):
+        return len(self.statuses)
@@ -0,0 +1,179 @@
+import os
+import sys
+import copy
+import json
+import time
+import queue
+import random
+import atexit
+import inspect
+import logging
+import logging.handlers
+import contextvars
+from functools import wraps
+
+# Поля, которые попадают в JSON-событие
+EVENT_FIELDS = ('event', 'handler', 'user', 'duration_ms')
+
+# Хендлер, пользователь и решение о сэмплировании для текущего апдейта
+_context = contextvars.ContextVar('log_context', default=None)
+
+_sample_rates = {}
+# По умолчанию в лог попадает каждое сотое обновление; LOG_SAMPLE_RATE=1 включает полный лог
+DEFAULT_SAMPLE_RATE = 0.01
+_default_rate = DEFAULT_SAMPLE_RATE
+_listener = None
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line with the structured fields of the record."""
+
+    def format(self, record):
+        event = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in EVENT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                event[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            event['exc'] = record.exc_text
+        return json.dumps(event, ensure_ascii=False)
+
+class ContextFilter(logging.Filter):
+    """Stamps handler and user onto records and drops below-WARNING records of unsampled updates."""
+
+    def filter(self, record):
+        context = _context.get()
+        if context is None:
+            return True
+        handler, user, sampled = context
+        if not sampled and record.levelno < logging.WARNING:
+            return False
+        if getattr(record, 'handler', None) is None:
+            record.handler = handler
+        if getattr(record, 'user', None) is None:
+            record.user = user
+        return True
+
+_traceback_formatter = logging.Formatter()
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """Formats the message and traceback before queueing, only the write happens in the listener thread.
+
+    As in QueueHandler.prepare, the listener must not read args the handler may change meanwhile.
+    Unlike it, the structured fields and the traceback stay separate for JsonFormatter.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or _traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def parse_sample_rates(value):
+    """'handle_response=0.01,set_status=0.1' -> {'handle_response': 0.01, 'set_status': 0.1}"""
+    rates = {}
+    for part in filter(None, (chunk.strip() for chunk in value.split(','))):
+        name, _, rate = part.partition('=')
+        rates[name.strip()] = float(rate)
+    return rates
+
+def setup_logging(level=None, fmt=None, sample_rates=None, default_rate=None):
+    """Send all log records through a queue to a background listener writing to stderr.
+
+    Settings come from LOG_LEVEL, LOG_FORMAT (json or text), LOG_SAMPLE_RATES and LOG_SAMPLE_RATE.
+    """
+    global _sample_rates, _default_rate, _listener
+    level = level or os.environ.get('LOG_LEVEL', 'INFO')
+    fmt = fmt or os.environ.get('LOG_FORMAT', 'json')
+    if sample_rates is None:
+        sample_rates = parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES', ''))
+    if default_rate is None:
+        default_rate = float(os.environ.get('LOG_SAMPLE_RATE', DEFAULT_SAMPLE_RATE))
+    _sample_rates = sample_rates
+    _default_rate = default_rate
+
+    stream = logging.StreamHandler(sys.stderr)
+    if fmt == 'json':
+        stream.setFormatter(JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    stop_logging()
+    _listener = logging.handlers.QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+    return _listener
+
+def stop_logging():
+    """Write out queued records and stop the listener thread; safe to call more than once."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def _log_handled(logger, name, started):
+    # Для несэмплированного обновления запись не создаём вовсе, а не отбрасываем в фильтре
+    context = _context.get()
+    if context is not None and not context[2]:
+        return
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("handled %s", name, extra={
+            'event': 'handled',
+            'duration_ms': round((time.perf_counter() - started) * 1000, 2),
+        })
+
+def log_handled(logger):
+    """Decorator for bot handlers: sampling decision per update and one structured 'handled' event.
+
+    Works for both sync and async handlers; the handler's first argument is a Message or CallbackQuery.
+    """
+    def decorator(handler):
+        name = handler.__name__
+
+        def enter(update):
+            rate = _sample_rates.get(name, _default_rate)
+            sampled = rate >= 1.0 or random.random() < rate
+            return _context.set((name, update.from_user.id, sampled))
+
+        if inspect.iscoroutinefunction(handler):
+            @wraps(handler)
+            async def async_wrapper(update, *args, **kwargs):
+                token = enter(update)
+                started = time.perf_counter()
+                try:
+                    return await handler(update, *args, **kwargs)
+                finally:
+                    _log_handled(logger, name, started)
+                    _context.reset(token)
+            return async_wrapper
+
+        @wraps(handler)
+        def wrapper(update, *args, **kwargs):
+            token = enter(update)
+            started = time.perf_counter()
+            try:
+                return handler(update, *args, **kwargs)
+            finally:
+                _log_handled(logger, name, started)
+                _context.reset(token)
+        return wrapper
+    return decorator
@@ -4,13 +4,6 @@
 START_MESSAGE = ("Привет! Я бот, который помогает собраться в поход. "
                  "Начнем собираться или вы хотите посмотреть весь список?")
 PACK_START_MESSAGE = "Отлично, тогда начнем! Берите все по списку:"
-SHOW_FULL_LIST_PROMPT = """
-*Список вещей для похода:*
-
-{}
-
-Нажмите кнопку *«Собраться в поход»*, чтобы приступить к сбору рюкзака.
-"""
 PACKING_FINISHED_MESSAGE = "Ура, список закончился!"
 WHAT_NEXT_MESSAGE = "Что дальше?"
 ITEM_PROMPT = "{}"
@@ -19,6 +12,27 @@ CHOOSE_ITEM_TO_EDIT = "Выберите пункт для редактирова
 CHOOSE_ITEM_STATUS = "Выберите статус:"
 STATUS_UPDATED = "Статус обновлен"
 RESTART_PACKING_MESSAGE = "Давайте начнем сбор заново. Берите все по списку:"
+PACKING_PAGE_HEADER = "Предметы {}–{} из {}. Нажимайте на предмет, чтобы сменить статус:"
+MARK_ALL_ITEMS = "Отметьте все предметы на странице"
+PACKING_STEP_OUTDATED = "Этот предмет уже отмечен"
+GROUP_ONLY = "Общий сбор работает в групповом чате: добавьте бота в группу и отправьте /group."
+GROUP_SUMMARY = """Общий список для похода *{}*
+
+✅ {} ⏳ {} ❌ {} ❓ {}
+
+Предметы {}–{} из {}. Нажмите на предмет, чтобы взять его или сменить статус."""
+GROUP_LIST_OUTDATED = "Этот список уже не используется"
+GROUP_ITEM_UPDATED = "{}: {}"
+REMIND_USAGE = "Укажите дату выхода в поход: /remind 25.07.2026 или /remind 25.07.2026 08:00"
+REMIND_NOTHING = "В вашем списке нет вещей с отметкой «Позже» — напоминать не о чем."
+REMIND_IN_PAST = "Эта дата уже прошла. Укажите дату выхода в будущем."
+REMIND_SET = "Напомню о вещах «Позже» перед выходом {}."
+REMINDER_MESSAGE = "Скоро выход в поход *{}*! Не забудьте положить:\n\n{}"
+SEARCH_USAGE = "Напишите, что ищете, после команды: /search палатка"
+SEARCH_NOTHING_FOUND = "По запросу «{}» ничего не нашлось."
+SEARCH_RESULTS = "Поиск «{}»: найдено {}, страница {} из {}\n\n{}"
+SEARCH_OUTDATED = "Результаты поиска устарели, повторите /search"
+SEARCH_MORE_LISTS = "{} и ещё {}"
 UNKNOWN_COMMAND = "Извините, я не понимаю эту команду. Пожалуйста, используйте /start или /reset."
 BUTTON_BUY = "Купить"
 BUTTON_BUY_ONLINE = "Купить онлайн"
@@ -26,10 +40,12 @@ BUY_PROMPT = "Вы можете купить {} по ссылке ниже:"
 NO_BUY_LINK = "К сожалению, у нас нет ссылки для покупки этого предмета."
 CHOOSE_HIKE_TYPE = "Выберите тип похода:"
 HIKE_TYPE_SELECTED = "Вы выбрали: {}\n\n{}\n\nНачнем сбор снаряжения?"
-SHOW_FULL_LIST_PROMPT = """
+# Длинный список делится на несколько сообщений: заголовок в первом, подсказка в последнем
+FULL_LIST_HEADER = """
 *Список вещей для похода "{}"*:
 
-{}
+"""
+FULL_LIST_FOOTER = """
 
 Нажмите кнопку *«Собраться в поход»*, чтобы приступить к сбору рюкзака.
 """
@@ -52,12 +68,20 @@ BUTTON_EDIT_LIST = "Редактировать список"
 BUTTON_SHOW_FULL_LIST = "Посмотреть весь список"
 BUTTON_RESTART_PACKING = "Собраться заново"
 BUTTON_BACK = "Назад"
+BUTTON_NEXT_PAGE = "Далее ▶"
+BUTTON_PREV_PAGE = "◀ Назад"
 
 # Названия команд
 COMMAND_START = "start"
 COMMAND_RESET = "reset"
 COMMAND_START_DESCRIPTION = "Начать работу с ботом"
 COMMAND_RESET_DESCRIPTION = "Сбросить прогресс и начать заново"
+COMMAND_GROUP = "group"
+COMMAND_GROUP_DESCRIPTION = "Собраться в поход всей группой"
+COMMAND_REMIND = "remind"
+COMMAND_REMIND_DESCRIPTION = "Напомнить о вещах «Позже» перед выходом"
+COMMAND_SEARCH = "search"
+COMMAND_SEARCH_DESCRIPTION = "Найти вещь в каталоге"
 
 # Форматирование списков
 PACKING_RESULT = """Вот, что получилось:
@@ -0,0 +1,244 @@
+import json
+import time
+import bisect
+import inspect
+import logging
+import threading
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+# Границы бакетов гистограмм задержки, секунды
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_values, value in items:
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {value}')
+        return lines
+
+class Histogram:
+    """Cumulative buckets are built at render time, observe() only bumps a single bucket."""
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [counts per bucket + overflow, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((key, (list(counts), total)) for key, (counts, total) in self._series.items())
+        for label_values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _format_labels(self.labels + ('le',), label_values + (bound,))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+class Gauge:
+    """Value is read from a callback at scrape time."""
+
+    def __init__(self, name, documentation, read):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception as e:
+            logger.error("Failed to read gauge %s: %s", self.name, e)
+            return []
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge', f'{self.name} {value}']
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, read):
+        return self.register(Gauge(name, documentation, read))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+handler_duration = registry.register(Histogram(
+    'bot_handler_duration_seconds', 'Time spent in a bot handler.', ('handler',)))
+handler_errors = registry.register(Counter(
+    'bot_handler_errors_total', 'Exceptions raised by a bot handler.', ('handler',)))
+api_requests = registry.register(Counter(
+    'telegram_api_requests_total', 'Bot API calls by method and outcome.', ('method', 'outcome')))
+api_duration = registry.register(Histogram(
+    'telegram_api_request_duration_seconds', 'Bot API call latency, including rate limiter waits.', ('method',)))
+
+def track_handler(handler):
+    """Decorator for bot handlers: latency histogram and error counter labelled with the handler name."""
+    name = handler.__name__
+
+    if inspect.iscoroutinefunction(handler):
+        @wraps(handler)
+        async def async_wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await handler(*args, **kwargs)
+            except Exception:
+                handler_errors.inc(name)
+                raise
+            finally:
+                handler_duration.observe(time.perf_counter() - started, name)
+        return async_wrapper
+
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return handler(*args, **kwargs)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_duration.observe(time.perf_counter() - started, name)
+    return wrapper
+
+def count_handler_error(name):
+    """Count an error a handler caught itself and answered the user about; track_handler never sees it."""
+    handler_errors.inc(name)
+
+def _track_request(method_name, started, outcome):
+    api_requests.inc(method_name, outcome)
+    api_duration.observe(time.perf_counter() - started, method_name)
+
+def instrument_requests():
+    """Count and time every Bot API call of the sync TeleBot."""
+    from telebot import apihelper
+    make_request = apihelper._make_request
+    if getattr(make_request, 'instrumented', False):
+        return
+
+    @wraps(make_request)
+    def tracked(token, method_name, *args, **kwargs):
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = make_request(token, method_name, *args, **kwargs)
+            outcome = 'ok'
+            return result
+        finally:
+            _track_request(method_name, started, outcome)
+
+    tracked.instrumented = True
+    apihelper._make_request = tracked
+
+def instrument_async_requests():
+    """Count and time every Bot API call of AsyncTeleBot."""
+    from telebot import asyncio_helper
+    process_request = asyncio_helper._process_request
+    if getattr(process_request, 'instrumented', False):
+        return
+
+    @wraps(process_request)
+    async def tracked(token, url, *args, **kwargs):
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            result = await process_request(token, url, *args, **kwargs)
+            outcome = 'ok'
+            return result
+        finally:
+            _track_request(url, started, outcome)
+
+    tracked.instrumented = True
+    asyncio_helper._process_request = tracked
+
+def make_metrics_handler(registry, path='/metrics', ready=None, ready_path='/ready', report=None,
+                         report_path='/startup'):
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def _reply(self, status, body, content_type=CONTENT_TYPE):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == path:
+                self._reply(200, registry.render().encode('utf-8'))
+            elif ready is not None and self.path == ready_path:
+                # 503, пока бот не прогрел кэши и не начал принимать апдейты
+                if ready():
+                    self._reply(200, b'ready\n', 'text/plain')
+                else:
+                    self._reply(503, b'starting\n', 'text/plain')
+            elif report is not None and self.path == report_path:
+                self._reply(200, json.dumps(report()).encode('utf-8'), 'application/json')
+            else:
+                self.send_error(404)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+def start_metrics_server(host='127.0.0.1', port=9090, path='/metrics', ready=None, report=None):
+    """Serve the registry on http://host:port/metrics from a daemon thread.
+
+    ready is an optional callable for the /ready readiness probe, report an optional callable
+    whose dict is served as JSON on /startup.
+    """
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((host, port), make_metrics_handler(registry, path, ready, report=report))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info("Metrics available on http://%s:%s%s", host, server.server_address[1], path)
+    return server
@@ -0,0 +1,401 @@
+import json
+import time
+import heapq
+import logging
+import itertools
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import requests
+from telebot import apihelper
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Служебные вызовы не ограничиваем; вызовы без chat_id (ответы на callback и inline-запросы) идут только через общий лимит
+UNTHROTTLED_METHODS = {'getUpdates', 'getMe', 'setWebhook', 'deleteWebhook', 'setMyCommands', 'getMyCommands'}
+# Лимит сообщений в чат относится к новым сообщениям: правки и удаления идут только через общий лимит
+CHAT_EXEMPT_METHODS = {'editMessageText', 'editMessageReplyMarkup', 'deleteMessage'}
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        # Корзину могли создать позже момента, с которым её проверяют
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token can be taken."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self.tokens -= 1
+
+    def reserve(self, now):
+        """Take a token now, possibly going into debt; returns how long the caller must wait."""
+        self._refill(now)
+        self.tokens -= 1
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds, now):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+def get_retry_after(response):
+    try:
+        return float(response.json()['parameters']['retry_after'])
+    except Exception:
+        return 1.0
+
+def get_chat_key(params):
+    """Chat of a call as a string: telebot passes chat_id as a string to sends and as given to edits."""
+    chat_id = params.get('chat_id') if params else None
+    return None if chat_id is None else str(chat_id)
+
+def accepted_response(chat_id, method_name):
+    """Stand-in response for a deferred call: True for edits and answers, a message with message_id 0 for sends."""
+    result = True if chat_id is None or method_name in CHAT_EXEMPT_METHODS else {
+        'message_id': 0, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+    response = requests.Response()
+    response.status_code = 200
+    response._content = json.dumps({'ok': True, 'result': result}).encode()
+    return response
+
+class PendingCall:
+    __slots__ = ('method', 'url', 'params', 'kwargs', 'priority', 'queued', 'attempts')
+
+    def __init__(self, method, url, params, kwargs, priority):
+        self.method = method
+        self.url = url
+        self.params = params
+        self.kwargs = kwargs
+        self.priority = priority
+        self.queued = time.monotonic()
+        self.attempts = 0
+
+    @property
+    def method_name(self):
+        return self.url.rsplit('/', 1)[-1]
+
+class SendScheduler:
+    """Rate limiter for outgoing Bot API calls, installed as telebot's request sender.
+
+    Each chat has its own token bucket and all chats share a global one. Callers wait
+    for the global bucket in priority order, so interactive replies overtake bulk traffic.
+
+    A call over its chat's limit does not wait in the handler thread: it joins the chat's
+    queue, a pool of sender threads makes it once the chat has a token, and the handler gets
+    a stand-in result at once (handlers do not use the results of their sends). Later calls
+    of that chat queue behind it, so a chat's messages keep their order. A 429 response
+    blocks the chat for retry_after and the call is queued again. Calls without a chat
+    (callback and inline query answers) only take the global bucket; their 429 blocks it.
+    """
+
+    def __init__(self, global_rate=30.0, global_burst=30, chat_rate=1.0, chat_burst=3,
+                 max_retries=3, max_chats=100000, senders=4):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.senders = senders
+        self.stats = {'sent': 0, 'throttled': 0, 'deferred': 0, 'failed': 0,
+                      'waits': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+
+        self._chat_buckets = OrderedDict()
+        self._chat_lock = threading.Lock()
+        # chat_id -> очередь отложенных вызовов; чат в куче _ready, пока его очередь ждёт отправителя.
+        # Отправитель забирает чат из кучи целиком, поэтому вызовы одного чата не уходят параллельно.
+        # Отложенные вызовы без чата лежат в очереди с ключом None.
+        self._pending = {}
+        self._ready = []
+        self._ready_cond = threading.Condition(self._chat_lock)
+        self._sender_threads = []
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    @contextmanager
+    def priority(self, priority):
+        """Send every call made in this block from the current thread with the given priority."""
+        previous = getattr(self._local, 'priority', PRIORITY_INTERACTIVE)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def bulk(self):
+        return self.priority(PRIORITY_BULK)
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _chat_delay(self, chat_id, method_name, now):
+        """Seconds until the chat may make the call; takes the chat token when it is 0. Needs _chat_lock."""
+        if chat_id is None:
+            return 0.0
+        bucket = self._chat_bucket(chat_id)
+        if method_name in CHAT_EXEMPT_METHODS:
+            return max(0.0, bucket.blocked_until - now)
+        wait = bucket.delay(now)
+        if wait <= 0:
+            bucket.take()
+        return wait
+
+    def _reserve_chat(self, chat_id, method_name):
+        """Take the chat token now, possibly going into debt; returns how long the caller must wait."""
+        if chat_id is None:
+            return 0.0
+        now = time.monotonic()
+        with self._chat_lock:
+            bucket = self._chat_bucket(chat_id)
+            if method_name in CHAT_EXEMPT_METHODS:
+                return max(0.0, bucket.blocked_until - now)
+            return bucket.reserve(now)
+
+    def _reserve_global(self):
+        with self._cond:
+            return self.global_bucket.reserve(time.monotonic())
+
+    def _wait_for_global(self, priority):
+        with self._cond:
+            ticket = (priority, next(self._sequence))
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                if self._waiting[0] == ticket:
+                    wait = self.global_bucket.delay(time.monotonic())
+                    if wait <= 0:
+                        self.global_bucket.take()
+                        heapq.heappop(self._waiting)
+                        self._cond.notify_all()
+                        return
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+    def _block(self, chat_id, seconds):
+        if chat_id is None:
+            # 429 на вызов без чата — превышен общий лимит бота
+            with self._cond:
+                self.global_bucket.block(seconds, time.monotonic())
+            return
+        with self._chat_lock:
+            self._chat_bucket(chat_id).block(seconds, time.monotonic())
+
+    def _throttled(self, method_name, chat_id, retry_after):
+        self.stats['throttled'] += 1
+        logger.warning("Flood limit on %s for chat %s, retry after %s s", method_name, chat_id, retry_after)
+        self._block(chat_id, retry_after)
+
+    def _record_wait(self, seconds):
+        self.stats['waits'] += 1
+        self.stats['wait_seconds'] += seconds
+        if seconds > self.stats['max_wait_seconds']:
+            self.stats['max_wait_seconds'] = seconds
+
+    def _request(self, method, url, **kwargs):
+        return apihelper._get_req_session().request(method, url, **kwargs)
+
+    def _send_now(self, chat_id, call):
+        self._wait_for_global(call.priority)
+        self._record_wait(time.monotonic() - call.queued)
+        response = self._request(call.method, call.url, params=call.params, **call.kwargs)
+        if response.status_code == 429:
+            self._throttled(call.method_name, chat_id, get_retry_after(response))
+        else:
+            self.stats['sent'] += 1
+        return response
+
+    def _defer(self, chat_id, call):
+        """Queue the call for the sender threads. Needs _chat_lock."""
+        pending = self._pending.get(chat_id)
+        if pending is None:
+            pending = self._pending[chat_id] = deque()
+            heapq.heappush(self._ready, (time.monotonic(), next(self._sequence), chat_id))
+            self._ready_cond.notify()
+        pending.append(call)
+        self.stats['deferred'] += 1
+        if not self._sender_threads:
+            for number in range(self.senders):
+                sender = threading.Thread(target=self._send_loop, name=f'send-scheduler-{number}', daemon=True)
+                sender.start()
+                self._sender_threads.append(sender)
+
+    def send(self, method, url, params=None, **kwargs):
+        method_name = url.rsplit('/', 1)[-1]
+        if method_name in UNTHROTTLED_METHODS:
+            return self._request(method, url, params=params, **kwargs)
+
+        chat_id = get_chat_key(params)
+        call = PendingCall(method, url, params, kwargs, getattr(self._local, 'priority', PRIORITY_INTERACTIVE))
+        if chat_id is not None:
+            with self._chat_lock:
+                # Пока у чата есть отложенные вызовы, новые встают за ними
+                if chat_id in self._pending or self._chat_delay(chat_id, method_name, call.queued) > 0:
+                    self._defer(chat_id, call)
+                    return accepted_response(chat_id, method_name)
+
+        response = self._send_now(chat_id, call)
+        if response.status_code == 429 and self.max_retries:
+            call.attempts += 1
+            with self._chat_lock:
+                self._defer(chat_id, call)
+            return accepted_response(chat_id, method_name)
+        return response
+
+    def _next_ready(self):
+        """Wait for the next chat whose first queued call may be sent; returns the chat and the call."""
+        with self._ready_cond:
+            while True:
+                now = time.monotonic()
+                if not self._ready:
+                    self._ready_cond.wait()
+                    continue
+                ready_at, _, chat_id = self._ready[0]
+                if ready_at > now:
+                    self._ready_cond.wait(ready_at - now)
+                    continue
+                heapq.heappop(self._ready)
+                pending = self._pending[chat_id]
+                wait = self._chat_delay(chat_id, pending[0].method_name, now)
+                if wait > 0:
+                    heapq.heappush(self._ready, (now + wait, next(self._sequence), chat_id))
+                    continue
+                return chat_id, pending.popleft()
+
+    def _send_deferred(self, chat_id, call):
+        response = self._send_now(chat_id, call)
+        if response.status_code == 429 and call.attempts < self.max_retries:
+            call.attempts += 1
+            return False
+        if response.status_code == 400 and call.params.get('parse_mode') and 'parse entities' in response.text:
+            # Вызывавший хендлер уже не поймает ошибку разметки, поэтому повторяем без неё, как хендлеры
+            logger.error("Failed to send deferred %s with Markdown. Sending without formatting.", call.method_name)
+            call.params = {key: value for key, value in call.params.items() if key != 'parse_mode'}
+            response = self._send_now(chat_id, call)
+        if response.status_code != 200:
+            self.stats['failed'] += 1
+            logger.error("Deferred %s to chat %s failed: %s %s", call.method_name, chat_id,
+                         response.status_code, response.text)
+        return True
+
+    def _send_loop(self):
+        while True:
+            chat_id, call = self._next_ready()
+            try:
+                sent = self._send_deferred(chat_id, call)
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error("Deferred %s to chat %s failed: %s", call.method_name, chat_id, e)
+                sent = True
+            with self._ready_cond:
+                pending = self._pending[chat_id]
+                if not sent:
+                    pending.appendleft(call)
+                if pending:
+                    heapq.heappush(self._ready, (time.monotonic(), next(self._sequence), chat_id))
+                    self._ready_cond.notify()
+                else:
+                    del self._pending[chat_id]
+
+    def pending(self):
+        with self._chat_lock:
+            return sum(len(pending) for pending in self._pending.values())
+
+    def has_pending(self, chat_id):
+        """True while the chat has deferred calls that are not made yet, including the one being sent."""
+        with self._chat_lock:
+            return get_chat_key({'chat_id': chat_id}) in self._pending
+
+    def drain(self, timeout=None):
+        """Wait until every deferred call is made. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._pending:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def metrics(self):
+        with self._cond:
+            depth = len(self._waiting)
+        depth += self.pending()
+        waits = self.stats['waits']
+        return {
+            'queue_depth': depth,
+            'sent': self.stats['sent'],
+            'throttled': self.stats['throttled'],
+            'deferred': self.stats['deferred'],
+            'failed': self.stats['failed'],
+            'avg_wait_seconds': self.stats['wait_seconds'] / waits if waits else 0.0,
+            'max_wait_seconds': self.stats['max_wait_seconds'],
+        }
+
+    def install(self):
+        apihelper.CUSTOM_REQUEST_SENDER = self.send
+
+class AsyncSendScheduler:
+    """SendScheduler front-end for AsyncTeleBot: the same buckets and stats, but waits are awaits.
+
+    A throttled chat only delays its own handler, which chat_ordered serializes anyway, so no
+    sender threads are needed. Calls of the sync client (reminders) share the global bucket.
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+
+    async def send(self, process_request, token, url, method='get', params=None, *args, **kwargs):
+        # asyncio нужен только асинхронному боту, синхронный его не импортирует
+        import asyncio
+        scheduler = self.scheduler
+        if url in UNTHROTTLED_METHODS:
+            return await process_request(token, url, method, params, *args, **kwargs)
+
+        chat_id = get_chat_key(params)
+
+        for attempt in range(scheduler.max_retries + 1):
+            queued = time.monotonic()
+            await asyncio.sleep(scheduler._reserve_chat(chat_id, url))
+            await asyncio.sleep(scheduler._reserve_global())
+            scheduler._record_wait(time.monotonic() - queued)
+            try:
+                result = await process_request(token, url, method, params, *args, **kwargs)
+            except Exception as e:
+                # asyncio_helper бросает свой ApiTelegramException, поэтому сверяем только код ошибки
+                if getattr(e, 'error_code', None) != 429 or attempt == scheduler.max_retries:
+                    raise
+                retry_after = float((e.result_json.get('parameters') or {}).get('retry_after', 1))
+                scheduler._throttled(url, chat_id, retry_after)
+                continue
+            scheduler.stats['sent'] += 1
+            return result
+
+    def install(self):
+        from telebot import asyncio_helper
+        process_request = asyncio_helper._process_request
+
+        async def limited(token, url, *args, **kwargs):
+            return await self.send(process_request, token, url, *args, **kwargs)
+
+        asyncio_helper._process_request = limited
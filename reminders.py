@@ -0,0 +1,226 @@
+import time
+import heapq
+import logging
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+# Очередь напоминаний по времени отправки
+
+class ReminderQueue:
+    """Reminders ordered by due time (unix seconds). A user has at most one departure,
+    so cancel() drops every pending reminder of the user."""
+
+    def add(self, due_at, user_id, chat_id):
+        raise NotImplementedError
+
+    def cancel(self, user_id):
+        raise NotImplementedError
+
+    def pop_due(self, now, limit):
+        """Remove and return up to `limit` reminders due by `now` as (due_at, user_id, chat_id)."""
+        raise NotImplementedError
+
+    def next_due(self):
+        """Due time of the earliest reminder, None when the queue is empty."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __len__(self):
+        raise NotImplementedError
+
+class MemoryReminderQueue(ReminderQueue):
+    """Binary heap; cancelled reminders stay in it and are skipped when they come up."""
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+        # user_id -> поколение напоминаний; отмена увеличивает его
+        self._generations = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, due_at, user_id, chat_id):
+        with self._lock:
+            generation = self._generations.get(user_id, 0)
+            heapq.heappush(self._heap, (due_at, next(self._sequence), user_id, chat_id, generation))
+            self._pending[user_id] = self._pending.get(user_id, 0) + 1
+
+    def cancel(self, user_id):
+        with self._lock:
+            if self._pending.pop(user_id, None):
+                self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def _drop_cancelled(self):
+        while self._heap and self._heap[0][4] != self._generations.get(self._heap[0][2], 0):
+            heapq.heappop(self._heap)
+
+    def pop_due(self, now, limit):
+        due = []
+        with self._lock:
+            self._drop_cancelled()
+            while self._heap and self._heap[0][0] <= now and len(due) < limit:
+                due_at, _, user_id, chat_id, _ = heapq.heappop(self._heap)
+                due.append((due_at, user_id, chat_id))
+                left = self._pending[user_id] - 1
+                if left:
+                    self._pending[user_id] = left
+                else:
+                    del self._pending[user_id]
+                self._drop_cancelled()
+        return due
+
+    def next_due(self):
+        with self._lock:
+            self._drop_cancelled()
+            return self._heap[0][0] if self._heap else None
+
+    def __len__(self):
+        return sum(self._pending.values())
+
+class SQLiteReminderQueue(ReminderQueue):
+    """Table indexed on due_at; pop_due selects and deletes a batch in one transaction,
+    so several processes can share the database without sending a reminder twice."""
+
+    def __init__(self, path):
+        import sqlite3
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS reminders ('
+                         'id INTEGER PRIMARY KEY, due_at REAL NOT NULL, user_id INTEGER NOT NULL, '
+                         'chat_id INTEGER NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS reminders_due_at ON reminders (due_at)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS reminders_user_id ON reminders (user_id)')
+        self._lock = threading.Lock()
+
+    def add(self, due_at, user_id, chat_id):
+        with self._lock:
+            self._db.execute('INSERT INTO reminders (due_at, user_id, chat_id) VALUES (?, ?, ?)',
+                             (due_at, user_id, chat_id))
+
+    def cancel(self, user_id):
+        with self._lock:
+            self._db.execute('DELETE FROM reminders WHERE user_id = ?', (user_id,))
+
+    def pop_due(self, now, limit):
+        with self._lock:
+            # IMMEDIATE сразу берёт блокировку записи: другой процесс не выберет ту же пачку
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._db.execute('SELECT id, due_at, user_id, chat_id FROM reminders '
+                                        'WHERE due_at <= ? ORDER BY due_at LIMIT ?', (now, limit)).fetchall()
+                self._db.executemany('DELETE FROM reminders WHERE id = ?', [(row[0],) for row in rows])
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return [row[1:] for row in rows]
+
+    def next_due(self):
+        with self._lock:
+            return self._db.execute('SELECT MIN(due_at) FROM reminders').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM reminders').fetchone()[0]
+
+def create_reminder_queue(backend, path='sessions.db'):
+    if backend == 'sqlite':
+        return SQLiteReminderQueue(path)
+    if backend == 'memory':
+        return MemoryReminderQueue()
+    raise ValueError(f"Unknown reminder backend: {backend}")
+
+# Отправка
+
+class ReminderEngine:
+    """Sends due reminders: a scheduler thread takes them from the queue in batches
+    and a worker pool calls send(user_id, chat_id) for each one.
+
+    Sends go through the bot's rate limiter, so the pool size only bounds the number of
+    calls in flight; throughput is set by the global rate limit and the API latency.
+    send() returns False when there was nothing to remind about.
+    """
+
+    def __init__(self, queue, send, workers=8, batch_size=500, poll_interval=1.0):
+        self.queue = queue
+        self.send = send
+        self.workers = workers
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.stats = {'sent': 0, 'skipped': 0, 'failed': 0}
+
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._pool = None
+        self._thread = None
+
+    def schedule(self, user_id, chat_id, departure, leads):
+        """Replace the user's reminders with one per lead time (seconds before departure).
+        Returns how many are still in the future."""
+        self.queue.cancel(user_id)
+        now = time.time()
+        scheduled = 0
+        for lead in leads:
+            if departure - lead > now:
+                self.queue.add(departure - lead, user_id, chat_id)
+                scheduled += 1
+        return scheduled
+
+    def cancel(self, user_id):
+        self.queue.cancel(user_id)
+
+    def _count(self, outcome):
+        with self._stats_lock:
+            self.stats[outcome] += 1
+
+    def _send(self, user_id, chat_id):
+        try:
+            self._count('sent' if self.send(user_id, chat_id) is not False else 'skipped')
+        except Exception as e:
+            self._count('failed')
+            logger.error("Failed to send reminder to user %s: %s", user_id, e)
+
+    def run_due(self, now=None):
+        """Send everything due by now, batch by batch. Returns the number of reminders taken."""
+        taken = 0
+        while not self._stop.is_set():
+            batch = self.queue.pop_due(time.time() if now is None else now, self.batch_size)
+            if not batch:
+                break
+            # Следующая пачка берётся после отправки текущей: очередь пула не растёт без предела
+            wait([self._pool.submit(self._send, user_id, chat_id) for _, user_id, chat_id in batch])
+            taken += len(batch)
+        return taken
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_due()
+                next_due = self.queue.next_due()
+            except Exception as e:
+                logger.error("Reminder scheduler failed: %s", e)
+                next_due = None
+            delay = self.poll_interval if next_due is None else min(self.poll_interval, next_due - time.time())
+            self._stop.wait(max(delay, 0))
+
+    def start(self):
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='reminder')
+        self._thread = threading.Thread(target=self._run, name='reminders', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._pool.shutdown(wait=True)
+        self.queue.close()
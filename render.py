@@ -0,0 +1,194 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+class RenderCache:
+    """Rendered message texts and serialized reply_markup JSON.
+
+    Keys start with the catalog version, so entries of different catalog snapshots never mix;
+    clear() drops everything when a new snapshot is swapped in.
+    """
+
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'clears': 0}
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        value = self._entries.get(key)
+        if value is not None:
+            self.stats['hits'] += 1
+            return value
+        self.stats['misses'] += 1
+        value = build()
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()
+            self._entries[key] = value
+        return value
+
+    def clear(self, snapshot=None):
+        with self._lock:
+            self._entries.clear()
+        self.stats['clears'] += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+class MessageStates:
+    """Hash of the last text and markup put into each bot message, to skip edits that change nothing.
+
+    Every edit of a tracked message has to go through changed()/remember(), otherwise
+    the stored hash goes stale and a real change could be skipped.
+    """
+
+    def __init__(self, max_size=50000):
+        self.max_size = max_size
+        self.stats = {'skipped': 0}
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def changed(self, chat_id, message_id, *content):
+        """False when the message already shows this content; such an edit is counted as skipped."""
+        if self._hashes.get((chat_id, message_id)) == hash(content):
+            self.stats['skipped'] += 1
+            return False
+        return True
+
+    def remember(self, chat_id, message_id, *content):
+        key = (chat_id, message_id)
+        with self._lock:
+            self._hashes[key] = hash(content)
+            self._hashes.move_to_end(key)
+            if len(self._hashes) > self.max_size:
+                self._hashes.popitem(last=False)
+
+    def forget(self, chat_id, message_id):
+        with self._lock:
+            self._hashes.pop((chat_id, message_id), None)
+
+    def __len__(self):
+        return len(self._hashes)
+
+class SearchQueries:
+    """Recent /search queries by a short key that fits into callback_data, least recently used dropped first."""
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._queries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, query):
+        key = hashlib.md5(query.encode()).hexdigest()[:10]
+        with self._lock:
+            self._queries[key] = query
+            self._queries.move_to_end(key)
+            if len(self._queries) > self.max_size:
+                self._queries.popitem(last=False)
+        return key
+
+    def get(self, key):
+        with self._lock:
+            query = self._queries.get(key)
+            if query is not None:
+                self._queries.move_to_end(key)
+            return query
+
+    def __len__(self):
+        return len(self._queries)
+
+class Debouncer:
+    """Coalesces calls per key: the first call runs after `delay` seconds, later ones until then are dropped.
+
+    The delayed function should read the state it renders when it runs, so the single
+    call still shows the result of every coalesced tap. delay 0 runs immediately.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.stats = {'scheduled': 0, 'coalesced': 0}
+        self._pending = {}
+        self._running = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+
+    def schedule(self, key, run):
+        if self.delay <= 0:
+            run()
+            return
+        with self._lock:
+            if key in self._pending:
+                self.stats['coalesced'] += 1
+                return
+            timer = self._pending[key] = threading.Timer(self.delay, self._fire, (key, run))
+        self.stats['scheduled'] += 1
+        timer.daemon = True
+        timer.start()
+
+    def _fire(self, key, run):
+        # Ключ снимается до вызова: нажатие во время правки запланирует следующую
+        with self._lock:
+            self._pending.pop(key, None)
+            self._running += 1
+        try:
+            run()
+        except Exception:
+            logger.exception("Debounced call for %s failed", key)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._idle.notify_all()
+
+    def cancel(self, key):
+        """Drop a pending call, e.g. before the message it would edit is deleted."""
+        with self._lock:
+            timer = self._pending.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+    def flush(self):
+        """Run every pending call now and wait for the ones already running, e.g. before shutdown."""
+        with self._lock:
+            timers = list(self._pending.values())
+            self._pending.clear()
+        for timer in timers:
+            timer.cancel()
+            self._fire(*timer.args)
+        with self._idle:
+            self._idle.wait_for(lambda: self._running == 0)
+
+class AsyncDebouncer(Debouncer):
+    """Debouncer for coroutine functions, scheduled on the running event loop."""
+
+    def __init__(self, delay):
+        super().__init__(delay)
+        self._tasks = set()
+
+    async def schedule(self, key, run):
+        if self.delay <= 0:
+            await run()
+            return
+        if key in self._pending:
+            self.stats['coalesced'] += 1
+            return
+        # asyncio нужен только асинхронному боту, синхронный его не импортирует
+        import asyncio
+        self.stats['scheduled'] += 1
+        self._pending[key] = asyncio.get_running_loop().call_later(self.delay, self._fire, key, run)
+
+    def _fire(self, key, run):
+        import asyncio
+        self._pending.pop(key, None)
+        task = asyncio.ensure_future(run())
+        # Держим ссылку на задачу, пока она не завершится
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def cancel(self, key):
+        handle = self._pending.pop(key, None)
+        if handle is not None:
+            handle.cancel()
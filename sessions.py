@@ -0,0 +1,403 @@
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+from messages import BUTTON_TAKE, BUTTON_TAKE_LATER, BUTTON_SKIP
+
+logger = logging.getLogger(__name__)
+
+# Статусы предметов
+
+STATUS_TAKE = 1
+STATUS_TAKE_LATER = 2
+STATUS_SKIP = 3
+
+STATUS_CODES = {
+    BUTTON_TAKE.lower(): STATUS_TAKE,
+    BUTTON_TAKE_LATER.lower(): STATUS_TAKE_LATER,
+    BUTTON_SKIP.lower(): STATUS_SKIP,
+}
+
+STATUS_ICONS = {
+    STATUS_TAKE: "✅",
+    STATUS_TAKE_LATER: "⏳",
+    STATUS_SKIP: "❌",
+}
+
+# Следующий статус при нажатии на кнопку предмета без выбранного статуса
+NEXT_STATUS = {0: STATUS_TAKE, STATUS_TAKE: STATUS_TAKE_LATER, STATUS_TAKE_LATER: STATUS_SKIP, STATUS_SKIP: STATUS_TAKE}
+
+def get_status_code(status):
+    return STATUS_CODES.get(status.lower())
+
+# Версия сессии — update_id последнего применённого апдейта.
+# После недели без апдейтов Telegram начинает нумерацию со случайного id, поэтому
+# id намного меньше версии считается новой последовательностью, а не запоздавшим апдейтом.
+STALE_UPDATE_WINDOW = 1000000
+
+_version_lock = threading.Lock()
+
+# Сессия
+
+class Session:
+    """Compact packing session: one status byte per item instead of a dict of responses.
+
+    current_list is a reference to the list of the catalog snapshot the session started on;
+    it is shared between sessions, not copied. version is the update_id of the last update
+    applied to the session.
+    """
+
+    __slots__ = ('current_list', 'catalog_version', 'progress', 'statuses', 'version')
+
+    def __init__(self, current_list, catalog_version, progress=0, statuses=None, version=0):
+        self.current_list = current_list
+        self.catalog_version = catalog_version
+        self.progress = progress
+        self.statuses = bytearray(statuses) if statuses is not None else bytearray(len(current_list['items']))
+        self.version = version
+
+    @property
+    def list_id(self):
+        return self.current_list['id']
+
+    def accept(self, update_id):
+        """Optimistic version check before handling an update.
+
+        Moves the version to update_id and returns True, or returns False for a duplicate
+        or an update older than the last applied one. Updates without an id are accepted.
+        """
+        if update_id is None:
+            return True
+        with _version_lock:
+            if 0 <= self.version - update_id < STALE_UPDATE_WINDOW:
+                return False
+            self.version = update_id
+            return True
+
+    def set_status(self, index, code):
+        """Update one item's status. Returns False when nothing changed."""
+        if self.statuses[index] == code:
+            return False
+        self.statuses[index] = code
+        return True
+
+    def has_responses(self):
+        return self.statuses.count(0) != len(self.statuses)
+
+    def indexes(self, code):
+        """Indexes of items with the given status, in list order."""
+        found = []
+        index = self.statuses.find(code)
+        while index != -1:
+            found.append(index)
+            index = self.statuses.find(code, index + 1)
+        return found
+
+    def counts(self):
+        return {code: self.statuses.count(code) for code in STATUS_ICONS}
+
+    def __sizeof__(self):
+        return object.__sizeof__(self) + self.statuses.__sizeof__()
+
+# Сериализация сессии
+
+def dump_session(session):
+    """Persistable part of a session: the list is stored by id, not as the whole dict."""
+    return json.dumps({
+        'list_id': session.list_id,
+        'progress': session.progress,
+        'statuses': session.statuses.hex(),
+        'version': session.version,
+    })
+
+def load_session(payload, resolve_list):
+    data = json.loads(payload)
+    resolved = resolve_list(data['list_id'])
+    if resolved is None:
+        return None
+    current_list, catalog_version = resolved
+    if 'statuses' in data:
+        statuses = bytes.fromhex(data['statuses'])
+        if len(statuses) == len(current_list['items']):
+            return Session(current_list, catalog_version, data['progress'], statuses, data.get('version', 0))
+        # Список в каталоге изменился — прогресс по индексам больше не соответствует предметам
+        return None
+    # Старый формат: ответы по индексам предметов
+    session = Session(current_list, catalog_version, data['progress'])
+    for index, code in data['responses'].items():
+        session.set_status(int(index), code)
+    return session
+
+# Интерфейс хранилища
+
+class SessionStore:
+    """Storage for per-user packing sessions.
+
+    get() returns a Session or None. Handlers mutate the returned Session in place
+    and call save() to persist it; backends that serialize use dump_session()/load_session().
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+
+    def get(self, user_id):
+        raise NotImplementedError
+
+    def save(self, user_id, session):
+        raise NotImplementedError
+
+    def delete(self, user_id):
+        raise NotImplementedError
+
+    def evict_expired(self):
+        return 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __len__(self):
+        raise NotImplementedError
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, ttl=None):
+        super().__init__(ttl)
+        self._sessions = {}
+        self._touched = {}
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session is not None:
+            self._touched[user_id] = time.monotonic()
+        return session
+
+    def save(self, user_id, session):
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[user_id] = session
+            self._touched[user_id] = now
+        if self.ttl and now - self._last_sweep >= min(self.ttl, 60):
+            self._last_sweep = now
+            self.evict_expired()
+
+    def delete(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+            self._touched.pop(user_id, None)
+
+    def evict_expired(self):
+        if not self.ttl:
+            return 0
+        deadline = time.monotonic() - self.ttl
+        with self._lock:
+            expired = [user_id for user_id, touched in self._touched.items() if touched < deadline]
+            for user_id in expired:
+                self._sessions.pop(user_id, None)
+                self._touched.pop(user_id, None)
+        return len(expired)
+
+    def __len__(self):
+        return len(self._sessions)
+
+# Не больше параметров в одном запросе, чем разрешает любая сборка SQLite (999)
+SQLITE_BATCH_VARIABLES = 500
+
+class SQLiteSessionStore(SessionStore):
+    """SQLite-backed store: WAL journal, LRU cache in front, group commit from a writer thread."""
+
+    def __init__(self, path, resolve_list, ttl=None, cache_size=10000,
+                 flush_interval=0.5, batch_size=500):
+        super().__init__(ttl)
+        self.path = path
+        self.resolve_list = resolve_list
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.stats = {'commits': 0, 'rows_written': 0, 'cache_hits': 0, 'cache_misses': 0}
+
+        self._cache = OrderedDict()
+        # user_id -> сериализованная сессия или None для удаления
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+
+        # sqlite3 нужен только этому бэкенду, поэтому импортируется при создании хранилища
+        import sqlite3
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS sessions ('
+                         'user_id INTEGER PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at)')
+        # Число строк считается один раз, дальше его ведут flush() и evict_expired()
+        self._count = self._db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+        self._writer = threading.Thread(target=self._write_loop, name='session-writer', daemon=True)
+        self._writer.start()
+
+    def _remember(self, user_id, session):
+        self._cache[user_id] = session
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, user_id):
+        with self._lock:
+            if user_id in self._cache:
+                self._cache.move_to_end(user_id)
+                self.stats['cache_hits'] += 1
+                return self._cache[user_id]
+            self.stats['cache_misses'] += 1
+            payload = self._pending.get(user_id, False)
+        if payload is None:
+            return None
+        if payload is False:
+            with self._db_lock:
+                row = self._db.execute('SELECT data FROM sessions WHERE user_id = ?', (user_id,)).fetchone()
+            if row is None:
+                return None
+            payload = row[0]
+        session = load_session(payload, self.resolve_list)
+        if session is not None:
+            with self._lock:
+                self._remember(user_id, session)
+        return session
+
+    def save(self, user_id, session):
+        payload = dump_session(session)
+        with self._lock:
+            self._remember(user_id, session)
+            self._pending[user_id] = payload
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def delete(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
+            self._pending[user_id] = None
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        now = time.time()
+        upserts = [(user_id, payload, now) for user_id, payload in pending.items() if payload is not None]
+        deletes = [(user_id,) for user_id, payload in pending.items() if payload is None]
+        with self._db_lock:
+            # Одна транзакция на пачку изменений — один fsync вместо одного на каждое нажатие
+            self._db.execute('BEGIN')
+            try:
+                existing = 0
+                for start in range(0, len(upserts), SQLITE_BATCH_VARIABLES):
+                    user_ids = [row[0] for row in upserts[start:start + SQLITE_BATCH_VARIABLES]]
+                    existing += self._db.execute(
+                        f"SELECT COUNT(*) FROM sessions WHERE user_id IN ({','.join('?' * len(user_ids))})",
+                        user_ids).fetchone()[0]
+                self._db.executemany('INSERT INTO sessions (user_id, data, updated_at) VALUES (?, ?, ?) '
+                                     'ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, '
+                                     'updated_at = excluded.updated_at', upserts)
+                deleted = self._db.executemany('DELETE FROM sessions WHERE user_id = ?', deletes).rowcount
+                self._db.execute('COMMIT')
+                self._count += len(upserts) - existing - max(deleted, 0)
+            except Exception:
+                self._db.execute('ROLLBACK')
+                with self._lock:
+                    # Возвращаем несохранённые изменения, не затирая более свежие
+                    for user_id, payload in pending.items():
+                        self._pending.setdefault(user_id, payload)
+                raise
+        self.stats['commits'] += 1
+        self.stats['rows_written'] += len(pending)
+
+    def evict_expired(self):
+        if not self.ttl:
+            return 0
+        deadline = time.time() - self.ttl
+        with self._db_lock:
+            expired = [row[0] for row in self._db.execute(
+                'SELECT user_id FROM sessions WHERE updated_at < ?', (deadline,))]
+            self._count -= self._db.execute('DELETE FROM sessions WHERE updated_at < ?', (deadline,)).rowcount
+        with self._lock:
+            for user_id in expired:
+                if user_id not in self._pending:
+                    self._cache.pop(user_id, None)
+        return len(expired)
+
+    def _write_loop(self):
+        last_sweep = time.monotonic()
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                if self.ttl and time.monotonic() - last_sweep >= min(self.ttl, 60):
+                    evicted = self.evict_expired()
+                    if evicted:
+                        logger.info("Evicted %s idle sessions", evicted)
+                    last_sweep = time.monotonic()
+            except Exception as e:
+                logger.error("Failed to write sessions: %s", e)
+
+    def close(self):
+        self._stop.set()
+        self._wakeup.set()
+        self._writer.join()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    def __len__(self):
+        """Sessions in the database as of the last commit; writes still waiting for the writer are not counted.
+
+        The count follows this store's own writes, so writes of other processes sharing the file are missed.
+        """
+        return self._count
+
+class AsyncSessionStore:
+    """Session store for the async bot.
+
+    Calls of a store that does I/O (SQLite) run in the default executor, so a query or a
+    flush does not block the event loop; the in-memory store is called directly.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._offload = not isinstance(store, MemorySessionStore)
+
+    async def _call(self, method, *args):
+        if self._offload:
+            # asyncio нужен только асинхронному боту, синхронный его не импортирует
+            import asyncio
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def get(self, user_id):
+        return await self._call(self.store.get, user_id)
+
+    async def save(self, user_id, session):
+        await self._call(self.store.save, user_id, session)
+
+    async def delete(self, user_id):
+        await self._call(self.store.delete, user_id)
+
+    def close(self):
+        self.store.close()
+
+    def __len__(self):
+        return len(self.store)
+
+def create_session_store(backend, resolve_list, path='sessions.db', ttl=None, cache_size=10000):
+    if backend == 'sqlite':
+        return SQLiteSessionStore(path, resolve_list, ttl=ttl, cache_size=cache_size)
+    if backend == 'memory':
+        return MemorySessionStore(ttl=ttl)
+    raise ValueError(f"Unknown session backend: {backend}")
@@ -0,0 +1,285 @@
+import os
+import time
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+import startup
+from telebot import apihelper
+import metrics
+from logs import setup_logging, stop_logging
+
+# Шардированный режим: фронт (webhook или long polling) раскладывает апдейты по hash(chat_id)
+# на SHARDS процессов. У каждого процесса свой бот, свой пул обработчиков и своё хранилище сессий.
+# Запуск: SHARDS=4 python shards.py
+# SIGHUP — поочерёдный перезапуск шардов, SIGTERM — остановка с дообработкой очередей.
+# Меню команд синхронизирует фронт, один раз на все шарды.
+
+logger = logging.getLogger(__name__)
+
+SHARDS = int(os.environ.get('SHARDS', str(os.cpu_count() or 1)))
+SHARD_QUEUE_SIZE = int(os.environ.get('SHARD_QUEUE_SIZE', '10000'))
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', os.environ.get('WEBHOOK_WORKERS', '8')))
+SHARD_DRAIN_TIMEOUT = float(os.environ.get('SHARD_DRAIN_TIMEOUT', '30'))
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', '20'))
+
+def get_update_chat_id(data):
+    """Chat id of a raw update dict, without building telebot objects in the front process."""
+    for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+        if key in data:
+            return data[key]['chat']['id']
+    callback_query = data.get('callback_query')
+    if callback_query:
+        message = callback_query.get('message')
+        return message['chat']['id'] if message else callback_query['from']['id']
+    for key in ('inline_query', 'chosen_inline_result'):
+        if key in data:
+            return data[key]['from']['id']
+    return data['update_id']
+
+def shard_env(index, shards):
+    """Environment overrides of one shard process."""
+    env = {
+        'SHARD_INDEX': str(index),
+        # Параллельность внутри шарда даёт UpdateDispatcher, а не пул потоков telebot
+        'BOT_MODE': 'webhook',
+        # Глобальный лимит Telegram делится между процессами
+        'RATE_LIMIT_GLOBAL': str(float(os.environ.get('RATE_LIMIT_GLOBAL', '30')) / shards),
+        'METRICS_PORT': str(int(os.environ.get('METRICS_PORT', '9090')) + 1 + index),
+    }
+    # 'sessions-{shard}.db' — своя база у каждого шарда, путь без {shard} — общая база.
+    # С общей базой шард считает сессии при старте по всей базе, а дальше учитывает только свои записи,
+    # поэтому bot_active_sessions шарда верен только со своей базой у каждого шарда.
+    session_path = os.environ.get('SESSION_DB_PATH', 'sessions.db')
+    env['SESSION_DB_PATH'] = session_path.replace('{shard}', str(index))
+    # Апдейты чата всегда приходят в один шард, поэтому кольцо update_id у каждого шарда своё
+    dedupe_path = os.environ.get('DEDUPE_PATH')
+    if dedupe_path:
+        env['DEDUPE_PATH'] = (dedupe_path.replace('{shard}', str(index)) if '{shard}' in dedupe_path
+                              else f"{dedupe_path}.{index}")
+    return env
+
+def run_shard(index, updates, env):
+    """Shard process: reads raw updates from its queue until the None sentinel, then drains."""
+    os.environ.update(env)
+    # Сигналы обрабатывает фронт и останавливает шарды через очередь
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    import bot
+    from webhook import UpdateDispatcher
+
+    dispatcher = UpdateDispatcher(bot.process_update, workers=SHARD_WORKERS, queue_size=SHARD_QUEUE_SIZE,
+                                  put_timeout=None)
+    if bot.METRICS_ENABLED:
+        metrics.start_metrics_server(bot.METRICS_HOST, bot.METRICS_PORT, ready=startup.timer.is_ready,
+                                     report=startup.timer.report)
+    dispatcher.start()
+    bot.catalog.start_watching()
+    bot.reminder_engine.start()
+    bot.warm_caches()
+    startup.timer.mark('warmup')
+    startup.watch_first_update(bot.bot)
+    startup.timer.set_ready()
+    bot.build_search_index()
+    bot.catalog.add_listener(bot.build_search_index)
+    logger.info("Shard %s started with pid %s", index, os.getpid())
+    try:
+        while True:
+            data = updates.get()
+            if data is None:
+                break
+            try:
+                dispatcher.submit_json(data)
+            except Exception as e:
+                logger.error("Invalid update in shard %s: %s", index, e)
+    finally:
+        dispatcher.stop()
+        bot.catalog.stop_watching()
+        bot.reminder_engine.stop()
+        bot.user_data.close()
+        bot.seen_updates.close()
+        logger.info("Shard %s drained", index)
+        stop_logging()
+
+class ShardedDispatcher:
+    """Routes raw updates by chat id to shard processes, one bounded IPC queue per shard.
+
+    A chat always lands on the same shard, so its updates stay ordered and its session
+    lives in one process. A shard is drained by queueing a None sentinel: it finishes
+    everything queued before it, closes its session store and exits; updates queued
+    after the sentinel wait for the restarted process.
+    """
+
+    def __init__(self, shards, queue_size=10000, put_timeout=1.0, drain_timeout=30.0):
+        self.shards = shards
+        self.put_timeout = put_timeout
+        self.drain_timeout = drain_timeout
+        self.stats = {'accepted': 0, 'rejected': 0, 'restarts': 0}
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue(maxsize=queue_size) for _ in range(shards)]
+        self._processes = [None] * shards
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._supervisor = threading.Thread(target=self._supervise, name='shard-supervisor', daemon=True)
+
+    def _spawn(self, index):
+        process = self._context.Process(target=run_shard, name=f'shard-{index}',
+                                        args=(index, self._queues[index], shard_env(index, self.shards)))
+        process.start()
+        self._processes[index] = process
+
+    def start(self):
+        for index in range(self.shards):
+            self._spawn(index)
+        self._supervisor.start()
+
+    def submit_json(self, data):
+        """Queue a raw update for its shard. Returns False when the shard's queue is full."""
+        shard_queue = self._queues[hash(get_update_chat_id(data)) % self.shards]
+        try:
+            shard_queue.put(data, timeout=self.put_timeout)
+        except queue.Full:
+            self.stats['rejected'] += 1
+            return False
+        self.stats['accepted'] += 1
+        return True
+
+    def queue_depth(self):
+        return sum(shard_queue.qsize() for shard_queue in self._queues)
+
+    def _join(self, index):
+        process = self._processes[index]
+        process.join(self.drain_timeout)
+        if process.is_alive():
+            logger.warning("Shard %s did not drain in %s s, killing it", index, self.drain_timeout)
+            process.kill()
+            process.join()
+
+    def restart(self, index):
+        """Drain one shard and start a fresh process on the same queue."""
+        with self._lock:
+            self._queues[index].put(None)
+            self._join(index)
+            self._spawn(index)
+            self.stats['restarts'] += 1
+        logger.info("Shard %s restarted", index)
+
+    def rolling_restart(self):
+        for index in range(self.shards):
+            if self._stopping.is_set():
+                return
+            self.restart(index)
+
+    def _supervise(self):
+        while not self._stopping.wait(1.0):
+            with self._lock:
+                for index, process in enumerate(self._processes):
+                    if not process.is_alive() and not self._stopping.is_set():
+                        logger.error("Shard %s exited with code %s, restarting", index, process.exitcode)
+                        self._spawn(index)
+                        self.stats['restarts'] += 1
+
+    def stop(self):
+        """Drain all shards in parallel and wait for them to exit."""
+        self._stopping.set()
+        with self._lock:
+            for shard_queue in self._queues:
+                shard_queue.put(None)
+            for index in range(self.shards):
+                self._join(index)
+
+# Фронт
+
+TOKEN = os.environ.get('BOT_TOKEN')
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', os.environ.get('PORT', '8443')))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9090'))
+
+def set_commands():
+    """Sync the command menu for all shards from the front process."""
+    # core не загружает каталог и не открывает хранилища при импорте
+    import core
+    from telebot import TeleBot
+    startup.sync_commands(TeleBot(TOKEN, threaded=False), TOKEN, core.COMMANDS_STAMP_PATH, core.get_bot_commands())
+
+def poll(dispatcher):
+    """Long polling front: getUpdates in this process, handling in the shards."""
+    offset = None
+    backoff = startup.Backoff(float(os.environ.get('POLLING_BACKOFF_BASE', '1')),
+                              float(os.environ.get('POLLING_BACKOFF_CAP', '60')))
+    while True:
+        try:
+            updates = apihelper.get_updates(TOKEN, offset, 100, POLLING_TIMEOUT + 5, None, POLLING_TIMEOUT)
+        except Exception as e:
+            delay = backoff.next_delay()
+            logger.error("getUpdates failed, retrying in %.1f s: %s", delay, e)
+            time.sleep(delay)
+            continue
+        backoff.reset()
+        for data in updates:
+            # put_timeout=None: при полной очереди шарда ждём, а не теряем апдейт
+            dispatcher.submit_json(data)
+            offset = data['update_id'] + 1
+
+def main():
+    if TOKEN is None:
+        raise ValueError("Произошла ошибка: переменная окружения BOT_TOKEN не может быть 'None'")
+    setup_logging()
+    if TELEGRAM_API_URL:
+        apihelper.API_URL = TELEGRAM_API_URL
+
+    webhook_mode = BOT_MODE == 'webhook'
+    dispatcher = ShardedDispatcher(SHARDS, queue_size=SHARD_QUEUE_SIZE,
+                                   put_timeout=1.0 if webhook_mode else None,
+                                   drain_timeout=SHARD_DRAIN_TIMEOUT)
+
+    def terminate(signum, frame):
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, terminate)
+    signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+        target=dispatcher.rolling_restart, name='rolling-restart', daemon=True).start())
+
+    if METRICS_ENABLED:
+        metrics.registry.gauge('bot_shard_queue_depth', 'Updates queued for the shard processes.',
+                               dispatcher.queue_depth)
+        metrics.registry.gauge('bot_shard_restarts', 'Shard processes restarted so far.',
+                               lambda: dispatcher.stats['restarts'])
+        metrics.start_metrics_server(METRICS_HOST, METRICS_PORT, ready=startup.timer.is_ready,
+                                     report=startup.timer.report)
+
+    logger.info("Starting %s shards in %s mode", SHARDS, BOT_MODE)
+    threading.Thread(target=set_commands, name='set-commands', daemon=True).start()
+    if webhook_mode:
+        from webhook import serve_webhook
+        if WEBHOOK_URL:
+            apihelper.delete_webhook(TOKEN)
+            apihelper.set_webhook(TOKEN, WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+        # serve_webhook сам запускает и останавливает диспетчер
+        startup.timer.set_ready()
+        serve_webhook(None, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                      secret_token=WEBHOOK_SECRET, dispatcher=dispatcher)
+        return
+
+    dispatcher.start()
+    startup.timer.set_ready()
+    try:
+        poll(dispatcher)
+    finally:
+        dispatcher.stop()
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
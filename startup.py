@@ -0,0 +1,131 @@
+import json
+import time
+import random
+import hashlib
+import inspect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class StartupTimer:
+    """Durations of the startup phases, readiness and time to the first update.
+
+    Times are counted from the import of this module, which bot.py does first.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+        self.ready = threading.Event()
+        self.ready_seconds = None
+        self.first_update_seconds = None
+        self._last = self.started
+
+    def mark(self, name):
+        """Close the phase that ran since the previous mark."""
+        now = time.perf_counter()
+        self.phases.append((name, now - self._last))
+        self._last = now
+
+    def set_ready(self):
+        self.ready_seconds = time.perf_counter() - self.started
+        self.ready.set()
+        logger.info("Ready in %.1f ms: %s", self.ready_seconds * 1000,
+                    ', '.join(f"{name} {seconds * 1000:.1f} ms" for name, seconds in self.phases))
+
+    def is_ready(self):
+        return self.ready.is_set()
+
+    def first_update(self):
+        if self.first_update_seconds is None:
+            self.first_update_seconds = time.perf_counter() - self.started
+            logger.info("First update %.1f ms after start", self.first_update_seconds * 1000)
+
+    def report(self):
+        """Phase durations, time to ready and to the first update; served on /startup of the metrics server."""
+        return {
+            'phases_ms': {name: round(seconds * 1000, 2) for name, seconds in self.phases},
+            'ready_ms': round(self.ready_seconds * 1000, 2) if self.ready_seconds is not None else None,
+            'first_update_ms': (round(self.first_update_seconds * 1000, 2)
+                                if self.first_update_seconds is not None else None),
+        }
+
+timer = StartupTimer()
+
+def watch_first_update(bot):
+    """Record the first processed batch of updates, then drop the hook. Works for TeleBot and AsyncTeleBot."""
+    process_new_updates = bot.process_new_updates
+
+    if inspect.iscoroutinefunction(process_new_updates):
+        async def first_batch_async(updates):
+            if updates:
+                timer.first_update()
+                bot.process_new_updates = process_new_updates
+            return await process_new_updates(updates)
+        bot.process_new_updates = first_batch_async
+        return
+
+    def first_batch(updates):
+        if updates:
+            timer.first_update()
+            # Дальше вызовы идут напрямую в прежний обработчик, например фильтр повторов
+            bot.process_new_updates = process_new_updates
+        return process_new_updates(updates)
+
+    bot.process_new_updates = first_batch
+
+class Backoff:
+    """Exponential backoff with jitter: the n-th delay is in [d/2, d] with d = min(cap, base * 2**n)."""
+
+    def __init__(self, base=1.0, cap=60.0):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
+
+    def next_delay(self):
+        delay = min(self.cap, self.base * 2 ** self.attempt)
+        # После потолка степень больше не растёт: иначе base * 2**n с float переполняется на n = 1024
+        if delay < self.cap:
+            self.attempt += 1
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def reset(self):
+        self.attempt = 0
+
+# Команды бота
+
+def commands_digest(token, commands):
+    """Digest of the bot id and its command list, stored after a successful sync."""
+    payload = json.dumps([command.to_dict() for command in commands], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(f"{token.split(':')[0]}:{payload}".encode('utf-8')).hexdigest()
+
+def commands_unchanged(stamp_path, digest):
+    try:
+        with open(stamp_path, 'r', encoding='utf-8') as file:
+            return file.read().strip() == digest
+    except OSError:
+        return False
+
+def remember_commands(stamp_path, digest):
+    try:
+        with open(stamp_path, 'w', encoding='utf-8') as file:
+            file.write(digest)
+    except OSError as e:
+        logger.warning("Failed to store bot commands stamp: %s", e)
+
+def same_commands(current, commands):
+    return [command.to_dict() for command in current] == [command.to_dict() for command in commands]
+
+def sync_commands(bot, token, stamp_path, commands):
+    """Sync the command menu of a sync TeleBot; without any API call when the stored stamp matches."""
+    digest = commands_digest(token, commands)
+    if commands_unchanged(stamp_path, digest):
+        logger.info("Bot commands unchanged, skipping set_my_commands")
+        return
+    try:
+        if not same_commands(bot.get_my_commands(), commands):
+            bot.set_my_commands(commands)
+        remember_commands(stamp_path, digest)
+    except Exception as e:
+        logger.error("Failed to set bot commands: %s", e)
@@ -0,0 +1,131 @@
+import json
+import queue
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telebot.types import Update
+
+logger = logging.getLogger(__name__)
+
+def get_chat_id(update):
+    """Chat the update belongs to; updates of one chat must be handled in order."""
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    if update.inline_query:
+        return update.inline_query.from_user.id
+    return update.update_id
+
+# Пул обработчиков
+
+class UpdateDispatcher:
+    """Worker pool with one bounded queue per worker.
+
+    Updates are routed by chat id, so all updates of one chat go to the same worker
+    and are processed in the order they arrived, while different chats run in parallel.
+    """
+
+    def __init__(self, process_update, workers=4, queue_size=1000, put_timeout=1.0):
+        self.process_update = process_update
+        self.put_timeout = put_timeout
+        self.stats = {'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0}
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = [
+            threading.Thread(target=self._work, args=(q,), name=f'update-worker-{index}', daemon=True)
+            for index, q in enumerate(self._queues)
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, update):
+        """Queue an update. Returns False when the worker's queue is full."""
+        worker_queue = self._queues[hash(get_chat_id(update)) % len(self._queues)]
+        try:
+            worker_queue.put(update, timeout=self.put_timeout)
+        except queue.Full:
+            self.stats['rejected'] += 1
+            return False
+        self.stats['accepted'] += 1
+        return True
+
+    def submit_json(self, data):
+        return self.submit(Update.de_json(data))
+
+    def queue_depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def _work(self, worker_queue):
+        while True:
+            update = worker_queue.get()
+            if update is None:
+                break
+            try:
+                self.process_update(update)
+                self.stats['processed'] += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.exception("Failed to process update %s: %s", update.update_id, e)
+            finally:
+                worker_queue.task_done()
+
+    def stop(self):
+        """Process everything already queued, then stop the workers."""
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+# HTTP-сервер
+
+def make_webhook_handler(dispatcher, path, secret_token=None):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != path:
+                self.send_error(404)
+                return
+            if secret_token and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret_token:
+                self.send_error(403)
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                accepted = dispatcher.submit_json(json.loads(self.rfile.read(length)))
+            except Exception as e:
+                logger.error("Invalid webhook payload: %s", e)
+                self.send_error(400)
+                return
+            # 503 заставит Telegram повторить доставку позже
+            if not accepted:
+                self.send_error(503)
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return WebhookHandler
+
+def create_webhook_server(dispatcher, host='0.0.0.0', port=8443, path='/webhook', secret_token=None):
+    return ThreadingHTTPServer((host, port), make_webhook_handler(dispatcher, path, secret_token))
+
+def serve_webhook(process_update, host='0.0.0.0', port=8443, path='/webhook', secret_token=None,
+                  workers=4, queue_size=1000, dispatcher=None):
+    """Run the webhook server; dispatcher replaces the in-process worker pool, e.g. with shards."""
+    if dispatcher is None:
+        dispatcher = UpdateDispatcher(process_update, workers=workers, queue_size=queue_size)
+    dispatcher.start()
+    server = create_webhook_server(dispatcher, host, port, path, secret_token)
+    logger.info("Webhook server listening on %s:%s%s", host, port, path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        dispatcher.stop()